@@ -38,6 +38,13 @@ DATABASES = {
         'HOST': os.environ.get('PGHOST', 'localhost'),
     }
 }
+# Shards, for tests of ``TICKETOFFICE_SHARDS``.
+for shard in ('shard1', 'shard2'):
+    DATABASES[shard] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(data_dir, f'{shard}.sqlite3'),
+        'TEST': {'DEPENDENCIES': []},
+    }
 
 
 # URL configuration.
@@ -0,0 +1,261 @@
+"""Benchmarks.
+
+Run them with the ``benchmark_tickets`` management command.
+
+Benchmarks return time per operation in seconds, by label.
+
+"""
+import asyncio
+import time
+import timeit
+from datetime import timedelta
+from functools import partial
+from random import SystemRandom
+
+from asgiref.sync import async_to_sync
+from django.conf import global_settings
+from django.core.management import call_command
+from django.http import HttpResponse
+from django.test import RequestFactory
+from django.utils.timezone import now
+
+from django_ticketoffice.decorators import (invitation_required,
+                                            stamp_invitation)
+from django_ticketoffice.models import Ticket
+from django_ticketoffice.utils import (import_member, random_password,
+                                       random_passwords)
+
+
+def measure(func, repeat=5):
+    """Return best execution time of ``func()``, in seconds."""
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+def measure_once(func):
+    """Return execution time of ``func()``, in seconds.
+
+    For benchmarks too slow or with too many side effects to be repeated.
+
+    """
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+
+def system_random_password(min_length=16, max_length=32,
+                           alphabet='abcdefghjkmnpqrstuvwxyz'
+                                    'ABCDEFGHJKLMNPQRSTUVWXYZ'
+                                    '23456789'):
+    """Return password like django-ticketoffice 0.11 did.
+
+    Reference for :func:`bench_password_generation`: same lengths and
+    alphabet, thus same entropy, with one ``SystemRandom`` call per
+    character.
+
+    """
+    random = SystemRandom()
+    length = random.randint(min_length, max_length)
+    return ''.join(random.choice(alphabet) for i in range(length))
+
+
+def bench_password_generation(count=10000):
+    """Return time to generate a password, one at a time and by batch.
+
+    All generators return passwords of 12 to 20 characters of the default
+    alphabet, i.e. the same entropy.
+
+    """
+    kwargs = {'min_length': 12, 'max_length': 20}
+    return {
+        'SystemRandom': measure(
+            lambda: [system_random_password(**kwargs)
+                     for i in range(count)],
+            repeat=3) / count,
+        'random_password': measure(
+            lambda: [random_password(**kwargs) for i in range(count)],
+            repeat=3) / count,
+        'random_passwords': measure(
+            partial(random_passwords, count, **kwargs),
+            repeat=3) / count,
+    }
+
+
+def bench_password_hashers(hashers=None):
+    """Return time to verify a ticket password, per hasher.
+
+    Compares hashers at import paths ``hashers``. Default is Django's default
+    ``PASSWORD_HASHERS`` and
+    :class:`~django_ticketoffice.utils.HMACPasswordHasher`.
+
+    Hashers whose library is not installed (bcrypt, argon2...) are skipped.
+
+    """
+    if hashers is None:
+        hashers = list(global_settings.PASSWORD_HASHERS) + [
+            'django_ticketoffice.utils.HMACPasswordHasher',
+        ]
+    password = random_password(min_length=12, max_length=20)
+    results = {}
+    for import_path in hashers:
+        hasher = import_member(import_path)()
+        try:
+            encoded = hasher.encode(password, hasher.salt())
+        except ValueError:  # Missing library.
+            continue
+        results[import_path] = measure(
+            partial(hasher.verify, password, encoded))
+    return results
+
+
+def fill(size, batch_size=10000, **fields):
+    """Insert ``size`` tickets with ``fields``.
+
+    Passwords are not hashed, unless ``password`` is in ``fields``.
+
+    """
+    fields.setdefault('password', '!')
+    for start in range(0, size, batch_size):
+        Ticket.objects.bulk_create(
+            [Ticket(**fields) for i in range(min(batch_size, size - start))])
+
+
+def bench_generate_password():
+    """Return time to generate and hash a ticket password."""
+    return {
+        'Ticket.generate_password': measure(Ticket().generate_password),
+    }
+
+
+def bench_lifecycle(size, stamps=100):
+    """Return time of ticket operations, with ``size`` tickets in table.
+
+    Covers password verification, authentication by the manager, a round
+    trip through ``invitation_required`` (credentials then session) and
+    ``stamp_invitation``, measured on ``stamps`` tickets.
+
+    """
+    view = invitation_required(place='louvre', purpose='visit')(
+        lambda request: HttpResponse())
+    stamp_view = stamp_invitation(lambda request: HttpResponse())
+    factory = RequestFactory()
+
+    def round_trip(ticket, password):
+        request = factory.get('/', {'uuid': str(ticket.uuid),
+                                    'password': password})
+        request.session = {}
+        view(request)
+        request = factory.get('/')
+        request.session = {'invitation': str(ticket.uuid)}
+        view(request)
+
+    def stamp(tickets):
+        for ticket in tickets:
+            request = factory.get('/')
+            request.session = {}
+            request.invitation = ticket
+            stamp_view(request)
+
+    fill(size, place='louvre', purpose='visit')
+    try:
+        ticket, password = Ticket.objects.issue(place='louvre',
+                                                purpose='visit')
+        results = {
+            'Ticket.authenticate': measure(
+                partial(ticket.authenticate, password)),
+            'TicketManager.authenticate': measure(
+                partial(Ticket.objects.authenticate, ticket.uuid, password,
+                        place='louvre', purpose='visit')),
+            'invitation_required': measure(
+                partial(round_trip, ticket, password)),
+        }
+        tickets = [Ticket(place='louvre', purpose='visit', password='!')
+                   for i in range(stamps)]
+        Ticket.objects.bulk_create(tickets)
+        results['stamp_invitation'] = \
+            measure_once(partial(stamp, tickets)) / stamps
+    finally:
+        Ticket.objects.all().delete()
+    return results
+
+
+def bench_async_throughput(size, concurrency=100):
+    """Return time per ticket to issue then authenticate it, sync vs async.
+
+    Sync API handles tickets one after the other, async API handles
+    ``concurrency`` tickets concurrently.
+
+    """
+    def run_sync():
+        issued = [Ticket.objects.issue() for i in range(concurrency)]
+        for ticket, clear_password in issued:
+            Ticket.objects.authenticate(ticket.uuid, clear_password)
+
+    async def run_async():
+        issued = await asyncio.gather(*[
+            Ticket.objects.aissue() for i in range(concurrency)])
+        await asyncio.gather(*[
+            Ticket.objects.aauthenticate(ticket.uuid, clear_password)
+            for ticket, clear_password in issued])
+
+    fill(size)
+    try:
+        return {
+            'sync': measure(run_sync, repeat=3) / concurrency,
+            'async': measure(async_to_sync(run_async), repeat=3)
+            / concurrency,
+        }
+    finally:
+        Ticket.objects.all().delete()
+
+
+def bench_insert(size, batch_size=1000):
+    """Return time to insert a ticket, with bulk inserts of ``batch_size``.
+
+    Passwords are not hashed, so that the result depends on the cost of
+    writing rows and maintaining indexes.
+
+    """
+    expiry_datetime = now() + timedelta(days=1)
+    try:
+        seconds = measure_once(partial(fill, size, batch_size=batch_size,
+                                       place='louvre', purpose='visit',
+                                       expiry_datetime=expiry_datetime))
+    finally:
+        Ticket.objects.all().delete()
+    return {'bulk_create': seconds / size}
+
+
+def bench_cleanup(size, batch_size=1000):
+    """Return time per ticket for ``clean_tickets`` to delete expired ones.
+
+    Among ``size`` tickets, half are expired.
+
+    """
+    fill(size // 2, place='louvre', purpose='visit',
+         expiry_datetime=now() - timedelta(days=1))
+    fill(size - size // 2, place='louvre', purpose='visit')
+    try:
+        seconds = measure_once(partial(call_command, 'clean_tickets',
+                                       batch_size=batch_size, verbosity=0))
+    finally:
+        Ticket.objects.all().delete()
+    return {'clean_tickets': seconds / max(size // 2, 1)}
+
+
+#: Available benchmarks, by name.
+BENCHMARKS = {
+    'async': bench_async_throughput,
+    'cleanup': bench_cleanup,
+    'generate_password': bench_generate_password,
+    'hashers': bench_password_hashers,
+    'insert': bench_insert,
+    'lifecycle': bench_lifecycle,
+    'passwords': bench_password_generation,
+}
+
+#: Benchmarks that write to the database. They take the number of tickets in
+#: table as argument. The ``benchmark_tickets`` command runs them against a
+#: test database.
+DATABASE_BENCHMARKS = {'async', 'cleanup', 'insert', 'lifecycle'}
@@ -0,0 +1,233 @@
+"""Probabilistic filter of tickets' UUIDs."""
+import hashlib
+import math
+import os
+import threading
+from datetime import timedelta
+from uuid import UUID
+
+from django.apps import apps
+from django.db import connections
+from django.utils.timezone import now
+
+from django_ticketoffice import settings
+from django_ticketoffice.sharding import get_shards
+
+
+class BloomFilter:
+    """Bloom filter of UUIDs.
+
+    Tells whether an UUID was *maybe* added, or was *definitely not* added.
+
+    Sized to hold ``capacity`` UUIDs with ``error_rate`` probability of false
+    positives, within ``max_bytes`` of memory if set (at the cost of a higher
+    error rate).
+
+    Hash functions are keyed with a random key, so that positions of an UUID
+    in the filter cannot be predicted from outside.
+
+    """
+    def __init__(self, capacity, error_rate=0.001, max_bytes=None):
+        capacity = max(capacity, 1)
+        size = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        if max_bytes is not None:
+            size = min(size, max_bytes * 8)
+        #: Number of bits.
+        self.size = max(size, 8)
+        #: Number of hash functions.
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray(math.ceil(self.size / 8))
+        self.key = os.urandom(16)
+
+    def positions(self, uuid):
+        """Return positions of ``uuid`` bits in filter."""
+        digest = hashlib.blake2b(UUID(str(uuid)).bytes, digest_size=16,
+                                 key=self.key).digest()
+        # Double hashing: the i-th hash function is h1 + i * h2.
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hash_count)]
+
+    def add(self, uuid):
+        for position in self.positions(uuid):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, uuid):
+        return all(self.bits[position >> 3] & (1 << (position & 7))
+                   for position in self.positions(uuid))
+
+
+class TicketUUIDFilter:
+    """In-process filter of UUIDs of tickets in database.
+
+    Lets callers reject unknown UUIDs without querying the database. Options
+    come from ``settings.TICKETOFFICE_UUID_FILTER``. ``None`` disables the
+    filter.
+
+    The filter is built on first use, with a streaming scan of tickets. Then:
+
+    * tickets created in current process are added at once;
+
+    * tickets created by other processes are added every ``refresh`` seconds;
+
+    * the filter is rebuilt every ``rebuild`` seconds, so that it forgets
+      deleted tickets. Rebuilds run in a background thread, while requests
+      use the current filter.
+
+    The lock only guards changes of the filter in memory: database scans run
+    without it. While another thread builds the first filter, every UUID
+    passes.
+
+    """
+    #: Default options.
+    defaults = {
+        'error_rate': 0.001,
+        'max_bytes': 16 * 1024 * 1024,
+        'refresh': 10,
+        'rebuild': 3600,
+    }
+
+    #: Tolerated clock difference between processes creating tickets, in
+    #: seconds.
+    clock_skew = 60
+
+    #: Ratio between filter's capacity and number of tickets at build time.
+    headroom = 2
+
+    def __init__(self):
+        self.filter = None
+        self.built_at = None
+        self.synced_at = None
+        #: UUIDs added while a new filter is being built.
+        self._pending = None
+        self._updating = False
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return settings.TICKETOFFICE_UUID_FILTER is not None
+
+    @property
+    def options(self):
+        return {**self.defaults, **settings.TICKETOFFICE_UUID_FILTER}
+
+    @property
+    def model(self):
+        return apps.get_model('django_ticketoffice', 'Ticket')
+
+    def get_querysets(self):
+        """Return UUIDs of tickets, one queryset per shard if sharded."""
+        queryset = self.model.objects.values_list('uuid', flat=True)
+        shards = get_shards()
+        if shards:
+            return [queryset.using(shard) for shard in shards]
+        return [queryset]
+
+    def build(self):
+        """Build filter from scratch with tickets in database.
+
+        The new filter replaces the current one once complete, with UUIDs
+        added in the meantime.
+
+        """
+        options = self.options
+        with self._lock:
+            self._pending = []
+        try:
+            querysets = self.get_querysets()
+            timestamp = now()
+            count = sum(queryset.count() for queryset in querysets)
+            new_filter = BloomFilter(
+                capacity=max(count * self.headroom, 1000),
+                error_rate=options['error_rate'],
+                max_bytes=options['max_bytes'])
+            for queryset in querysets:
+                for uuid in queryset.iterator(chunk_size=10000):
+                    new_filter.add(uuid)
+            with self._lock:
+                for uuid in self._pending:
+                    new_filter.add(uuid)
+                self.filter = new_filter
+                self.built_at = self.synced_at = timestamp
+        finally:
+            self._pending = None
+
+    def sync(self):
+        """Add tickets created since last sync to filter."""
+        timestamp = now()
+        since = self.synced_at - timedelta(seconds=self.clock_skew)
+        uuids = []
+        for queryset in self.get_querysets():
+            queryset = queryset.filter(creation_datetime__gte=since)
+            uuids.extend(queryset.iterator(chunk_size=10000))
+        with self._lock:
+            for uuid in uuids:
+                self.filter.add(uuid)
+            self.synced_at = timestamp
+
+    def _run(self, task, background=False):
+        try:
+            task()
+        finally:
+            self._updating = False
+            if background:
+                # Background threads have their own connections.
+                connections.close_all()
+
+    def update(self):
+        """Build, rebuild or sync filter if due.
+
+        One thread at a time updates the filter: others go on with current
+        filter.
+
+        """
+        options = self.options
+        with self._lock:
+            if self._updating:
+                return
+            timestamp = now()
+            background = False
+            if self.filter is None:
+                task = self.build
+            elif (timestamp - self.built_at) \
+                    > timedelta(seconds=options['rebuild']):
+                task, background = self.build, True
+            elif (timestamp - self.synced_at) \
+                    > timedelta(seconds=options['refresh']):
+                task = self.sync
+            else:
+                return
+            self._updating = True
+        if background:
+            threading.Thread(target=self._run, args=(task, True),
+                             name='ticketoffice-uuid-filter',
+                             daemon=True).start()
+        else:
+            self._run(task)
+
+    def add(self, uuid):
+        """Add ``uuid`` to filter, if built or being built."""
+        if not self.enabled:
+            return
+        with self._lock:
+            if self.filter is not None:
+                self.filter.add(uuid)
+            if self._pending is not None:
+                self._pending.append(uuid)
+
+    def might_contain(self, uuid):
+        """Return False if there is definitely no ticket with ``uuid``.
+
+        Always True if filter is disabled.
+
+        """
+        if not self.enabled:
+            return True
+        self.update()
+        current = self.filter
+        return current is None or uuid in current
+
+
+#: Filter shared by :class:`~django_ticketoffice.models.Ticket`, its manager
+#: and decorators.
+uuid_filter = TicketUUIDFilter()
@@ -0,0 +1,133 @@
+"""Cache of valid tickets."""
+import threading
+from functools import partial
+from uuid import UUID
+
+from django.core.cache import InvalidCacheBackendError, caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import transaction
+from django.utils.timezone import now
+
+from django_ticketoffice import settings
+
+
+class TicketCache:
+    """Cache state of valid tickets, by UUID.
+
+    Uses cache ``settings.TICKETOFFICE_CACHE`` of ``settings.CACHES``. If no
+    such cache is configured, falls back to a local-memory cache, which is
+    only invalidated within the current process. ``None`` disables the cache.
+
+    Entries live ``settings.TICKETOFFICE_CACHE_TIMEOUT`` seconds at most, and
+    never after ticket's expiry.
+
+    Changed tickets are invalidated when the transaction changing them
+    commits, see :meth:`invalidate`. Invalidated entries are replaced by
+    tombstones for :attr:`tombstone_timeout` seconds, which :meth:`set` does
+    not overwrite: a lookup which read the ticket before the change cannot
+    cache it again.
+
+    """
+    #: Prefix of cache keys.
+    key_prefix = 'ticketoffice:ticket:'
+
+    #: Value of invalidated entries.
+    tombstone = 'invalidated'
+
+    #: Lifetime of tombstones, in seconds. Longer than the time between a
+    #: lookup and caching its result.
+    tombstone_timeout = 10
+
+    #: Ticket fields stored in cache. Others are loaded on first access.
+    fields = ('id', 'uuid', 'place', 'purpose', 'expiry_datetime',
+              'usage_datetime', 'max_uses', 'use_count')
+
+    def __init__(self):
+        #: Number of lookups that found a ticket in cache.
+        self.hits = 0
+        #: Number of lookups that did not find a ticket in cache.
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._fallback = LocMemCache('django_ticketoffice', {})
+
+    @property
+    def enabled(self):
+        return settings.TICKETOFFICE_CACHE is not None
+
+    @property
+    def backend(self):
+        """Return Django cache backend."""
+        try:
+            return caches[settings.TICKETOFFICE_CACHE]
+        except InvalidCacheBackendError:
+            return self._fallback
+
+    def make_key(self, uuid):
+        try:
+            uuid = UUID(str(uuid)).hex
+        except ValueError:
+            pass
+        return f'{self.key_prefix}{uuid}'
+
+    def get(self, uuid):
+        """Return cached state of ticket ``uuid``, as a dict, or None."""
+        if not self.enabled:
+            return None
+        state = self.backend.get(self.make_key(uuid))
+        if state == self.tombstone:
+            state = None
+        with self._lock:
+            if state is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return state
+
+    def set(self, ticket):
+        """Store state of ``ticket`` in cache, if ticket is valid.
+
+        Does not overwrite entries, nor tombstones.
+
+        """
+        if not self.enabled or not ticket.is_valid():
+            return
+        timeout = settings.TICKETOFFICE_CACHE_TIMEOUT
+        if ticket.expiry_datetime is not None:
+            timeout = min(timeout,
+                          (ticket.expiry_datetime - now()).total_seconds())
+            if timeout <= 0:
+                return
+        state = {name: getattr(ticket, name) for name in self.fields}
+        self.backend.add(self.make_key(ticket.uuid), state, timeout)
+
+    def delete(self, uuid):
+        """Replace ticket ``uuid`` by a tombstone in cache."""
+        self.delete_many([uuid])
+
+    def delete_many(self, uuids):
+        """Replace tickets ``uuids`` by tombstones in cache."""
+        if self.enabled and uuids:
+            self.backend.set_many(
+                {self.make_key(uuid): self.tombstone for uuid in uuids},
+                self.tombstone_timeout)
+
+    def invalidate(self, uuids, using):
+        """Delete tickets ``uuids`` when transaction of ``using`` commits.
+
+        At once outside transactions. Before commit, other transactions
+        still read tickets unchanged, and could cache them again.
+
+        """
+        if self.enabled and uuids:
+            transaction.on_commit(partial(self.delete_many, list(uuids)),
+                                  using=using)
+
+    def stats(self):
+        """Return hits and misses counters, as a dict."""
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses}
+
+
+#: Cache shared by :class:`~django_ticketoffice.models.Ticket` and its
+#: manager.
+ticket_cache = TicketCache()
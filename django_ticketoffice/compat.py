@@ -1,9 +1,54 @@
+import asyncio
+
+from asgiref.sync import sync_to_async
+from django.db.models import JSONField, QuerySet
+
 try:
-    from django.db.models import JSONField
-except ImportError:
-    from django.contrib.postgres.fields import JSONField
+    from asgiref.sync import markcoroutinefunction
+except ImportError:  # asgiref < 3.6
+    def markcoroutinefunction(func):
+        func._is_coroutine = asyncio.coroutines._is_coroutine
+        return func
+
+
+#: Whether Django's ORM has an asynchronous API (Django >= 4.1).
+ASYNC_ORM = hasattr(QuerySet, 'aget')
+
+
+async def aget(queryset, *args, **kwargs):
+    """Asynchronous ``queryset.get()``."""
+    if ASYNC_ORM:
+        return await queryset.aget(*args, **kwargs)
+    return await sync_to_async(queryset.get)(*args, **kwargs)
+
+
+async def acreate(queryset, **kwargs):
+    """Asynchronous ``queryset.create()``."""
+    if ASYNC_ORM:
+        return await queryset.acreate(**kwargs)
+    return await sync_to_async(queryset.create)(**kwargs)
+
+
+async def abulk_create(queryset, objs, **kwargs):
+    """Asynchronous ``queryset.bulk_create()``."""
+    if ASYNC_ORM:
+        return await queryset.abulk_create(objs, **kwargs)
+    return await sync_to_async(queryset.bulk_create)(objs, **kwargs)
+
+
+async def aupdate(queryset, **kwargs):
+    """Asynchronous ``queryset.update()``."""
+    if ASYNC_ORM:
+        return await queryset.aupdate(**kwargs)
+    return await sync_to_async(queryset.update)(**kwargs)
 
 
 __all__ = [
-    'JSONField'
+    'ASYNC_ORM',
+    'JSONField',
+    'abulk_create',
+    'acreate',
+    'aget',
+    'aupdate',
+    'markcoroutinefunction',
 ]
@@ -1,13 +1,21 @@
 """View decorators."""
-import json
-from functools import wraps
+import asyncio
+from datetime import datetime
+from functools import partial, wraps
 from uuid import UUID
 
+from asgiref.sync import sync_to_async
+from django.core import signing
+from django.db import transaction
 from django.http import HttpResponseRedirect
 
 from django_ticketoffice import exceptions
+from django_ticketoffice import settings
+from django_ticketoffice.bloom import uuid_filter
 from django_ticketoffice.forms import TicketAuthenticationForm
+from django_ticketoffice.metrics import INVITATIONS, metrics
 from django_ticketoffice.models import Ticket, GuestUser
+from django_ticketoffice.tokens import TOKEN_PARAMETER, load_token
 from django_ticketoffice.utils import (UnauthorizedView, ForbiddenView,
                                        Decorator)
 
@@ -20,22 +28,65 @@ forbidden_view = ForbiddenView.as_view(
     template_name='invitation/403.html')
 
 
+#: Session key where ticket snapshots are stored.
+SNAPSHOT_SESSION_KEY = 'invitation_snapshot'
+
+
+#: Salt of ticket snapshots' signatures.
+SNAPSHOT_SALT = 'django_ticketoffice.decorators.snapshot'
+
+
+def make_snapshot(ticket):
+    """Return signed snapshot of valid ``ticket``, for storage in session.
+
+    Usage count is not part of snapshots: it changes with each use, from any
+    process. Only tickets with a single use, thus unused while valid, are
+    snapshot.
+
+    """
+    expiry_datetime = ticket.expiry_datetime
+    if expiry_datetime is not None:
+        expiry_datetime = expiry_datetime.isoformat()
+    return signing.dumps({'id': ticket.pk,
+                          'uuid': ticket.uuid.hex,
+                          'place': ticket.place,
+                          'purpose': ticket.purpose,
+                          'expiry_datetime': expiry_datetime,
+                          'max_uses': ticket.max_uses},
+                         salt=SNAPSHOT_SALT,
+                         compress=True)
+
+
+def load_snapshot(value, max_age):
+    """Return ticket from signed snapshot ``value``.
+
+    Raises :class:`django.core.signing.BadSignature` if ``value`` was
+    tampered with or is older than ``max_age`` seconds.
+
+    """
+    snapshot = signing.loads(value, salt=SNAPSHOT_SALT, max_age=max_age)
+    expiry_datetime = snapshot['expiry_datetime']
+    if expiry_datetime is not None:
+        expiry_datetime = datetime.fromisoformat(expiry_datetime)
+    return Ticket.from_db(None,
+                          ['id', 'uuid', 'place', 'purpose',
+                           'expiry_datetime', 'usage_datetime', 'max_uses',
+                           'use_count'],
+                          [snapshot['id'], UUID(snapshot['uuid']),
+                           snapshot['place'], snapshot['purpose'],
+                           expiry_datetime, None, snapshot['max_uses'], 0])
+
+
 def guest_login(request, invitation):
-    """Perform guest login in request."""
+    """Perform guest login in request.
+
+    Does not read invitation's data: see :attr:`GuestUser.id`.
+
+    """
     # Cache the invitation instance in request.
     request.invitation = invitation
     request.user = GuestUser(invitation=invitation, invitation_valid=True)
 
-    try:
-        invitation_data = json.loads(invitation.data)
-    except (TypeError, ValueError):
-        return
-
-    try:
-        request.user.id = invitation_data['user']
-    except KeyError:
-        pass
-
 
 class invitation_required(Decorator):
     """Make sure invitation is provided for place and purpose.
@@ -61,93 +112,282 @@ class invitation_required(Decorator):
     Arguments `place` and `purpose` are required to filter invitations. User is
     invited somewhere (place) to do something (purpose).
 
+    Decorator instance is shared by concurrent requests: per-request state,
+    such as the ticket, is passed around as arguments.
+
+    Coroutine views are supported: then database queries do not block the
+    event loop, and passwords are verified in a thread pool.
+
+    If `tokens` is True, signed tokens in `token` GET parameter are accepted
+    too, see :mod:`django_ticketoffice.tokens`. They are validated without
+    querying tickets, and the view runs right away, without session.
+
+    .. warning::
+
+       Tokens are NOT checked against tickets' usage. After a ticket was
+       used or revoked, e.g. with ``Ticket.use()`` or
+       ``TicketQuerySet.revoke()``, its tokens stay valid until expiry,
+       unless the view is decorated with `stamp_invitation`. Revoke tokens
+       with :func:`django_ticketoffice.tokens.revoke`.
+
+    Tickets are read from database `using`. Default is routers' choice, see
+    :class:`django_ticketoffice.routers.TicketRouter`.
+
     """
-    def __init__(self, place, purpose):
+    def __init__(self, place, purpose, tokens=False, using=None):
         Decorator.__init__(self, func=Decorator.UNDEFINED_FUNCTION)
         self.place = place
         self.purpose = purpose
+        self.tokens = tokens
+        self.using = using
+
+    @property
+    def tickets(self):
+        """Return manager of tickets, for database :attr:`using`."""
+        if self.using is None:
+            return Ticket.objects
+        return Ticket.objects.db_manager(self.using)
 
     def run(self, request, *args, **kwargs):
+        if asyncio.iscoroutinefunction(self.decorated):
+            return self.arun(request, *args, **kwargs)
         try:
-            self.get_ticket(request)
+            with metrics.outcomes(INVITATIONS):
+                ticket = self.get_ticket(request)
         except exceptions.NoTicketError:
             return self.unauthorized(request)
         except (exceptions.CredentialsError,
                 exceptions.TicketUsedError,
                 exceptions.TicketExpiredError):
             return self.forbidden(request)
-        if 'invitation' not in request.session:
-            return self.redirect(request)
+        if 'invitation' not in request.session \
+                and self.get_token(request) is None:
+            return self.redirect(request, ticket)
         else:
-            self.login(request)
+            self.login(request, ticket)
             return self.valid(request, *args, **kwargs)
 
-    def get_ticket(self, request):
-        """Return ticket instance for ``request``."""
+    async def arun(self, request, *args, **kwargs):
+        """Asynchronous :meth:`run`, for coroutine views."""
+        # Session backends may query the database when session is loaded.
+        await sync_to_async(request.session.get)('invitation')
         try:
-            self.ticket = self.get_ticket_from_credentials(request)
+            with metrics.outcomes(INVITATIONS):
+                ticket = await self.aget_ticket(request)
         except exceptions.NoTicketError:
-            self.ticket = self.get_ticket_from_session(request)
-        self.validate_ticket()
+            return self.unauthorized(request)
+        except (exceptions.CredentialsError,
+                exceptions.TicketUsedError,
+                exceptions.TicketExpiredError):
+            return self.forbidden(request)
+        if 'invitation' not in request.session \
+                and self.get_token(request) is None:
+            return self.redirect(request, ticket)
+        else:
+            self.login(request, ticket)
+            return await self.valid(request, *args, **kwargs)
 
-    def get_ticket_from_session(self, request):
-        """Return ticket instance from ``request``'s session."""
+    def get_ticket(self, request):
+        """Return valid ticket instance for ``request``."""
+        token = self.get_token(request)
+        if token is not None:
+            ticket = self.get_ticket_from_token(token)
+        else:
+            try:
+                ticket = self.get_ticket_from_credentials(request)
+            except exceptions.NoTicketError:
+                ticket = self.get_ticket_from_session(request)
+        self.validate_ticket(ticket)
+        return ticket
+
+    async def aget_ticket(self, request):
+        """Asynchronous :meth:`get_ticket`."""
+        token = self.get_token(request)
+        if token is not None:
+            # Cache backends may block on network I/O.
+            ticket = await sync_to_async(self.get_ticket_from_token)(token)
+        else:
+            try:
+                ticket = await self.aget_ticket_from_credentials(request)
+            except exceptions.NoTicketError:
+                ticket = await self.aget_ticket_from_session(request)
+        self.validate_ticket(ticket)
+        return ticket
+
+    def get_token(self, request):
+        """Return signed token in ``request.GET``, or None.
+
+        Always None unless decorator accepts tokens.
+
+        """
+        if not self.tokens:
+            return None
+        return request.GET.get(TOKEN_PARAMETER)
+
+    def get_ticket_from_token(self, token):
+        """Return ticket instance from signed ``token``, without query."""
+        ticket = load_token(token)
+        if not ticket.is_appropriate(self.place, self.purpose):
+            raise exceptions.CredentialsError(
+                f'Token of ticket with UUID="{ticket.uuid}" is not for '
+                f'place="{self.place}" and purpose="{self.purpose}".')
+        return ticket
+
+    def get_session_uuid(self, request):
+        """Return UUID of ticket in ``request``'s session."""
         try:
-            invitation_uuid = UUID(request.session['invitation'])
+            return UUID(request.session['invitation'])
         except ValueError:
             raise exceptions.NoTicketError('Invalid ticket in session.')
         except KeyError:  # No ticket in session, check credentials.
             raise exceptions.NoTicketError('No ticket in session.')
-        else:
-            try:
-                return Ticket.objects.get(uuid=invitation_uuid,
-                                          place=self.place,
-                                          purpose=self.purpose)
-            except Ticket.DoesNotExist:
-                raise exceptions.CredentialsError(
-                    f'Ticket {invitation_uuid} in session no longer exists in'
-                    ' database.')
 
-    def get_ticket_from_credentials(self, request):
-        """Return ticket instance from credentials in ``request.get``."""
+    def get_ticket_from_session(self, request):
+        """Return ticket instance from ``request``'s session."""
+        invitation_uuid = self.get_session_uuid(request)
+        ticket = self.get_ticket_from_snapshot(request, invitation_uuid)
+        if ticket is not None:
+            return ticket
+        try:
+            ticket = self.tickets.get_cached(invitation_uuid,
+                                             place=self.place,
+                                             purpose=self.purpose)
+        except Ticket.DoesNotExist:
+            raise exceptions.CredentialsError(
+                f'Ticket {invitation_uuid} in session no longer exists in'
+                ' database.')
+        self.store_snapshot(request, ticket)
+        return ticket
+
+    async def aget_ticket_from_session(self, request):
+        """Asynchronous :meth:`get_ticket_from_session`."""
+        invitation_uuid = self.get_session_uuid(request)
+        ticket = self.get_ticket_from_snapshot(request, invitation_uuid)
+        if ticket is not None:
+            return ticket
+        try:
+            ticket = await self.tickets.aget_cached(invitation_uuid,
+                                                    place=self.place,
+                                                    purpose=self.purpose)
+        except Ticket.DoesNotExist:
+            raise exceptions.CredentialsError(
+                f'Ticket {invitation_uuid} in session no longer exists in'
+                ' database.')
+        self.store_snapshot(request, ticket)
+        return ticket
+
+    def get_ticket_from_snapshot(self, request, invitation_uuid):
+        """Return ticket from snapshot in ``request``'s session, or None.
+
+        Snapshots are only used if younger than
+        ``settings.TICKETOFFICE_SESSION_SNAPSHOT_MAX_AGE``, if they match
+        ``invitation_uuid``, place and purpose, and for single-use tickets.
+
+        """
+        max_age = settings.TICKETOFFICE_SESSION_SNAPSHOT_MAX_AGE
+        if max_age is None:
+            return None
+        try:
+            ticket = load_snapshot(request.session[SNAPSHOT_SESSION_KEY],
+                                   max_age)
+        except (KeyError, signing.BadSignature):
+            return None
+        if ticket.uuid != invitation_uuid or ticket.max_uses != 1 \
+                or not ticket.is_appropriate(self.place, self.purpose):
+            return None
+        return ticket
+
+    def store_snapshot(self, request, ticket):
+        """Store snapshot of ``ticket`` in ``request``'s session, if valid.
+
+        Does nothing if ``settings.TICKETOFFICE_SESSION_SNAPSHOT_MAX_AGE`` is
+        ``None``, or for multi-use tickets, whose usage count must be read
+        from database at each request.
+
+        """
+        if settings.TICKETOFFICE_SESSION_SNAPSHOT_MAX_AGE is None \
+                or ticket.max_uses != 1 or not ticket.is_valid():
+            return
+        request.session[SNAPSHOT_SESSION_KEY] = make_snapshot(ticket)
+
+    def get_credentials(self, request):
+        """Return valid credentials in ``request.GET``, as a dict."""
         if request.GET:
             form = TicketAuthenticationForm(data=request.GET,
                                             place=self.place,
                                             purpose=self.purpose)
             if form.is_valid():
-                data = form.cleaned_data
-                # ticket check
-                try:
-                    ticket = Ticket.objects.get(uuid=data['uuid'],
-                                                place=self.place,
-                                                purpose=self.purpose)
-                except Ticket.DoesNotExist:
-                    data_uuid = data['uuid']
-                    raise exceptions.CredentialsError(
-                        f'No ticket with UUID="{data_uuid}" for '
-                        f'place="{self.place}" and purpose="{self.purpose}"'
-                        ' in database.')
-                # Check password.
-                if not ticket.authenticate(data['password']):
-                    raise exceptions.CredentialsError(
-                        f'Wrong password for ticket with UUID="{ticket.uuid}"')
-                return ticket
+                return form.cleaned_data
             else:
                 raise exceptions.CredentialsError('Invalid credentials.')
         else:
             raise exceptions.NoTicketError('Missing ticket.')
 
-    def validate_ticket(self):
+    def get_ticket_from_credentials(self, request):
+        """Return ticket instance from credentials in ``request.get``."""
+        data = self.get_credentials(request)
+        # ticket check
+        try:
+            if not uuid_filter.might_contain(data['uuid']):
+                raise Ticket.DoesNotExist()
+            ticket = self.tickets.get_for_validation(uuid=data['uuid'],
+                                                     place=self.place,
+                                                     purpose=self.purpose)
+        except Ticket.DoesNotExist:
+            data_uuid = data['uuid']
+            raise exceptions.CredentialsError(
+                f'No ticket with UUID="{data_uuid}" for '
+                f'place="{self.place}" and purpose="{self.purpose}"'
+                ' in database.')
+        # Check password.
+        if not ticket.authenticate(data['password']):
+            raise exceptions.CredentialsError(
+                f'Wrong password for ticket with UUID="{ticket.uuid}"')
+        return ticket
+
+    async def aget_ticket_from_credentials(self, request):
+        """Asynchronous :meth:`get_ticket_from_credentials`.
+
+        Password is verified in a thread pool, see
+        :meth:`~django_ticketoffice.models.Ticket.aauthenticate`.
+
+        """
+        data = self.get_credentials(request)
+        # ticket check
+        try:
+            if uuid_filter.enabled:
+                # Filter may query the database when it needs an update.
+                known = await sync_to_async(uuid_filter.might_contain)(
+                    data['uuid'])
+                if not known:
+                    raise Ticket.DoesNotExist()
+            ticket = await self.tickets.aget_for_validation(
+                uuid=data['uuid'],
+                place=self.place,
+                purpose=self.purpose)
+        except Ticket.DoesNotExist:
+            data_uuid = data['uuid']
+            raise exceptions.CredentialsError(
+                f'No ticket with UUID="{data_uuid}" for '
+                f'place="{self.place}" and purpose="{self.purpose}"'
+                ' in database.')
+        # Check password.
+        if not await ticket.aauthenticate(data['password']):
+            raise exceptions.CredentialsError(
+                f'Wrong password for ticket with UUID="{ticket.uuid}"')
+        return ticket
+
+    def validate_ticket(self, ticket):
         # Check usage.
-        if self.ticket.used:
+        if ticket.used:
             raise exceptions.TicketUsedError(
-                f'Ticket with UUID="{self.ticket.uuid}" was used '
-                f'at {self.ticket.usage_datetime}')
+                f'Ticket with UUID="{ticket.uuid}" was used '
+                f'at {ticket.usage_datetime}')
         # Check expiry.
-        if self.ticket.expired:
+        if ticket.expired:
             raise exceptions.TicketExpiredError(
-                f'Ticket with UUID="{self.ticket.uuid}" expired '
-                f'at {self.ticket.expiry_datetime}')
+                f'Ticket with UUID="{ticket.uuid}" expired '
+                f'at {ticket.expiry_datetime}')
 
     def unauthorized(self, request, *args, **kwargs):
         """Return response when credentials are missing (no invitation)."""
@@ -158,32 +398,86 @@ class invitation_required(Decorator):
         credentials)."""
         return forbidden_view(request)
 
-    def redirect(self, request):
+    def redirect(self, request, ticket):
         """Redirect to same URL once invitation has been stored in session."""
         # Cache the invitation instance in session.
-        request.session['invitation'] = str(self.ticket.uuid)
+        request.session['invitation'] = str(ticket.uuid)
+        self.store_snapshot(request, ticket)
         return HttpResponseRedirect(request.path)
 
-    def login(self, request, *args, **kwargs):
+    def login(self, request, ticket):
         """Log the user in when ticket is valid."""
-        return guest_login(request, self.ticket)
+        return guest_login(request, ticket)
 
     def valid(self, request, *args, **kwargs):
-        """Return response when ticket is valid."""
-        self.login(request, *args, **kwargs)
+        """Return response when ticket is valid and user logged in."""
         return Decorator.run(self, request, *args, **kwargs)
 
 
-def stamp_invitation(view_func):
-    @wraps(view_func)
-    def _wrapped_view(request, *args, **kwargs):
-        # Execute view function.
-        response = view_func(request, *args, **kwargs)
-        # Stamp ticket if available.
+def stamp_invitation(view_func=None, *, atomic=False):
+    """Mark invitation as used right after view execution.
+
+    If another request used the ticket in the meantime, the `forbidden` view
+    is returned.
+
+    With ``atomic=True``, i.e. ``@stamp_invitation(atomic=True)``, view
+    execution and ticket consumption happen in the same transaction, on the
+    ticket's database: if the ticket was used in the meantime, changes made
+    by the view on that database are rolled back. With sharding or
+    replicas, that database is the ticket's shard or the primary database,
+    not necessarily the one of view's changes.
+
+    Coroutine views are supported too, but not with ``atomic=True``:
+    transactions cannot span asynchronous views, so view's changes are never
+    rolled back.
+
+    """
+    if view_func is None:
+        return partial(stamp_invitation, atomic=atomic)
+
+    if asyncio.iscoroutinefunction(view_func):
+        if atomic:
+            raise ValueError('atomic=True is not supported on coroutine '
+                             'views.')
+
+        @wraps(view_func)
+        async def _wrapped_async_view(request, *args, **kwargs):
+            # Execute view function.
+            response = await view_func(request, *args, **kwargs)
+            # Stamp ticket if available.
+            try:
+                invitation = request.invitation
+            except AttributeError:
+                raise  # Invitation not request! Missing @invitation_required?
+            if await invitation.aconsume():
+                request.session.pop(SNAPSHOT_SESSION_KEY, None)
+                return response
+            return forbidden_view(request)
+        return _wrapped_async_view
+
+    def stamp(request):
+        """Use ticket of ``request``, return True on success."""
         try:
             invitation = request.invitation
         except AttributeError:
             raise  # Invitation not request! Missing @invitation_required?
-        invitation.use()
-        return response
+        if invitation.consume():
+            request.session.pop(SNAPSHOT_SESSION_KEY, None)
+            return True
+        # Ticket was used by another request, or expired meanwhile.
+        return False
+
+    @wraps(view_func)
+    def _wrapped_view(request, *args, **kwargs):
+        if not atomic:
+            # Execute view function.
+            response = view_func(request, *args, **kwargs)
+            return response if stamp(request) else forbidden_view(request)
+        using = request.invitation._usage_database()
+        with transaction.atomic(using=using):
+            response = view_func(request, *args, **kwargs)
+            if stamp(request):
+                return response
+            transaction.set_rollback(True, using=using)
+        return forbidden_view(request)
     return _wrapped_view
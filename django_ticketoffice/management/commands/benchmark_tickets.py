@@ -0,0 +1,81 @@
+import json
+import platform
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import setup_databases, teardown_databases
+
+from django_ticketoffice.benchmarks import BENCHMARKS, DATABASE_BENCHMARKS
+
+
+def parse_sizes(value):
+    """Return list of table sizes from comma-separated ``value``."""
+    try:
+        return [int(size) for size in value.split(',')]
+    except ValueError:
+        raise CommandError(f'Invalid sizes: {value}')
+
+
+class Command(BaseCommand):
+
+    help = """Run performance benchmarks. Benchmarks writing to the
+    database run against a test database, created then destroyed."""
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'benchmarks', nargs='*', metavar='benchmark',
+            help=f'Benchmarks to run, among {", ".join(sorted(BENCHMARKS))}.'
+                 ' Default is all.')
+        parser.add_argument(
+            '--sizes', type=parse_sizes, default=[1000, 10000, 100000,
+                                                  1000000],
+            help='Comma-separated numbers of tickets in table, for database '
+                 'benchmarks. Default is 1000,10000,100000,1000000.')
+        parser.add_argument(
+            '--format', choices=('text', 'json'), default='text',
+            help='Output format. Default is "text".')
+
+    def handle(self, *args, **options):
+        names = options['benchmarks'] or sorted(BENCHMARKS)
+        unknown = set(names) - set(BENCHMARKS)
+        if unknown:
+            raise CommandError(
+                f'Unknown benchmarks: {", ".join(sorted(unknown))}')
+        old_config = None
+        if DATABASE_BENCHMARKS.intersection(names):
+            old_config = setup_databases(verbosity=0, interactive=False,
+                                         aliases={'default'})
+        try:
+            results = []
+            for name in names:
+                if name in DATABASE_BENCHMARKS:
+                    sizes = options['sizes']
+                else:
+                    sizes = [None]
+                for size in sizes:
+                    args = () if size is None else (size,)
+                    for label, seconds in BENCHMARKS[name](*args).items():
+                        result = {'benchmark': name, 'size': size,
+                                  'label': label, 'seconds': seconds}
+                        results.append(result)
+                        if options['format'] == 'text':
+                            self.write_text(result)
+        finally:
+            if old_config is not None:
+                teardown_databases(old_config, verbosity=0)
+        if options['format'] == 'json':
+            self.stdout.write(json.dumps({
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'database': connection.vendor,
+                'results': results,
+            }, indent=2))
+
+    def write_text(self, result):
+        """Write one benchmark result as text."""
+        name = result['benchmark']
+        if result['size'] is not None:
+            name = f'{name} ({result["size"]} tickets)'
+        self.stdout.write(
+            f'{name}: {result["label"]}: {result["seconds"] * 1e6:.1f} µs')
@@ -1,12 +1,94 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 from django.core.management.base import BaseCommand
-from django.utils import timezone
+from django.db import connections
 
 from django_ticketoffice.models import Ticket
+from django_ticketoffice.sharding import get_shards
 
 
 class Command(BaseCommand):
 
-    help = """Clean out expired tickets."""
+    help = """Clean out expired tickets. With sharding, shards are cleaned
+    in parallel."""
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help='Number of tickets deleted per statement. Default is 1000.')
+        parser.add_argument(
+            '--sleep', type=float, default=0,
+            help='Seconds to wait between batches, to let replicas catch '
+                 'up. Default is 0.')
+        parser.add_argument(
+            '--max-runtime', type=float, default=None,
+            help='Stop after this number of seconds. Remaining tickets are '
+                 'deleted by next run.')
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='Only count expired tickets.')
 
     def handle(self, *args, **options):
-        Ticket.objects.filter(expiry_datetime__lt=timezone.now()).delete()
+        shards = get_shards()
+        if options['dry_run']:
+            count = sum(self.get_queryset(shard).count()
+                        for shard in shards or [None])
+            self.stdout.write(f'{count} expired tickets would be deleted.')
+            return
+        start = time.monotonic()
+        if len(shards) > 1:
+            with ThreadPoolExecutor(max_workers=len(shards)) as executor:
+                total = sum(executor.map(
+                    lambda shard: self.clean_shard(shard, start, options),
+                    shards))
+        else:
+            total = self.clean(shards[0] if shards else None, start,
+                               options)
+        elapsed = time.monotonic() - start
+        # Quiet by default, e.g. in cron jobs.
+        if options['verbosity'] >= 2:
+            self.stdout.write(
+                f'Deleted {total} expired tickets in {elapsed:.1f}s '
+                f'({self.rate(total, elapsed)}).')
+
+    def get_queryset(self, shard):
+        """Return expired tickets of ``shard``, or routed if None."""
+        queryset = Ticket.objects.expired()
+        if shard is not None:
+            queryset = queryset.using(shard)
+        return queryset
+
+    def clean_shard(self, shard, start, options):
+        """Clean ``shard`` in a worker thread, return number deleted."""
+        try:
+            return self.clean(shard, start, options)
+        finally:
+            # Worker threads have their own connections.
+            connections[shard].close()
+
+    def clean(self, shard, start, options):
+        """Delete expired tickets of ``shard``, return number deleted."""
+        verbosity = options['verbosity']
+        max_runtime = options['max_runtime']
+        prefix = '' if shard is None else f'{shard}: '
+        queryset = self.get_queryset(shard)
+        total = 0
+        for deleted in queryset.delete_in_batches(options['batch_size']):
+            total += deleted
+            elapsed = time.monotonic() - start
+            if verbosity >= 3:
+                self.stdout.write(
+                    f'{prefix}Deleted {total} tickets '
+                    f'({self.rate(total, elapsed)})')
+            if max_runtime is not None and elapsed >= max_runtime:
+                if verbosity >= 1:
+                    self.stdout.write(f'{prefix}Stopped after max runtime.')
+                break
+            if options['sleep']:
+                time.sleep(options['sleep'])
+        return total
+
+    def rate(self, count, seconds):
+        """Return throughput as text."""
+        return f'{count / seconds if seconds else 0:.0f} tickets/s'
@@ -0,0 +1,151 @@
+import csv
+import gzip
+from datetime import datetime, time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import router, transaction
+from django.utils.dateparse import parse_date, parse_datetime
+from django.utils.timezone import is_naive, make_aware, make_naive
+
+from django_ticketoffice.metrics import CLEANED, metrics
+from django_ticketoffice.models import Ticket
+from django_ticketoffice.sharding import get_shard, get_shards
+
+
+def parse_timestamp(value):
+    """Return datetime from ISO 8601 date or datetime ``value``.
+
+    Datetime is aware if ``settings.USE_TZ`` is True, naive otherwise.
+
+    """
+    try:
+        timestamp = parse_datetime(value)
+        if timestamp is None:
+            date = parse_date(value)
+            if date is not None:
+                timestamp = datetime.combine(date, time())
+    except ValueError:
+        timestamp = None
+    if timestamp is None:
+        raise CommandError(f'Invalid date: {value}')
+    if settings.USE_TZ and is_naive(timestamp):
+        timestamp = make_aware(timestamp)
+    elif not settings.USE_TZ and not is_naive(timestamp):
+        timestamp = make_naive(timestamp)
+    return timestamp
+
+
+class Command(BaseCommand):
+
+    help = """Export tickets to JSON lines or CSV, gzipped if output path
+    ends with ".gz"."""
+
+    #: Exported fields. Passwords are not exported.
+    fields = ('id', 'uuid', 'place', 'purpose', 'data', 'creation_datetime',
+              'expiry_datetime', 'usage_datetime')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'output',
+            help='Path of output file. Compressed with gzip if it ends with '
+                 '".gz".')
+        parser.add_argument(
+            '--format', choices=('jsonl', 'csv'), default='jsonl',
+            help='Output format. Default is "jsonl".')
+        parser.add_argument('--place', help='Only export tickets for place.')
+        parser.add_argument('--purpose',
+                            help='Only export tickets for purpose.')
+        parser.add_argument(
+            '--status', choices=('active', 'used', 'expired'),
+            help='Only export tickets with status.')
+        parser.add_argument(
+            '--created-after', type=parse_timestamp,
+            help='Only export tickets created at or after date.')
+        parser.add_argument(
+            '--created-before', type=parse_timestamp,
+            help='Only export tickets created before date.')
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help='Number of tickets per batch. Default is 1000.')
+        parser.add_argument(
+            '--then-delete', action='store_true',
+            help='Delete exported tickets. Each batch is written to output, '
+                 'then deleted in the same transaction.')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        then_delete = options['then_delete']
+        path = options['output']
+        opener = gzip.open if path.endswith('.gz') else open
+        total = 0
+        with opener(path, 'wt', newline='') as output:
+            write = self.get_writer(output, options['format'])
+            for database in self.get_databases(options):
+                if database is None and then_delete:
+                    # Tickets are locked and deleted on primary database.
+                    database = router.db_for_write(Ticket)
+                queryset = self.get_queryset(options, database)
+                for pks in queryset.pk_batches(batch_size):
+                    with transaction.atomic(using=database):
+                        batch = queryset.filter(pk__in=pks).order_by('pk')
+                        if then_delete:
+                            batch = batch.select_for_update()
+                        exported = []
+                        rows = batch.values(*self.fields)
+                        for row in rows.iterator(chunk_size=batch_size):
+                            write(row)
+                            exported.append(row['id'])
+                        # Archive is written before tickets are deleted.
+                        output.flush()
+                        if then_delete:
+                            deleted, _ = Ticket.objects.using(database) \
+                                .filter(pk__in=exported).delete()
+                            metrics.increment(CLEANED, deleted)
+                    total += len(exported)
+        if options['verbosity'] >= 1:
+            action = 'Exported and deleted' if then_delete else 'Exported'
+            self.stdout.write(f'{action} {total} tickets to {path}.')
+
+    def get_databases(self, options):
+        """Return shards holding tickets to export, in turn.
+
+        Without sharding, return ``[None]``: database is routers' choice.
+
+        """
+        shard = get_shard(place=options['place'])
+        if shard is not None:
+            return [shard]
+        return get_shards() or [None]
+
+    def get_queryset(self, options, database=None):
+        """Return tickets of ``database`` matching filters in ``options``."""
+        queryset = Ticket.objects.using(database)
+        if options['place'] is not None:
+            queryset = queryset.filter(place=options['place'])
+        if options['purpose'] is not None:
+            queryset = queryset.filter(purpose=options['purpose'])
+        if options['status'] is not None:
+            queryset = getattr(queryset, options['status'])()
+        if options['created_after'] is not None:
+            queryset = queryset.filter(
+                creation_datetime__gte=options['created_after'])
+        if options['created_before'] is not None:
+            queryset = queryset.filter(
+                creation_datetime__lt=options['created_before'])
+        return queryset
+
+    def get_writer(self, output, format):
+        """Return function that writes a ticket's values to ``output``."""
+        encoder = DjangoJSONEncoder()
+        if format == 'jsonl':
+            def write(row):
+                output.write(encoder.encode(row) + '\n')
+        else:
+            writer = csv.DictWriter(output, fieldnames=self.fields)
+            writer.writeheader()
+
+            def write(row):
+                writer.writerow(dict(row, data=encoder.encode(row['data'])))
+        return write
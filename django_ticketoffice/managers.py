@@ -1,24 +1,443 @@
 """Managers for models."""
-from django.db.models import Manager
+import asyncio
+import contextvars
+import os
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice, repeat
+from uuid import UUID, uuid4
+
+from asgiref.sync import sync_to_async
+from django.db import router
+from django.db.models import (Case, DateTimeField, F, Manager, Q, QuerySet,
+                              Value, When)
 from django.core.exceptions import ValidationError
+from django.utils.timezone import now
+
+from django_ticketoffice import exceptions, settings
+from django_ticketoffice.bloom import uuid_filter
+from django_ticketoffice.cache import ticket_cache
+from django_ticketoffice.compat import abulk_create, acreate, aget, aupdate
+from django_ticketoffice.metrics import (AUTHENTICATIONS, CLEANED,
+                                         CLEANUP_BATCH_SECONDS,
+                                         LOOKUP_SECONDS, metrics)
+from django_ticketoffice.sharding import get_shard, get_shards
+from django_ticketoffice.utils import get_executor
+
+
+class TicketQuerySet(QuerySet):
+    #: Fields required to validate tickets. Others, such as ``data``, are
+    #: loaded on first access.
+    validation_fields = ('uuid', 'password', 'place', 'purpose',
+                         'expiry_datetime', 'usage_datetime', 'max_uses',
+                         'use_count')
+
+    def for_validation(self):
+        """Return queryset that only loads :attr:`validation_fields`."""
+        return self.only(*self.validation_fields)
+
+    def active(self, timestamp=None):
+        """Return tickets neither used nor expired at ``timestamp``.
+
+        Default ``timestamp`` is now.
+
+        """
+        if timestamp is None:
+            timestamp = now()
+        return self.filter(usage_datetime__isnull=True) \
+            .filter(Q(expiry_datetime__isnull=True)
+                    | Q(expiry_datetime__gt=timestamp))
+
+    def used(self):
+        """Return used tickets."""
+        return self.filter(usage_datetime__isnull=False)
+
+    def expired(self, timestamp=None):
+        """Return tickets expired at ``timestamp``. Default is now."""
+        if timestamp is None:
+            timestamp = now()
+        return self.filter(expiry_datetime__lt=timestamp)
+
+    def pk_batches(self, batch_size=1000):
+        """Yield lists of at most ``batch_size`` primary keys, in order.
+
+        Uses keyset pagination (``WHERE pk > last ORDER BY pk LIMIT n``), so
+        that each query is cheap whatever the size of the table, and rows
+        changed between batches are neither skipped nor repeated.
+
+        """
+        queryset = self.order_by('pk').values_list('pk', flat=True)
+        last_pk = None
+        while True:
+            if last_pk is not None:
+                queryset = queryset.filter(pk__gt=last_pk)
+            pks = list(queryset[:batch_size])
+            if not pks:
+                return
+            yield pks
+            last_pk = pks[-1]
+
+    def delete_in_batches(self, batch_size=1000):
+        """Delete tickets by batches, yield number deleted per batch.
+
+        Each batch is a short ``DELETE ... WHERE pk IN (...)`` statement,
+        which is run while the generator is consumed. Unless ``pre_delete``
+        or ``post_delete`` signals have receivers for tickets, Django deletes
+        rows without loading them.
+
+        """
+        for pks in self.pk_batches(batch_size):
+            with metrics.timer(CLEANUP_BATCH_SECONDS):
+                deleted, _ = self.filter(pk__in=pks).order_by().delete()
+            metrics.increment(CLEANED, deleted)
+            yield deleted
+
+    def for_shard(self, place=None, uuid=None):
+        """Return queryset on shard of ``place`` or ``uuid``.
+
+        Queryset is unchanged if sharding is disabled, if the shard is
+        unknown, or if its database is explicit, see ``using()``.
+
+        """
+        if self._db is None:
+            shard = get_shard(place, uuid)
+            if shard is not None:
+                return self.using(shard)
+        return self
+
+    def validation_databases(self, place=None, uuid=None):
+        """Return aliases of databases where to look tickets up, in order.
+
+        With sharding, it is the shard of ``place`` or ``uuid``, or all
+        shards if unknown.
+
+        Else, first is the database of reads, e.g. a replica picked by
+        :class:`~django_ticketoffice.routers.TicketRouter`. If it is not the
+        primary database and ``settings.TICKETOFFICE_REPLICA_FALLBACK`` is
+        True, the primary database follows, for tickets not replicated yet.
+
+        Querysets with an explicit database, see ``using()``, only read
+        from it.
+
+        """
+        if self._db is not None:
+            return [self._db]
+        shards = get_shards()
+        if shards:
+            shard = get_shard(place, uuid)
+            return shards if shard is None else [shard]
+        read = router.db_for_read(self.model, **self._hints)
+        if not settings.TICKETOFFICE_REPLICA_FALLBACK:
+            return [read]
+        primary = router.db_for_write(self.model, read_fallback=True,
+                                      **self._hints)
+        return [read] if primary == read else [read, primary]
+
+    def update_in_batches(self, batch_size=1000, **kwargs):
+        """Update tickets with ``kwargs`` by batches, return number updated.
+
+        Each batch is a short ``UPDATE ... WHERE pk IN (...)`` statement, on
+        the primary database, or on each shard. Cached tickets are removed
+        from cache.
+
+        """
+        updated = 0
+        for queryset in self._write_querysets():
+            for pks in queryset.pk_batches(batch_size):
+                batch = queryset.filter(pk__in=pks)
+                uuids = []
+                if ticket_cache.enabled:
+                    uuids = list(batch.values_list('uuid', flat=True))
+                updated += batch.update(**kwargs)
+                ticket_cache.invalidate(uuids, using=queryset.db)
+        return updated
+
+    def db_for_write(self):
+        """Return alias of database where ``update()`` writes."""
+        if self._db is not None:
+            return self._db
+        return router.db_for_write(self.model, **self._hints)
+
+    def _write_querysets(self):
+        """Return querysets on databases where tickets are written."""
+        if self._db is not None:
+            return [self]
+        shards = get_shards()
+        if shards:
+            return [self.using(shard) for shard in shards]
+        return [self.using(router.db_for_write(self.model))]
+
+    def revoke(self, timestamp=None, batch_size=1000):
+        """Mark unused tickets as used at ``timestamp``, return count.
+
+        Default ``timestamp`` is now. Revoked tickets fail validation with
+        :class:`~django_ticketoffice.exceptions.TicketUsedError`. Signed
+        tokens are not checked against usage: revoke them with
+        :func:`django_ticketoffice.tokens.revoke`.
+
+        """
+        if timestamp is None:
+            timestamp = now()
+        return self.filter(usage_datetime__isnull=True) \
+            .update_in_batches(batch_size, usage_datetime=timestamp)
+
+    def expire_now(self, timestamp=None, batch_size=1000):
+        """Make tickets expire at ``timestamp``, return count.
+
+        Default ``timestamp`` is now. Tickets already expired are unchanged.
+        Expired tickets are deleted by ``clean_tickets``.
+
+        """
+        if timestamp is None:
+            timestamp = now()
+        return self.filter(Q(expiry_datetime__isnull=True)
+                           | Q(expiry_datetime__gt=timestamp)) \
+            .update_in_batches(batch_size, expiry_datetime=timestamp)
+
+    def bulk_consume(self, uuids, timestamp=None, batch_size=1000):
+        """Use active tickets of ``uuids`` once, return number used.
+
+        Like :meth:`TicketManager.consume`, without checking place and
+        purpose: filter the queryset for that.
+
+        """
+        if timestamp is None:
+            timestamp = now()
+        uuids = iter(uuids)
+        consumed = 0
+        while True:
+            batch = list(islice(uuids, batch_size))
+            if not batch:
+                return consumed
+            consumed += self.filter(uuid__in=batch).active(timestamp) \
+                .update_in_batches(batch_size, **self.usage_update(timestamp))
+
+    def usage_update(self, timestamp):
+        """Return ``update()`` arguments that use tickets once.
+
+        Increments ``use_count`` in SQL. ``usage_datetime`` is only set by the
+        last use, so that tickets stay active until then.
+
+        """
+        return {
+            'use_count': F('use_count') + 1,
+            'usage_datetime': Case(
+                When(use_count__gte=F('max_uses') - 1,
+                     then=Value(timestamp)),
+                default=None,
+                output_field=DateTimeField()),
+        }
+
+    def get_for_validation(self, **kwargs):
+        """Return ticket matching ``kwargs``, for validation.
+
+        Only :attr:`validation_fields` are loaded.
+
+        Looks for active tickets first, so that valid tickets take a single
+        query. Only if this query misses, a second one gets the ticket
+        whatever its state, so that callers can tell why it is not valid.
+
+        Tickets missing from one of :meth:`validation_databases` are looked
+        up in the next one.
+
+        """
+        queryset = self.for_validation()
+        *fallbacks, last = self.validation_databases(kwargs.get('place'),
+                                                     kwargs.get('uuid'))
+        with metrics.timer(LOOKUP_SECONDS):
+            for database in fallbacks:
+                try:
+                    return queryset.using(database).get_active_first(**kwargs)
+                except self.model.DoesNotExist:
+                    pass
+            return queryset.using(last).get_active_first(**kwargs)
 
-from django_ticketoffice import exceptions
+    async def aget_for_validation(self, **kwargs):
+        """Asynchronous :meth:`get_for_validation`."""
+        queryset = self.for_validation()
+        *fallbacks, last = self.validation_databases(kwargs.get('place'),
+                                                     kwargs.get('uuid'))
+        with metrics.timer(LOOKUP_SECONDS):
+            for database in fallbacks:
+                try:
+                    return await queryset.using(database) \
+                        .aget_active_first(**kwargs)
+                except self.model.DoesNotExist:
+                    pass
+            return await queryset.using(last).aget_active_first(**kwargs)
 
+    def in_bulk_for_validation(self, uuids, **kwargs):
+        """Return tickets with UUID in ``uuids`` matching ``kwargs``, by UUID.
 
-class TicketManager(Manager):
+        Only :attr:`validation_fields` are loaded, with one ``uuid__in``
+        query per database of :meth:`validation_databases`, for tickets
+        missing from previous ones.
 
-    def authenticate(self, uuid, clear_password, place='', purpose=''):
+        """
+        queryset = self.for_validation().filter(**kwargs)
+        missing = set(uuids)
+        tickets = {}
+        with metrics.timer(LOOKUP_SECONDS):
+            for database in self.validation_databases(kwargs.get('place')):
+                if not missing:
+                    break
+                for ticket in queryset.using(database) \
+                        .filter(uuid__in=missing):
+                    tickets[ticket.uuid] = ticket
+                missing.difference_update(tickets)
+        return tickets
+
+    def get_active_first(self, **kwargs):
+        """Return ticket matching ``kwargs``, looking up active ones first."""
         try:
-            ticket = self.get(uuid=uuid, place=place, purpose=purpose)
+            return self.active().get(**kwargs)
         except self.model.DoesNotExist:
-            raise exceptions.CredentialsError(
-                f'No ticket with UUID "{uuid}" for place "{place}" and '
-                f'purpose "{purpose}"')
-        except (ValueError, ValidationError):
-            raise exceptions.CredentialsError(
-                f'Invalid UUID format for {uuid}')
+            return self.get(**kwargs)
+
+    async def aget_active_first(self, **kwargs):
+        """Asynchronous :meth:`get_active_first`."""
+        try:
+            return await aget(self.active(), **kwargs)
+        except self.model.DoesNotExist:
+            return await aget(self, **kwargs)
+
+    def get_cached(self, uuid, place='', purpose=''):
+        """Return ticket ``uuid`` for validation, from cache if possible.
+
+        If cache misses, behaves like :meth:`get_for_validation`, then
+        caches the ticket if it is valid.
+
+        See :class:`~django_ticketoffice.cache.TicketCache`.
+
+        """
+        state = ticket_cache.get(uuid)
+        if state is not None \
+                and (state['place'], state['purpose']) == (place, purpose):
+            return self.model.from_db(self.for_shard(place, uuid).db,
+                                      list(state), list(state.values()))
+        ticket = self.get_for_validation(uuid=uuid, place=place,
+                                         purpose=purpose)
+        ticket_cache.set(ticket)
+        return ticket
+
+    async def aget_cached(self, uuid, place='', purpose=''):
+        """Asynchronous :meth:`get_cached`."""
+        if ticket_cache.enabled:
+            # Cache backends may block on network I/O.
+            return await sync_to_async(self.get_cached)(uuid, place, purpose)
+        return await self.aget_for_validation(uuid=uuid, place=place,
+                                              purpose=purpose)
+
+
+class TicketManager(Manager.from_queryset(TicketQuerySet)):
+
+    def authenticate(self, uuid, clear_password, place='', purpose='',
+                     using=None):
+        """Return valid ticket matching credentials, else raise exception.
+
+        Ticket is read from database ``using``, default is routers' choice.
+
+        """
+        with metrics.outcomes(AUTHENTICATIONS):
+            try:
+                if not uuid_filter.might_contain(uuid):
+                    raise self.model.DoesNotExist()
+                ticket = self.db_manager(using).get_for_validation(
+                    uuid=uuid, place=place, purpose=purpose)
+            except self.model.DoesNotExist:
+                raise self._not_found(uuid, place, purpose)
+            except (ValueError, ValidationError):
+                raise self._invalid_uuid(uuid)
+            return self._check(ticket, ticket.authenticate(clear_password))
+
+    async def aauthenticate(self, uuid, clear_password, place='',
+                            purpose='', using=None):
+        """Asynchronous :meth:`authenticate`.
+
+        Raises the same exceptions. Password is verified in a thread pool,
+        see :meth:`Ticket.aauthenticate()
+        <django_ticketoffice.models.Ticket.aauthenticate>`.
+
+        """
+        with metrics.outcomes(AUTHENTICATIONS):
+            try:
+                if uuid_filter.enabled:
+                    # Filter may query the database when it needs an update.
+                    known = await sync_to_async(uuid_filter.might_contain)(
+                        uuid)
+                    if not known:
+                        raise self.model.DoesNotExist()
+                ticket = await self.db_manager(using).aget_for_validation(
+                    uuid=uuid, place=place, purpose=purpose)
+            except self.model.DoesNotExist:
+                raise self._not_found(uuid, place, purpose)
+            except (ValueError, ValidationError):
+                raise self._invalid_uuid(uuid)
+            authenticated = await ticket.aauthenticate(clear_password)
+            return self._check(ticket, authenticated)
+
+    def authenticate_many(self, credentials, place='', purpose='',
+                          using=None, executor=None):
+        """Authenticate ``(uuid, clear_password)`` pairs of ``credentials``.
+
+        Return a list with, for each pair in order, the valid ticket or the
+        exception :meth:`authenticate` would raise. Nothing is raised.
+
+        Tickets are loaded at once, see
+        :meth:`TicketQuerySet.in_bulk_for_validation`. Passwords are verified
+        in parallel with ``executor``, a
+        :class:`concurrent.futures.Executor`. Default is the thread pool of
+        ``settings.TICKETOFFICE_HASHING_WORKERS`` threads.
+
+        """
+        credentials = list(credentials)
+        uuids = []
+        for uuid, clear_password in credentials:
+            try:
+                uuids.append(UUID(str(uuid)))
+            except ValueError:
+                uuids.append(None)
+        tickets = self.db_manager(using).in_bulk_for_validation(
+            [uuid for uuid in uuids
+             if uuid is not None and uuid_filter.might_contain(uuid)],
+            place=place, purpose=purpose)
+        if executor is None:
+            executor = get_executor(settings.TICKETOFFICE_HASHING_WORKERS)
+        # Run in current context, so that metrics reach its collector.
+        verifications = [
+            executor.submit(contextvars.copy_context().run,
+                            tickets[uuid].authenticate, clear_password)
+            if uuid in tickets else None
+            for uuid, (_, clear_password) in zip(uuids, credentials)
+        ]
+        results = []
+        for (raw_uuid, _), uuid, verification in zip(credentials, uuids,
+                                                     verifications):
+            try:
+                with metrics.outcomes(AUTHENTICATIONS):
+                    if uuid is None:
+                        raise self._invalid_uuid(raw_uuid)
+                    if verification is None:
+                        raise self._not_found(raw_uuid, place, purpose)
+                    results.append(
+                        self._check(tickets[uuid], verification.result()))
+            except (exceptions.CredentialsError,
+                    exceptions.TicketUsedError,
+                    exceptions.TicketExpiredError) as exception:
+                results.append(exception)
+        return results
+
+    def _not_found(self, uuid, place, purpose):
+        return exceptions.CredentialsError(
+            f'No ticket with UUID "{uuid}" for place "{place}" and '
+            f'purpose "{purpose}"')
+
+    def _invalid_uuid(self, uuid):
+        return exceptions.CredentialsError(f'Invalid UUID format for {uuid}')
+
+    def _check(self, ticket, authenticated):
+        """Return ``ticket`` if it is valid, else raise exception."""
         # Check password.
-        if not ticket.authenticate(clear_password):
+        if not authenticated:
             raise exceptions.CredentialsError(
                 f'Wrong password for UUID {ticket.uuid}')
         # Check usage.
@@ -33,3 +452,172 @@ class TicketManager(Manager):
                 f'at {ticket.expiry_datetime}')
         # Alright, return ticket.
         return ticket
+
+    def issue(self, place='', purpose='', expiry_datetime=None, data=None,
+              max_uses=1):
+        """Create ticket, return ``(ticket, clear_password)``."""
+        clear_password = self.model.get_password_generator()()
+        uuid = uuid4()
+        ticket = self.for_shard(place, uuid).create(
+            uuid=uuid,
+            place=place,
+            purpose=purpose,
+            expiry_datetime=expiry_datetime,
+            data={} if data is None else data,
+            max_uses=max_uses,
+            password=self.model.hash_password(clear_password))
+        return ticket, clear_password
+
+    async def aissue(self, place='', purpose='', expiry_datetime=None,
+                     data=None, max_uses=1):
+        """Asynchronous :meth:`issue`.
+
+        Password is hashed in a thread pool of
+        ``settings.TICKETOFFICE_HASHING_WORKERS`` threads.
+
+        """
+        clear_password = self.model.get_password_generator()()
+        loop = asyncio.get_running_loop()
+        password = await loop.run_in_executor(
+            get_executor(settings.TICKETOFFICE_HASHING_WORKERS),
+            self.model.hash_password, clear_password)
+        uuid = uuid4()
+        ticket = await acreate(self.for_shard(place, uuid),
+                               uuid=uuid,
+                               place=place,
+                               purpose=purpose,
+                               expiry_datetime=expiry_datetime,
+                               data={} if data is None else data,
+                               max_uses=max_uses,
+                               password=password)
+        return ticket, clear_password
+
+    def consume(self, uuid, place='', purpose='', timestamp=None):
+        """Use valid ticket once; return True if this call used it.
+
+        Runs a single conditional ``UPDATE``, which only matches tickets
+        neither used nor expired. So, when concurrent calls try to use the
+        same ticket, only as many of them as remaining uses return True.
+
+        """
+        if timestamp is None:
+            timestamp = now()
+        queryset = self.for_shard(place, uuid)
+        updated = queryset.filter(uuid=uuid, place=place, purpose=purpose) \
+            .active(timestamp) \
+            .update(**self.usage_update(timestamp))
+        ticket_cache.invalidate([uuid], using=queryset.db_for_write())
+        return updated == 1
+
+    async def aconsume(self, uuid, place='', purpose='', timestamp=None):
+        """Asynchronous :meth:`consume`."""
+        if timestamp is None:
+            timestamp = now()
+        queryset = self.for_shard(place, uuid) \
+            .filter(uuid=uuid, place=place, purpose=purpose) \
+            .active(timestamp)
+        updated = await aupdate(queryset, **self.usage_update(timestamp))
+        if ticket_cache.enabled:
+            await sync_to_async(ticket_cache.invalidate)(
+                [uuid], using=queryset.db_for_write())
+        return updated == 1
+
+    def bulk_issue(self, tickets, place='', purpose='', expiry_datetime=None,
+                   batch_size=1000, executor=None, max_uses=1):
+        """Create tickets in batches, yield ``(uuid, clear_password)`` pairs.
+
+        ``tickets`` is either the number of tickets to create, or an iterable
+        of ``data`` for each ticket.
+
+        Tickets are created ``batch_size`` at a time, while the generator is
+        consumed, so memory usage does not depend on the number of tickets.
+
+        Passwords are hashed in parallel with ``executor``, a
+        :class:`concurrent.futures.Executor`. Default is a thread pool, which
+        runs in parallel since hashers (PBKDF2, bcrypt, Argon2) release the
+        GIL. A :class:`~concurrent.futures.ProcessPoolExecutor` works too.
+
+        """
+        if isinstance(tickets, int):
+            tickets = repeat(None, tickets)
+        tickets = iter(tickets)
+        own_executor = executor is None
+        if own_executor:
+            executor = ThreadPoolExecutor(max_workers=os.cpu_count())
+        try:
+            while True:
+                batch = list(islice(tickets, batch_size))
+                if not batch:
+                    break
+                clear_passwords = self.model.generate_passwords(len(batch))
+                passwords = executor.map(self.model.hash_password,
+                                         clear_passwords)
+                instances = [
+                    self.model(place=place,
+                               purpose=purpose,
+                               expiry_datetime=expiry_datetime,
+                               data={} if data is None else data,
+                               max_uses=max_uses,
+                               password=password)
+                    for data, password in zip(batch, passwords)
+                ]
+                for queryset, group in self._shard_groups(instances):
+                    queryset.bulk_create(group, batch_size=batch_size)
+                for instance in instances:
+                    uuid_filter.add(instance.uuid)
+                for instance, clear_password in zip(instances,
+                                                    clear_passwords):
+                    yield instance.uuid, clear_password
+        finally:
+            if own_executor:
+                executor.shutdown()
+
+    async def abulk_issue(self, tickets, place='', purpose='',
+                          expiry_datetime=None, batch_size=1000,
+                          executor=None, max_uses=1):
+        """Asynchronous :meth:`bulk_issue`, an asynchronous generator.
+
+        Default ``executor`` is the thread pool of
+        ``settings.TICKETOFFICE_HASHING_WORKERS`` threads.
+
+        """
+        if isinstance(tickets, int):
+            tickets = repeat(None, tickets)
+        tickets = iter(tickets)
+        if executor is None:
+            executor = get_executor(settings.TICKETOFFICE_HASHING_WORKERS)
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = list(islice(tickets, batch_size))
+            if not batch:
+                break
+            clear_passwords = self.model.generate_passwords(len(batch))
+            passwords = await asyncio.gather(*[
+                loop.run_in_executor(executor, self.model.hash_password,
+                                     clear_password)
+                for clear_password in clear_passwords
+            ])
+            instances = [
+                self.model(place=place,
+                           purpose=purpose,
+                           expiry_datetime=expiry_datetime,
+                           data={} if data is None else data,
+                           max_uses=max_uses,
+                           password=password)
+                for data, password in zip(batch, passwords)
+            ]
+            for queryset, group in self._shard_groups(instances):
+                await abulk_create(queryset, group, batch_size=batch_size)
+            for instance in instances:
+                uuid_filter.add(instance.uuid)
+            for instance, clear_password in zip(instances, clear_passwords):
+                yield instance.uuid, clear_password
+
+    def _shard_groups(self, instances):
+        """Return ``(queryset, instances)`` pairs, grouped by shard."""
+        groups = {}
+        for instance in instances:
+            queryset = self.for_shard(instance.place, instance.uuid)
+            groups.setdefault(queryset._db, (queryset, []))[1] \
+                .append(instance)
+        return list(groups.values())
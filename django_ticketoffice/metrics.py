@@ -0,0 +1,220 @@
+"""Metrics: counters and histograms about tickets.
+
+Metrics are sent to the backend at import path
+``settings.TICKETOFFICE_METRICS``, a class with methods ``increment(name,
+value, labels)`` and ``observe(name, value, labels)``. :class:`Registry`
+keeps metrics in process, and renders them in Prometheus text format. When
+``settings.TICKETOFFICE_METRICS`` is ``None``, metrics cost a setting lookup.
+
+Metrics also go to the :data:`collector` of current context, if any, e.g.
+the per-request report of
+:class:`~django_ticketoffice.middleware.TicketQueryReportMiddleware`.
+
+"""
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from functools import lru_cache
+
+from django_ticketoffice import exceptions, settings
+from django_ticketoffice.utils import import_member
+
+
+#: Counter of ``invitation_required`` outcomes, by ``outcome``.
+INVITATIONS = 'ticketoffice_invitations_total'
+
+#: Counter of ``TicketManager.authenticate()`` outcomes, by ``outcome``.
+AUTHENTICATIONS = 'ticketoffice_authentications_total'
+
+#: Histogram of password verification time, in seconds.
+HASH_SECONDS = 'ticketoffice_hash_seconds'
+
+#: Histogram of time to load a ticket for validation, in seconds.
+LOOKUP_SECONDS = 'ticketoffice_lookup_seconds'
+
+#: Counter of tickets deleted by batches, e.g. by ``clean_tickets``.
+CLEANED = 'ticketoffice_cleaned_tickets_total'
+
+#: Histogram of time to delete a batch of tickets, in seconds.
+CLEANUP_BATCH_SECONDS = 'ticketoffice_cleanup_batch_seconds'
+
+#: Outcome label of exceptions, other outcome is "valid".
+OUTCOMES = (
+    (exceptions.NoTicketError, 'no_ticket'),
+    (exceptions.CredentialsError, 'credentials'),
+    (exceptions.TicketUsedError, 'used'),
+    (exceptions.TicketExpiredError, 'expired'),
+)
+
+
+#: Object with ``increment()`` and ``observe()`` methods, like backends, which
+#: receives metrics of current context (thread or asynchronous task).
+collector = ContextVar('django_ticketoffice.metrics.collector', default=None)
+
+
+class Registry:
+    """In-process registry of counters and histograms."""
+    #: Upper bounds of histograms' buckets, in seconds.
+    buckets = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+               0.5, 1, 2.5, 5, 10)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        """Reset all metrics."""
+        with self._lock:
+            self.counters = {}
+            self.histograms = {}
+
+    def increment(self, name, value, labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            try:
+                histogram = self.histograms[key]
+            except KeyError:
+                histogram = self.histograms[key] = {
+                    'buckets': [0] * len(self.buckets),
+                    'sum': 0,
+                    'count': 0,
+                }
+            index = bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                histogram['buckets'][index] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    def render(self):
+        """Return metrics in Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(
+                (key, dict(value, buckets=list(value['buckets'])))
+                for key, value in self.histograms.items())
+        declared = set()
+        for (name, labels), value in counters:
+            if name not in declared:
+                declared.add(name)
+                lines.append(f'# TYPE {name} counter')
+            lines.append(f'{name}{format_labels(labels)} {value}')
+        for (name, labels), histogram in histograms:
+            if name not in declared:
+                declared.add(name)
+                lines.append(f'# TYPE {name} histogram')
+            cumulative = 0
+            for bound, count in zip(self.buckets, histogram['buckets']):
+                cumulative += count
+                bucket_labels = labels + (('le', str(bound)),)
+                lines.append(
+                    f'{name}_bucket{format_labels(bucket_labels)} '
+                    f'{cumulative}')
+            bucket_labels = labels + (('le', '+Inf'),)
+            lines.append(f'{name}_bucket{format_labels(bucket_labels)} '
+                         f'{histogram["count"]}')
+            lines.append(f'{name}_sum{format_labels(labels)} '
+                         f'{histogram["sum"]}')
+            lines.append(f'{name}_count{format_labels(labels)} '
+                         f'{histogram["count"]}')
+        return ''.join(f'{line}\n' for line in lines)
+
+
+def format_labels(labels):
+    """Return Prometheus representation of ``labels`` pairs."""
+    if not labels:
+        return ''
+    pairs = ','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', r'\\')
+                                         .replace('"', r'\"')
+                                         .replace('\n', r'\n'))
+        for name, value in labels)
+    return f'{{{pairs}}}'
+
+
+@lru_cache()
+def get_backend(import_path):
+    """Return backend instance for ``import_path``, shared by threads."""
+    return import_member(import_path)()
+
+
+class Metrics:
+    """Send metrics to backend of ``settings.TICKETOFFICE_METRICS``."""
+    @property
+    def enabled(self):
+        """Whether a backend is configured."""
+        return settings.TICKETOFFICE_METRICS is not None
+
+    @property
+    def active(self):
+        """Whether metrics go to backend or to a collector."""
+        return self.enabled or collector.get() is not None
+
+    @property
+    def backend(self):
+        return get_backend(settings.TICKETOFFICE_METRICS)
+
+    def increment(self, name, value=1, **labels):
+        """Add ``value`` to counter ``name``."""
+        if self.enabled:
+            self.backend.increment(name, value, labels)
+        current = collector.get()
+        if current is not None:
+            current.increment(name, value, labels)
+
+    def observe(self, name, value, **labels):
+        """Record ``value`` in histogram ``name``."""
+        if self.enabled:
+            self.backend.observe(name, value, labels)
+        current = collector.get()
+        if current is not None:
+            current.observe(name, value, labels)
+
+    def timer(self, name, **labels):
+        """Return context manager recording its duration in ``name``."""
+        if not self.active:
+            return nullcontext()
+        return self._timer(name, labels)
+
+    @contextmanager
+    def _timer(self, name, labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def outcomes(self, name, **labels):
+        """Return context manager counting its outcome in counter ``name``.
+
+        Outcome is "valid", unless one of :data:`OUTCOMES` exceptions is
+        raised.
+
+        """
+        if not self.active:
+            return nullcontext()
+        return self._outcomes(name, labels)
+
+    @contextmanager
+    def _outcomes(self, name, labels):
+        try:
+            yield
+        except tuple(exception for exception, outcome in OUTCOMES) \
+                as exception:
+            outcome = next(outcome for exception_class, outcome in OUTCOMES
+                           if isinstance(exception, exception_class))
+            self.increment(name, outcome=outcome, **labels)
+            raise
+        else:
+            self.increment(name, outcome='valid', **labels)
+
+
+#: Metrics of the ticket office.
+metrics = Metrics()
@@ -0,0 +1,88 @@
+"""Middlewares."""
+import logging
+import time
+from collections import Counter
+from contextlib import ExitStack
+
+from django.db import connections
+
+from django_ticketoffice.metrics import HASH_SECONDS, collector
+from django_ticketoffice.models import Ticket
+
+
+logger = logging.getLogger(__name__)
+
+
+class TicketQueryReport:
+    """Count queries on tickets' table and password verifications.
+
+    Instances are both database execute wrappers and metrics collectors.
+    Queries are counted per database alias, e.g. for replicas or shards.
+
+    """
+    def __init__(self):
+        self.table = Ticket._meta.db_table
+        #: Number of queries per database alias.
+        self.queries = Counter()
+        self.query_seconds = 0
+        self.hashes = 0
+        self.hash_seconds = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        if self.table not in sql:
+            return execute(sql, params, many, context)
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries[context['connection'].alias] += 1
+            self.query_seconds += time.perf_counter() - start
+
+    def increment(self, name, value, labels):
+        pass
+
+    def observe(self, name, value, labels):
+        if name == HASH_SECONDS:
+            self.hashes += 1
+            self.hash_seconds += value
+
+    def __str__(self):
+        queries = f'queries={sum(self.queries.values())}'
+        if self.queries:
+            queries += ' ({})'.format(', '.join(
+                f'{alias}={count}'
+                for alias, count in sorted(self.queries.items())))
+        return (f'{queries}; '
+                f'query_time={self.query_seconds * 1000:.1f}ms; '
+                f'hashes={self.hashes}; '
+                f'hash_time={self.hash_seconds * 1000:.1f}ms')
+
+
+class TicketQueryReportMiddleware:
+    """Report tickets' queries and password verifications of each request.
+
+    Report is logged at DEBUG level and set in response header
+    :attr:`header`. Queries are counted on every database of
+    ``settings.DATABASES``. For debugging: do not enable in production.
+
+    """
+    #: Response header where report is set.
+    header = 'X-Ticketoffice-Report'
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        report = TicketQueryReport()
+        token = collector.set(report)
+        try:
+            with ExitStack() as stack:
+                for database in connections.all():
+                    stack.enter_context(database.execute_wrapper(report))
+                response = self.get_response(request)
+        finally:
+            collector.reset(token)
+        response[self.header] = str(report)
+        logger.debug('Tickets of %s %s: %s', request.method, request.path,
+                     report)
+        return response
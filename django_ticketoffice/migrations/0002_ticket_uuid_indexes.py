@@ -0,0 +1,31 @@
+import uuid
+
+from django.db import migrations, models
+
+from django_ticketoffice.operations import (
+    AddIndexConcurrently,
+    AlterFieldUniqueConcurrently,
+)
+
+
+class Migration(migrations.Migration):
+
+    # Indexes are built concurrently on PostgreSQL, which cannot happen
+    # inside a transaction.
+    atomic = False
+
+    dependencies = [
+        ('django_ticketoffice', '0001_initial'),
+    ]
+
+    operations = [
+        AlterFieldUniqueConcurrently(
+            model_name='ticket',
+            name='uuid',
+            field=models.UUIDField(default=uuid.uuid4, unique=True),
+        ),
+        AddIndexConcurrently(
+            model_name='ticket',
+            index=models.Index(fields=['uuid', 'place', 'purpose'], name='ticket_uuid_place_purpose_idx'),
+        ),
+    ]
@@ -0,0 +1,69 @@
+from django.db import migrations, models
+
+from django_ticketoffice.operations import (
+    AddIndexConcurrently,
+    RemoveFieldIndexConcurrently,
+    RemoveIndexConcurrently,
+)
+
+
+class Migration(migrations.Migration):
+
+    # Indexes are built concurrently on PostgreSQL, which cannot happen
+    # inside a transaction.
+    atomic = False
+
+    dependencies = [
+        ('django_ticketoffice', '0002_ticket_uuid_indexes'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='ticket',
+            index=models.Index(fields=['place', 'purpose'], name='ticket_place_purpose_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='ticket',
+            index=models.Index(condition=models.Q(usage_datetime__isnull=True), fields=['place', 'purpose', 'expiry_datetime'], name='ticket_active_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='ticket',
+            index=models.Index(condition=models.Q(expiry_datetime__isnull=False), fields=['expiry_datetime'], name='ticket_expiry_idx'),
+        ),
+        RemoveIndexConcurrently(
+            model_name='ticket',
+            name='ticket_uuid_place_purpose_idx',
+        ),
+        # Dropping db_index with AlterField would lock the table while
+        # dropping indexes: drop them concurrently, then update state.
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                RemoveFieldIndexConcurrently(model_name='ticket', name='place'),
+                RemoveFieldIndexConcurrently(model_name='ticket', name='purpose'),
+                RemoveFieldIndexConcurrently(model_name='ticket', name='expiry_datetime'),
+                RemoveFieldIndexConcurrently(model_name='ticket', name='usage_datetime'),
+            ],
+            state_operations=[
+                migrations.AlterField(
+                    model_name='ticket',
+                    name='place',
+                    field=models.CharField(blank=True, max_length=50),
+                ),
+                migrations.AlterField(
+                    model_name='ticket',
+                    name='purpose',
+                    field=models.CharField(blank=True, max_length=50),
+                ),
+                migrations.AlterField(
+                    model_name='ticket',
+                    name='expiry_datetime',
+                    field=models.DateTimeField(blank=True, default=None, null=True),
+                ),
+                migrations.AlterField(
+                    model_name='ticket',
+                    name='usage_datetime',
+                    field=models.DateTimeField(blank=True, default=None, null=True),
+                ),
+            ],
+        ),
+    ]
@@ -0,0 +1,21 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_ticketoffice', '0003_ticket_index_strategy'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ticket',
+            name='max_uses',
+            field=models.PositiveIntegerField(default=1),
+        ),
+        migrations.AddField(
+            model_name='ticket',
+            name='use_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
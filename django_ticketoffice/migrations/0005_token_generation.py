@@ -0,0 +1,26 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_ticketoffice', '0004_ticket_max_uses'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TokenGeneration',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True,
+                                        serialize=False, verbose_name='ID')),
+                ('place', models.CharField(blank=True, max_length=50)),
+                ('purpose', models.CharField(blank=True, max_length=50)),
+                ('generation', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='tokengeneration',
+            constraint=models.UniqueConstraint(
+                fields=('place', 'purpose'), name='token_generation_unique'),
+        ),
+    ]
@@ -1,32 +1,46 @@
 """Models."""
+import asyncio
+import contextvars
+import json
 from functools import partial
 from uuid import uuid4
 
-from django.db import models
+from asgiref.sync import sync_to_async
+from django.db import models, router
 from django.utils.timezone import now
 from django.contrib.auth import hashers
 from django.contrib.auth.models import AnonymousUser
+from django.utils.functional import cached_property
 
+from django_ticketoffice.bloom import uuid_filter
+from django_ticketoffice.cache import ticket_cache
 from django_ticketoffice.compat import JSONField
 from django_ticketoffice.managers import TicketManager
+from django_ticketoffice.metrics import HASH_SECONDS, metrics
+from django_ticketoffice.sharding import get_shard
 from django_ticketoffice import settings
-from django_ticketoffice.utils import import_member
+from django_ticketoffice.utils import (get_executor, import_generator,
+                                       import_hasher)
 
 
 class Ticket(models.Model):
-    """Tickets are generic one-shot credentials."""
+    """Tickets are generic one-shot credentials.
+
+    Tickets may be used several times, up to :attr:`max_uses`.
+
+    """
     #: Unique identifier for the ticket.
-    uuid = models.UUIDField(default=uuid4)
+    uuid = models.UUIDField(default=uuid4, unique=True)
 
     #: Encrypted password for the ticket.
     password = models.CharField(max_length=255,
                                 default=partial(hashers.make_password, None))
 
     #: Location where the ticket is to be used.
-    place = models.CharField(max_length=50, blank=True, db_index=True)
+    place = models.CharField(max_length=50, blank=True)
 
     #: Purpose of the ticket, i.e. what does the invitation grant access to.
-    purpose = models.CharField(max_length=50, blank=True, db_index=True)
+    purpose = models.CharField(max_length=50, blank=True)
 
     #: Data relative to the ticket.
     #: Serialized as JSON.
@@ -40,24 +54,100 @@ class Ticket(models.Model):
     #: ``None`` means no deadline.
     expiry_datetime = models.DateTimeField(null=True,
                                            blank=True,
-                                           db_index=True,
                                            default=None)
 
     #: Date and time when the ticket was used, None if not used.
+    #: For multi-use tickets, date and time of the last use.
     usage_datetime = models.DateTimeField(null=True,
                                           blank=True,
-                                          db_index=True,
                                           default=None)
 
+    #: Number of times the ticket can be used.
+    max_uses = models.PositiveIntegerField(default=1)
+
+    #: Number of times the ticket was consumed.
+    use_count = models.PositiveIntegerField(default=0)
+
+    #: Fields changed when ticket is consumed, with :attr:`max_uses`.
+    usage_fields = ('max_uses', 'use_count', 'usage_datetime')
+
     objects = TicketManager()
 
+    class Meta:
+        # Lookups by credentials use the unique index on uuid.
+        indexes = [
+            # Tickets by place and purpose.
+            models.Index(fields=['place', 'purpose'],
+                         name='ticket_place_purpose_idx'),
+            # Active tickets by place and purpose, e.g. to revoke them.
+            models.Index(fields=['place', 'purpose', 'expiry_datetime'],
+                         condition=models.Q(usage_datetime__isnull=True),
+                         name='ticket_active_idx'),
+            # Expired tickets, for clean_tickets. Tickets without deadline
+            # are left out.
+            models.Index(fields=['expiry_datetime'],
+                         condition=models.Q(expiry_datetime__isnull=False),
+                         name='ticket_expiry_idx'),
+        ]
+
+    def save(self, *args, **kwargs):
+        created = self._state.adding
+        super().save(*args, **kwargs)
+        if created:
+            uuid_filter.add(self.uuid)
+
+    @classmethod
+    def get_password_hasher(cls):
+        """Return password hasher for tickets, ``None`` for Django's default.
+
+        Uses ``settings.TICKETOFFICE_PASSWORD_HASHER``.
+
+        """
+        if settings.TICKETOFFICE_PASSWORD_HASHER is None:
+            return None
+        return import_hasher(settings.TICKETOFFICE_PASSWORD_HASHER)
+
+    @classmethod
+    def hash_password(cls, clear_password):
+        """Return encrypted value of ``clear_password``."""
+        return hashers.make_password(
+            clear_password,
+            hasher=cls.get_password_hasher() or 'default')
+
+    @classmethod
+    def get_password_generator(cls):
+        """Return callable that generates a clear password.
+
+        Uses ``settings.TICKETOFFICE_PASSWORD_GENERATOR``.
+
+        """
+        import_path, args, kwargs = settings.TICKETOFFICE_PASSWORD_GENERATOR
+        generator = import_generator(import_path)
+        return partial(generator, *args, **kwargs)
+
+    @classmethod
+    def generate_passwords(cls, count):
+        """Return list of ``count`` clear passwords.
+
+        Uses ``many`` attribute of generator if any, such as
+        :func:`~django_ticketoffice.utils.random_passwords` for
+        :func:`~django_ticketoffice.utils.random_password`, which generates
+        them at once.
+
+        """
+        generator = cls.get_password_generator()
+        many = getattr(generator.func, 'many', None)
+        if many is None:
+            return [generator() for i in range(count)]
+        return many(count, *generator.args, **generator.keywords)
+
     def set_password(self, clear_password):
         """Encrypt and set password.
 
         Does not save the instance.
 
         """
-        self.password = hashers.make_password(clear_password)
+        self.password = self.hash_password(clear_password)
 
     def generate_password(self):
         """Generate password, set :py:attr:`password` and return clear value.
@@ -67,15 +157,33 @@ class Ticket(models.Model):
         Does not save the instance.
 
         """
-        import_path, args, kwargs = settings.TICKETOFFICE_PASSWORD_GENERATOR
-        generator = import_member(import_path)
-        clear_password = generator(*args, **kwargs)
+        clear_password = self.get_password_generator()()
         self.set_password(clear_password)
         return clear_password
 
     def authenticate(self, clear_password):
         """Return `True` if encrypted password matches `clear_password`."""
-        return hashers.check_password(clear_password, self.password)
+        hasher = self.get_password_hasher()
+        with metrics.timer(HASH_SECONDS):
+            if hasher is not None \
+                    and self.password.startswith(f'{hasher.algorithm}$'):
+                return hasher.verify(clear_password, self.password)
+            return hashers.check_password(clear_password, self.password)
+
+    async def aauthenticate(self, clear_password):
+        """Asynchronous :meth:`authenticate`.
+
+        Password is verified in a thread pool of
+        ``settings.TICKETOFFICE_HASHING_WORKERS`` threads, so that hashing
+        does not block the event loop.
+
+        """
+        loop = asyncio.get_running_loop()
+        executor = get_executor(settings.TICKETOFFICE_HASHING_WORKERS)
+        # Run in current context, so that metrics reach its collector.
+        context = contextvars.copy_context()
+        return await loop.run_in_executor(executor, context.run,
+                                          self.authenticate, clear_password)
 
     def is_valid(self):
         """Return True if ticket is neither used nor expired."""
@@ -95,9 +203,17 @@ class Ticket(models.Model):
 
     @property
     def used(self):
-        """Return True if ticket was used."""
+        """Return True if ticket was used, all its uses for multi-use
+        tickets."""
         return self.usage_datetime is not None
 
+    @property
+    def remaining_uses(self):
+        """Return number of times ticket can still be used."""
+        if self.used:
+            return 0
+        return max(self.max_uses - self.use_count, 0)
+
     @property
     def expired(self):
         """Return True if ticket expired."""
@@ -107,6 +223,83 @@ class Ticket(models.Model):
         """Mark the ticket as used and save it."""
         self.usage_datetime = now()
         self.save()
+        ticket_cache.invalidate([self.uuid], using=self._state.db)
+
+    def consume(self):
+        """Use the ticket once if still valid; return True on success.
+
+        Unlike :meth:`use`, only writes usage fields, and only if no other
+        process used the ticket in the meantime. See
+        :meth:`~django_ticketoffice.managers.TicketManager.consume`.
+
+        Multi-use tickets are reloaded from database after use, since other
+        processes may have used them too.
+
+        """
+        timestamp = now()
+        consumed = type(self).objects.consume(self.uuid, self.place,
+                                              self.purpose,
+                                              timestamp=timestamp)
+        if consumed and not self._update_usage(timestamp):
+            self.refresh_from_db(using=self._usage_database(),
+                                 fields=self.usage_fields)
+        return consumed
+
+    async def aconsume(self):
+        """Asynchronous :meth:`consume`."""
+        timestamp = now()
+        consumed = await type(self).objects.aconsume(self.uuid, self.place,
+                                                     self.purpose,
+                                                     timestamp=timestamp)
+        if consumed and not self._update_usage(timestamp):
+            await sync_to_async(self.refresh_from_db)(
+                using=self._usage_database(), fields=self.usage_fields)
+        return consumed
+
+    def _usage_database(self):
+        """Return alias of database where ticket's usage is up to date.
+
+        Ticket may have been read from a replica, which lags behind.
+
+        """
+        shard = get_shard(self.place, self.uuid)
+        if shard is not None:
+            return shard
+        return router.db_for_write(type(self), instance=self)
+
+    def _update_usage(self, timestamp):
+        """Update usage fields of one-shot ticket consumed at ``timestamp``.
+
+        Return False if usage is unknown, e.g. of multi-use tickets.
+
+        """
+        if 'max_uses' in self.get_deferred_fields() or self.max_uses != 1:
+            return False
+        self.use_count = 1
+        self.usage_datetime = timestamp
+        return True
+
+
+class TokenGeneration(models.Model):
+    """Revocation generation of signed tokens, by place and purpose.
+
+    See :mod:`django_ticketoffice.tokens`.
+
+    """
+    #: Place of revoked tokens.
+    place = models.CharField(max_length=50, blank=True)
+
+    #: Purpose of revoked tokens.
+    purpose = models.CharField(max_length=50, blank=True)
+
+    #: Tokens made before this generation are revoked.
+    generation = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['place', 'purpose'],
+                                    name='token_generation_unique'),
+        ]
 
 
 class GuestUser(AnonymousUser):
@@ -116,5 +309,23 @@ class GuestUser(AnonymousUser):
         self.invitation_valid = invitation_valid
         super().__init__()
 
+    @cached_property
+    def id(self):
+        """Return ``user`` item of invitation's data, if any.
+
+        Invitation's data is only read (and loaded) on first access.
+
+        """
+        if self.invitation is None:
+            return None
+        try:
+            invitation_data = json.loads(self.invitation.data)
+        except (TypeError, ValueError):
+            return None
+        try:
+            return invitation_data['user']
+        except (KeyError, TypeError):
+            return None
+
     def is_authenticated(self):
         return self.invitation is not None and self.invitation_valid
@@ -0,0 +1,187 @@
+"""Migration operations.
+
+Ticket tables tend to be large, so these operations build and drop indexes
+without locking out writes on PostgreSQL (``CREATE INDEX CONCURRENTLY``,
+``DROP INDEX CONCURRENTLY``). Other backends get the regular Django
+behaviour.
+
+Migrations using these operations must set ``atomic = False``, since
+PostgreSQL cannot build indexes concurrently inside a transaction.
+
+"""
+from django.db import migrations
+from django.db.migrations.operations.base import Operation
+
+
+def is_postgresql(schema_editor):
+    """Return True if ``schema_editor`` works on PostgreSQL."""
+    return schema_editor.connection.vendor == 'postgresql'
+
+
+class AddIndexConcurrently(migrations.AddIndex):
+    """Add index, concurrently on PostgreSQL."""
+    def database_forwards(self, app_label, schema_editor, from_state,
+                          to_state):
+        if not is_postgresql(schema_editor):
+            return super().database_forwards(app_label, schema_editor,
+                                             from_state, to_state)
+        model = to_state.apps.get_model(app_label, self.model_name)
+        if self.allow_migrate_model(schema_editor.connection.alias, model):
+            schema_editor.execute(
+                self.index.create_sql(model, schema_editor,
+                                      concurrently=True))
+
+    def describe(self):
+        return super().describe() + ' (concurrently on PostgreSQL)'
+
+
+class RemoveIndexConcurrently(migrations.RemoveIndex):
+    """Remove index, concurrently on PostgreSQL."""
+    def database_forwards(self, app_label, schema_editor, from_state,
+                          to_state):
+        if not is_postgresql(schema_editor):
+            return super().database_forwards(app_label, schema_editor,
+                                             from_state, to_state)
+        model = from_state.apps.get_model(app_label, self.model_name)
+        if self.allow_migrate_model(schema_editor.connection.alias, model):
+            from_model_state = from_state.models[app_label,
+                                                 self.model_name_lower]
+            index = from_model_state.get_index_by_name(self.name)
+            schema_editor.execute(
+                index.remove_sql(model, schema_editor, concurrently=True))
+
+    def database_backwards(self, app_label, schema_editor, from_state,
+                           to_state):
+        if not is_postgresql(schema_editor):
+            return super().database_backwards(app_label, schema_editor,
+                                              from_state, to_state)
+        model = to_state.apps.get_model(app_label, self.model_name)
+        if self.allow_migrate_model(schema_editor.connection.alias, model):
+            to_model_state = to_state.models[app_label,
+                                             self.model_name_lower]
+            index = to_model_state.get_index_by_name(self.name)
+            schema_editor.execute(
+                index.create_sql(model, schema_editor, concurrently=True))
+
+    def describe(self):
+        return super().describe() + ' (concurrently on PostgreSQL)'
+
+
+class AlterFieldUniqueConcurrently(migrations.AlterField):
+    """Make a field unique, building the index concurrently on PostgreSQL.
+
+    On PostgreSQL, the unique index is built with ``CREATE UNIQUE INDEX
+    CONCURRENTLY``, then attached to the table as a constraint, which only
+    takes a short lock.
+
+    """
+    def database_forwards(self, app_label, schema_editor, from_state,
+                          to_state):
+        if not is_postgresql(schema_editor):
+            return super().database_forwards(app_label, schema_editor,
+                                             from_state, to_state)
+        model = to_state.apps.get_model(app_label, self.model_name)
+        if not self.allow_migrate_model(schema_editor.connection.alias,
+                                        model):
+            return
+        table = model._meta.db_table
+        column = model._meta.get_field(self.name).column
+        name = schema_editor._create_index_name(table, [column],
+                                                suffix='_uniq')
+        quote_name = schema_editor.quote_name
+        schema_editor.execute(
+            f'CREATE UNIQUE INDEX CONCURRENTLY {quote_name(name)} '
+            f'ON {quote_name(table)} ({quote_name(column)})')
+        schema_editor.execute(
+            f'ALTER TABLE {quote_name(table)} '
+            f'ADD CONSTRAINT {quote_name(name)} '
+            f'UNIQUE USING INDEX {quote_name(name)}')
+
+    def describe(self):
+        return super().describe() + ' (concurrently on PostgreSQL)'
+
+
+class RemoveFieldIndexConcurrently(Operation):
+    """Drop single-column index of a field, concurrently on PostgreSQL.
+
+    Database counterpart of an ``AlterField`` which removes ``db_index``:
+    use it in ``database_operations`` of ``SeparateDatabaseAndState``, with
+    the ``AlterField`` in ``state_operations``. ``AlterField`` itself drops
+    the index, and the ``_like`` index of text fields on PostgreSQL, with
+    plain ``DROP INDEX``, which locks the table.
+
+    """
+    reduces_to_sql = False
+    reversible = True
+
+    def __init__(self, model_name, name):
+        self.model_name = model_name
+        self.name = name
+
+    def deconstruct(self):
+        kwargs = {'model_name': self.model_name, 'name': self.name}
+        return (self.__class__.__name__, [], kwargs)
+
+    @property
+    def model_name_lower(self):
+        return self.model_name.lower()
+
+    def state_forwards(self, app_label, state):
+        pass
+
+    def index_names(self, model, field, schema_editor):
+        """Return names of single-column indexes of ``field``.
+
+        Indexes declared in ``Meta.indexes``, e.g. partial ones, are kept.
+
+        """
+        declared = {index.name for index in model._meta.indexes}
+        names = [name for name in schema_editor._constraint_names(
+            model, [field.column], index=True, unique=False,
+            primary_key=False) if name not in declared]
+        if is_postgresql(schema_editor):
+            # The _like index may be missing from introspection.
+            names.append(schema_editor._create_index_name(
+                model._meta.db_table, [field.column], suffix='_like'))
+        return sorted(set(names))
+
+    def database_forwards(self, app_label, schema_editor, from_state,
+                          to_state):
+        model = from_state.apps.get_model(app_label, self.model_name)
+        if not self.allow_migrate_model(schema_editor.connection.alias,
+                                        model):
+            return
+        field = model._meta.get_field(self.name)
+        for name in self.index_names(model, field, schema_editor):
+            if is_postgresql(schema_editor):
+                schema_editor.execute(
+                    f'DROP INDEX CONCURRENTLY IF EXISTS '
+                    f'{schema_editor.quote_name(name)}')
+            else:
+                schema_editor.execute(
+                    schema_editor._delete_index_sql(model, name))
+
+    def database_backwards(self, app_label, schema_editor, from_state,
+                           to_state):
+        model = to_state.apps.get_model(app_label, self.model_name)
+        if not self.allow_migrate_model(schema_editor.connection.alias,
+                                        model):
+            return
+        field = model._meta.get_field(self.name)
+        if not is_postgresql(schema_editor):
+            schema_editor.execute(
+                schema_editor._create_index_sql(model, fields=[field]))
+            return
+        schema_editor.execute(schema_editor._create_index_sql(
+            model, fields=[field], concurrently=True))
+        db_type = field.db_type(schema_editor.connection)
+        opclass = {'varchar': 'varchar_pattern_ops',
+                   'text': 'text_pattern_ops'}.get(db_type.split('(')[0])
+        if opclass is not None:
+            schema_editor.execute(schema_editor._create_index_sql(
+                model, fields=[field], suffix='_like', opclasses=[opclass],
+                concurrently=True))
+
+    def describe(self):
+        return (f'Remove index of field {self.name} on {self.model_name} '
+                f'(concurrently on PostgreSQL)')
@@ -0,0 +1,117 @@
+"""Database routers.
+
+:class:`TicketRouter` sends reads of tickets, e.g. validation lookups, to
+replicas of ``settings.TICKETOFFICE_READ_DATABASES``, and writes, i.e.
+issuance and consumption, to the primary database.
+
+Replicas lag behind the primary database. Two safeguards cover tickets just
+written:
+
+* within ``settings.TICKETOFFICE_READ_AFTER_WRITE_SECONDS`` after a write in
+  current context (thread or asynchronous task), reads go to the primary
+  database too. Pins do not outlive the request: they are reset when
+  requests start and finish, since threads of WSGI servers serve requests
+  in turn;
+
+* when ``settings.TICKETOFFICE_REPLICA_FALLBACK`` is True, validation
+  lookups which miss on a replica are retried on the primary database, see
+  :meth:`~django_ticketoffice.managers.TicketQuerySet.validation_databases`.
+  So tickets issued by other processes validate right away.
+
+Replicas may still show tickets used on primary as unused: consumption
+(``stamp_invitation``, ``Ticket.consume()``) runs on the primary database,
+so such tickets are not used twice.
+
+With sharding, see :mod:`django_ticketoffice.sharding`, instances of tickets
+are saved to and refreshed from their shard.
+
+"""
+import random
+import time
+from contextvars import ContextVar
+
+from django.core.signals import request_finished, request_started
+from django.db import DEFAULT_DB_ALIAS
+
+from django_ticketoffice import settings
+from django_ticketoffice.sharding import get_shard, get_shards
+
+
+#: Time until which reads of current context go to the primary database.
+pinned_until = ContextVar('django_ticketoffice.routers.pinned_until',
+                          default=0)
+
+
+def pin():
+    """Send reads of current context to primary database for a while."""
+    pinned_until.set(time.monotonic()
+                     + settings.TICKETOFFICE_READ_AFTER_WRITE_SECONDS)
+
+
+def is_pinned():
+    """Return True if reads of current context go to primary database."""
+    return time.monotonic() < pinned_until.get()
+
+
+def unpin(**kwargs):
+    """Send reads of current context to replicas again.
+
+    Connected to ``request_started`` and ``request_finished`` signals.
+
+    """
+    pinned_until.set(0)
+
+
+request_started.connect(unpin,
+                        dispatch_uid='django_ticketoffice.routers.unpin')
+request_finished.connect(unpin,
+                         dispatch_uid='django_ticketoffice.routers.unpin')
+
+
+class TicketRouter:
+    """Route reads of tickets to replicas, writes to primary database.
+
+    Add it to ``settings.DATABASE_ROUTERS``, before routers which would
+    handle tickets. Other models are left to next routers.
+
+    """
+    #: Alias of primary database.
+    primary = DEFAULT_DB_ALIAS
+
+    def is_ticket(self, model):
+        return model._meta.label_lower == 'django_ticketoffice.ticket'
+
+    def get_shard(self, hints):
+        """Return shard of ticket instance in ``hints``, if any.
+
+        Reads loaded fields only: routing runs when deferred fields are
+        loaded, and must not load them.
+
+        """
+        instance = hints.get('instance')
+        if instance is None or not get_shards():
+            return None
+        return get_shard(instance.__dict__.get('place'),
+                         instance.__dict__.get('uuid'))
+
+    def db_for_read(self, model, **hints):
+        if not self.is_ticket(model):
+            return None
+        shard = self.get_shard(hints)
+        if shard is not None:
+            return shard
+        replicas = settings.TICKETOFFICE_READ_DATABASES
+        if not replicas or is_pinned():
+            return self.primary
+        return random.choice(replicas)
+
+    def db_for_write(self, model, **hints):
+        if not self.is_ticket(model):
+            return None
+        shard = self.get_shard(hints)
+        if shard is not None:
+            return shard
+        # Lookups falling back to primary database do not write.
+        if not hints.get('read_fallback'):
+            pin()
+        return self.primary
@@ -17,3 +17,133 @@ TICKETOFFICE_PASSWORD_GENERATOR = settings.__dict__.setdefault(
      [],
      {'min_length': 12, 'max_length': 20})
 )
+
+
+# Set default value for ``settings.TICKETOFFICE_PASSWORD_HASHER``.
+#: Import path of password hasher class used to encrypt tickets' passwords.
+#:
+#: ``None`` means tickets use ``settings.PASSWORD_HASHERS``, like users.
+TICKETOFFICE_PASSWORD_HASHER = settings.__dict__.setdefault(
+    'TICKETOFFICE_PASSWORD_HASHER',
+    None
+)
+
+
+# Set default value for ``settings.TICKETOFFICE_CACHE``.
+#: Alias of cache (in ``settings.CACHES``) where valid tickets are cached.
+#: If there is no such cache, a local-memory cache is used.
+#:
+#: ``None`` disables the cache.
+TICKETOFFICE_CACHE = settings.__dict__.setdefault(
+    'TICKETOFFICE_CACHE',
+    None
+)
+
+
+# Set default value for ``settings.TICKETOFFICE_CACHE_TIMEOUT``.
+#: Maximum lifetime of cached tickets, in seconds.
+TICKETOFFICE_CACHE_TIMEOUT = settings.__dict__.setdefault(
+    'TICKETOFFICE_CACHE_TIMEOUT',
+    300
+)
+
+
+# Set default value for ``settings.TICKETOFFICE_SESSION_SNAPSHOT_MAX_AGE``.
+#: Freshness window of ticket snapshots stored in session, in seconds.
+#: Within this window, ``invitation_required`` validates ticket from session
+#: without querying the database.
+#:
+#: ``None`` disables snapshots.
+TICKETOFFICE_SESSION_SNAPSHOT_MAX_AGE = settings.__dict__.setdefault(
+    'TICKETOFFICE_SESSION_SNAPSHOT_MAX_AGE',
+    None
+)
+
+
+# Set default value for ``settings.TICKETOFFICE_UUID_FILTER``.
+#: Options of the in-process filter of tickets' UUIDs, as a dict. See
+#: :class:`django_ticketoffice.bloom.TicketUUIDFilter`.
+#:
+#: ``None`` disables the filter.
+TICKETOFFICE_UUID_FILTER = settings.__dict__.setdefault(
+    'TICKETOFFICE_UUID_FILTER',
+    None
+)
+
+
+# Set default value for ``settings.TICKETOFFICE_HASHING_WORKERS``.
+#: Number of threads where asynchronous code verifies tickets' passwords, so
+#: that hashing does not block the event loop.
+#:
+#: ``None`` means the number of processors.
+TICKETOFFICE_HASHING_WORKERS = settings.__dict__.setdefault(
+    'TICKETOFFICE_HASHING_WORKERS',
+    None
+)
+
+
+# Set default value for ``settings.TICKETOFFICE_TOKEN_CACHE``.
+#: Alias of cache (in ``settings.CACHES``) where revocation generations of
+#: signed tokens are stored. See :mod:`django_ticketoffice.tokens`.
+TICKETOFFICE_TOKEN_CACHE = settings.__dict__.setdefault(
+    'TICKETOFFICE_TOKEN_CACHE',
+    'default'
+)
+
+
+# Set default value for ``settings.TICKETOFFICE_METRICS``.
+#: Import path of metrics backend class. See
+#: :mod:`django_ticketoffice.metrics`.
+#:
+#: ``None`` disables metrics.
+TICKETOFFICE_METRICS = settings.__dict__.setdefault(
+    'TICKETOFFICE_METRICS',
+    None
+)
+
+
+# Set default value for ``settings.TICKETOFFICE_READ_DATABASES``.
+#: Aliases of databases (in ``settings.DATABASES``) where
+#: :class:`~django_ticketoffice.routers.TicketRouter` sends reads of tickets,
+#: e.g. replicas. Empty means reads go to primary database.
+TICKETOFFICE_READ_DATABASES = settings.__dict__.setdefault(
+    'TICKETOFFICE_READ_DATABASES',
+    []
+)
+
+
+# Set default value for ``settings.TICKETOFFICE_READ_AFTER_WRITE_SECONDS``.
+#: Time during which reads of tickets go to primary database after a write
+#: in the same thread or asynchronous task, in seconds.
+TICKETOFFICE_READ_AFTER_WRITE_SECONDS = settings.__dict__.setdefault(
+    'TICKETOFFICE_READ_AFTER_WRITE_SECONDS',
+    5
+)
+
+
+# Set default value for ``settings.TICKETOFFICE_REPLICA_FALLBACK``.
+#: Whether validation lookups which miss on a replica are retried on primary
+#: database, for tickets issued but not replicated yet.
+TICKETOFFICE_REPLICA_FALLBACK = settings.__dict__.setdefault(
+    'TICKETOFFICE_REPLICA_FALLBACK',
+    True
+)
+
+
+# Set default value for ``settings.TICKETOFFICE_SHARDS``.
+#: Aliases of databases (in ``settings.DATABASES``) where tickets are
+#: sharded. See :mod:`django_ticketoffice.sharding`.
+#:
+#: Empty disables sharding.
+TICKETOFFICE_SHARDS = settings.__dict__.setdefault(
+    'TICKETOFFICE_SHARDS',
+    []
+)
+
+
+# Set default value for ``settings.TICKETOFFICE_SHARD_KEY``.
+#: Field whose hash picks the shard of tickets: ``'place'`` or ``'uuid'``.
+TICKETOFFICE_SHARD_KEY = settings.__dict__.setdefault(
+    'TICKETOFFICE_SHARD_KEY',
+    'place'
+)
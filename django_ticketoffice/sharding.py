@@ -0,0 +1,43 @@
+"""Horizontal sharding of tickets across databases.
+
+When ``settings.TICKETOFFICE_SHARDS`` lists database aliases, each ticket is
+stored in one of them, picked by a stable hash of its place or of its UUID,
+according to ``settings.TICKETOFFICE_SHARD_KEY``.
+
+:class:`~django_ticketoffice.managers.TicketManager` issues, validates and
+consumes tickets on their shard. Lookups which do not tell the shard, e.g.
+by UUID only while sharding by place, try every shard in turn.
+
+Changing the list of shards moves tickets to other shards: tickets already
+issued are then not found.
+
+"""
+import zlib
+from uuid import UUID
+
+from django_ticketoffice import settings
+
+
+def get_shards():
+    """Return list of shards' aliases, empty if sharding is disabled."""
+    return list(settings.TICKETOFFICE_SHARDS)
+
+
+def get_shard(place=None, uuid=None):
+    """Return alias of database holding tickets of ``place`` or ``uuid``.
+
+    Return None if sharding is disabled, or if the shard key is None.
+
+    """
+    shards = settings.TICKETOFFICE_SHARDS
+    if not shards:
+        return None
+    if settings.TICKETOFFICE_SHARD_KEY == 'uuid':
+        if uuid is None:
+            return None
+        key = UUID(str(uuid)).bytes
+    else:
+        if place is None:
+            return None
+        key = place.encode()
+    return shards[zlib.crc32(key) % len(shards)]
@@ -1,5 +1,14 @@
 """Tests."""
-from datetime import timedelta
+import asyncio
+import csv
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+import gzip
+from io import StringIO
+import json
+import os
+import tempfile
+import threading
 import uuid
 import unittest
 from unittest import mock
@@ -7,15 +16,33 @@ from unittest import mock
 import django.test
 from django.conf import settings
 from django.contrib.auth import hashers
-from django.core.management import call_command
-from django.utils.timezone import now
+from django.contrib.sessions.models import Session
+from django.core import signing
+from django.core.cache import caches
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.management import CommandError, call_command
+from django.core.signals import request_finished, request_started
+from django.db import (IntegrityError, close_old_connections, connection,
+                       transaction)
+from django.http import Http404, HttpResponse
+from django.views.generic import View
+from django.utils.timezone import make_aware, now
 
+from django_ticketoffice import benchmarks
+from django_ticketoffice import bloom
+from django_ticketoffice import cache
 from django_ticketoffice import decorators
 from django_ticketoffice import exceptions
 from django_ticketoffice import forms
 from django_ticketoffice import managers
+from django_ticketoffice import metrics
 from django_ticketoffice import models
+from django_ticketoffice import routers
+from django_ticketoffice import sharding
+from django_ticketoffice import tokens
 from django_ticketoffice import utils
+from django_ticketoffice import views
+from django_ticketoffice.middleware import TicketQueryReportMiddleware
 from django_ticketoffice.settings import TICKETOFFICE_PASSWORD_GENERATOR
 
 
@@ -36,6 +63,9 @@ class TicketModelTestCase(django.test.TestCase):
         ticket = models.Ticket()
         self.assertTrue(is_valid_password(ticket.password))
         generate_password_mock = mock.Mock(return_value='a-password')
+        # Generator is imported once: forget it before and after mock.
+        utils.import_generator.cache_clear()
+        self.addCleanup(utils.import_generator.cache_clear)
         with mock.patch('django_ticketoffice.utils.random_password',
                         new=generate_password_mock):
             password = ticket.generate_password()
@@ -45,6 +75,33 @@ class TicketModelTestCase(django.test.TestCase):
             **TICKETOFFICE_PASSWORD_GENERATOR[2])
         self.assertEqual(password, 'a-password')
 
+    def test_generate_passwords(self):
+        """Ticket.generate_passwords() returns distinct clear passwords."""
+        passwords = models.Ticket.generate_passwords(10)
+        self.assertEqual(len(set(passwords)), 10)
+        generator = mock.Mock(side_effect=['a', 'b'], spec=[])
+        # Generators without "many" attribute are called once per password.
+        with mock.patch('django_ticketoffice.models.import_generator',
+                        return_value=generator):
+            self.assertEqual(models.Ticket.generate_passwords(2), ['a', 'b'])
+
+    def test_password_hasher(self):
+        """Ticket uses settings.TICKETOFFICE_PASSWORD_HASHER if set."""
+        ticket = models.Ticket()
+        with mock.patch('django_ticketoffice.settings'
+                        '.TICKETOFFICE_PASSWORD_HASHER',
+                        new='django_ticketoffice.utils.HMACPasswordHasher'):
+            ticket.set_password('secret')
+            self.assertTrue(ticket.password.startswith('hmac_sha256$'))
+            self.assertTrue(ticket.authenticate('secret'))
+            self.assertFalse(ticket.authenticate('wrong'))
+        # Tickets encrypted with another hasher can still authenticate.
+        ticket.set_password('secret')
+        with mock.patch('django_ticketoffice.settings'
+                        '.TICKETOFFICE_PASSWORD_HASHER',
+                        new='django_ticketoffice.utils.HMACPasswordHasher'):
+            self.assertTrue(ticket.authenticate('secret'))
+
 
 class TicketManagerTestCase(django.test.TestCase):
     "Test suite around `django_ticketoffice.managers.TicketManager`."
@@ -120,6 +177,605 @@ class TicketManagerTestCase(django.test.TestCase):
                           manager.authenticate,
                           original.uuid, password)
 
+    def test_get_for_validation(self):
+        """get_for_validation() loads data on first access only."""
+        manager = models.Ticket.objects
+        original = manager.create(data={'user': 42})
+        original.set_password('secret')
+        original.save()
+        with self.assertNumQueries(1):
+            ticket = manager.get_for_validation(uuid=original.uuid)
+            self.assertTrue(ticket.is_valid())
+            self.assertTrue(ticket.authenticate('secret'))
+            self.assertTrue(ticket.is_appropriate('', ''))
+        with self.assertNumQueries(1):
+            self.assertEqual(ticket.data, {'user': 42})
+            self.assertEqual(ticket.data, {'user': 42})
+
+    def test_active(self):
+        """active() returns tickets neither used nor expired."""
+        manager = models.Ticket.objects
+        valid = [
+            manager.create(),
+            manager.create(expiry_datetime=now() + timedelta(days=2)),
+        ]
+        manager.create(expiry_datetime=now() - timedelta(days=2))
+        manager.create(usage_datetime=now() - timedelta(days=2))
+        self.assertEqual(set(manager.active()), set(valid))
+
+    def test_authenticate_queries(self):
+        """authenticate() takes one query if valid, two otherwise."""
+        manager = models.Ticket.objects
+        valid = manager.create()
+        valid.set_password('secret')
+        valid.save()
+        used = manager.create(usage_datetime=now())
+        used.set_password('secret')
+        used.save()
+        with self.assertNumQueries(1):
+            manager.authenticate(valid.uuid, 'secret')
+        with self.assertNumQueries(2):
+            with self.assertRaises(exceptions.TicketUsedError):
+                manager.authenticate(used.uuid, 'secret')
+        with self.assertNumQueries(2):
+            with self.assertRaises(exceptions.CredentialsError):
+                manager.authenticate(uuid.uuid4(), 'secret')
+
+    def test_authenticate_many(self):
+        """authenticate_many() returns a ticket or an exception per pair."""
+        manager = models.Ticket.objects
+        valid, password = manager.issue(place='louvre')
+        used, used_password = manager.issue(place='louvre')
+        used.use()
+        expired, expired_password = manager.issue(
+            place='louvre', expiry_datetime=now() - timedelta(days=1))
+        other, other_password = manager.issue(place='orsay')
+        credentials = [
+            (valid.uuid, password),
+            (str(valid.uuid), 'wrong'),
+            (used.uuid, used_password),
+            (expired.uuid, expired_password),
+            (other.uuid, other_password),
+            (uuid.uuid4(), 'secret'),
+            ('not-a-uuid', 'secret'),
+            (str(valid.uuid), password),
+        ]
+        with self.assertNumQueries(1):
+            results = manager.authenticate_many(credentials, place='louvre')
+        self.assertEqual(results[0], valid)
+        self.assertEqual([type(result) for result in results[1:-1]],
+                         [exceptions.CredentialsError,
+                          exceptions.TicketUsedError,
+                          exceptions.TicketExpiredError,
+                          exceptions.CredentialsError,
+                          exceptions.CredentialsError,
+                          exceptions.CredentialsError])
+        self.assertEqual(results[-1], valid)
+        self.assertEqual(manager.authenticate_many([]), [])
+
+    def test_consume(self):
+        """consume() marks valid ticket as used, only once."""
+        manager = models.Ticket.objects
+        ticket = manager.create(place='louvre', purpose='visit')
+        self.assertTrue(manager.consume(ticket.uuid, 'louvre', 'visit'))
+        self.assertTrue(manager.get(pk=ticket.pk).used)
+        self.assertFalse(manager.consume(ticket.uuid, 'louvre', 'visit'))
+
+    def test_consume_expired(self):
+        """consume() does not use expired tickets."""
+        manager = models.Ticket.objects
+        ticket = manager.create(expiry_datetime=now() - timedelta(days=2))
+        self.assertFalse(manager.consume(ticket.uuid))
+        self.assertFalse(manager.get(pk=ticket.pk).used)
+
+    def test_consume_wrong_place(self):
+        """consume() only matches ticket's place and purpose."""
+        manager = models.Ticket.objects
+        ticket = manager.create(place='louvre', purpose='visit')
+        self.assertFalse(manager.consume(ticket.uuid, 'orsay', 'visit'))
+
+    def test_ticket_consume(self):
+        """Ticket.consume() updates instance on success."""
+        ticket = models.Ticket.objects.create()
+        self.assertTrue(ticket.consume())
+        self.assertTrue(ticket.used)
+        usage_datetime = ticket.usage_datetime
+        other = models.Ticket.objects.get(pk=ticket.pk)
+        self.assertEqual(other.usage_datetime, usage_datetime)
+        other.usage_datetime = None
+        self.assertFalse(other.consume())
+        self.assertFalse(other.used)
+
+    def test_bulk_issue(self):
+        """bulk_issue() creates tickets and yields uuid and clear password."""
+        manager = models.Ticket.objects
+        expiry = now() + timedelta(days=2)
+        issued = list(manager.bulk_issue(5, place='louvre', purpose='visit',
+                                         expiry_datetime=expiry,
+                                         batch_size=2))
+        self.assertEqual(len(issued), 5)
+        self.assertEqual(manager.count(), 5)
+        for ticket_uuid, password in issued:
+            ticket = manager.authenticate(ticket_uuid, password,
+                                          place='louvre', purpose='visit')
+            self.assertEqual(ticket.expiry_datetime, expiry)
+            self.assertEqual(ticket.data, {})
+
+    def test_bulk_issue_data(self):
+        """bulk_issue() accepts an iterable of ticket data."""
+        manager = models.Ticket.objects
+        data = ({'user': x} for x in range(3))
+        issued = manager.bulk_issue(data, batch_size=2)
+        for x, (ticket_uuid, password) in enumerate(issued):
+            self.assertEqual(manager.get(uuid=ticket_uuid).data, {'user': x})
+        self.assertEqual(manager.count(), 3)
+
+    def test_consume_multi_use(self):
+        """consume() uses multi-use tickets up to max_uses."""
+        manager = models.Ticket.objects
+        ticket, password = manager.issue(max_uses=3)
+        self.assertEqual(ticket.remaining_uses, 3)
+        self.assertTrue(ticket.consume())
+        self.assertEqual(ticket.use_count, 1)
+        self.assertEqual(ticket.remaining_uses, 2)
+        self.assertFalse(ticket.used)
+        # Another process uses it too.
+        self.assertTrue(manager.consume(ticket.uuid))
+        self.assertTrue(ticket.consume())
+        self.assertTrue(ticket.used)
+        self.assertEqual(ticket.remaining_uses, 0)
+        self.assertFalse(ticket.consume())
+        ticket.refresh_from_db()
+        self.assertEqual(ticket.use_count, 3)
+        with self.assertRaises(exceptions.TicketUsedError):
+            manager.authenticate(ticket.uuid, password)
+
+    def test_revoke(self):
+        """revoke() marks matching unused tickets as used, by batches."""
+        manager = models.Ticket.objects
+        revoked = [manager.issue(data={'campaign': 1}) for x in range(3)]
+        kept = manager.issue(data={'campaign': 2})
+        used = manager.create(data={'campaign': 1}, usage_datetime=now())
+        # 2 batches of SELECT and UPDATE, then a SELECT of no batch.
+        with self.assertNumQueries(5):
+            count = manager.filter(data__campaign=1).revoke(batch_size=2)
+        self.assertEqual(count, 3)
+        for ticket, password in revoked:
+            with self.assertRaises(exceptions.TicketUsedError):
+                manager.authenticate(ticket.uuid, password)
+        manager.authenticate(kept[0].uuid, kept[1])
+        self.assertEqual(manager.get(pk=used.pk).usage_datetime,
+                         used.usage_datetime)
+
+    def test_expire_now(self):
+        """expire_now() makes matching tickets expire."""
+        manager = models.Ticket.objects
+        timestamp = now()
+        expired = manager.create(expiry_datetime=timestamp
+                                 - timedelta(days=1))
+        tickets = [manager.create(place='louvre'),
+                   manager.create(place='louvre',
+                                  expiry_datetime=timestamp
+                                  + timedelta(days=1))]
+        manager.create(place='orsay')
+        self.assertEqual(manager.exclude(place='orsay')
+                         .expire_now(timestamp, batch_size=1), 2)
+        for ticket in tickets:
+            ticket.refresh_from_db()
+            self.assertEqual(ticket.expiry_datetime, timestamp)
+        self.assertEqual(manager.get(pk=expired.pk).expiry_datetime,
+                         expired.expiry_datetime)
+        self.assertEqual(manager.expired().count(), 3)
+
+    def test_bulk_consume(self):
+        """bulk_consume() uses active tickets once."""
+        manager = models.Ticket.objects
+        one_shot = manager.create()
+        multi_use = manager.create(max_uses=2)
+        used = manager.create(usage_datetime=now())
+        uuids = [one_shot.uuid, multi_use.uuid, used.uuid, uuid.uuid4()]
+        self.assertEqual(manager.bulk_consume(uuids, batch_size=2), 2)
+        self.assertEqual(manager.bulk_consume(uuids), 1)
+        for ticket in (one_shot, multi_use):
+            ticket.refresh_from_db()
+            self.assertTrue(ticket.used)
+        self.assertEqual(multi_use.use_count, 2)
+
+    def test_pk_batches(self):
+        """pk_batches() yields primary keys in order, by batches."""
+        manager = models.Ticket.objects
+        pks = [manager.create().pk for x in range(5)]
+        self.assertEqual(list(manager.all().pk_batches(2)),
+                         [pks[0:2], pks[2:4], pks[4:]])
+
+    def test_issue(self):
+        """issue() creates ticket and returns it with clear password."""
+        manager = models.Ticket.objects
+        ticket, password = manager.issue(place='louvre', purpose='visit',
+                                         data={'user': 1})
+        self.assertEqual(manager.authenticate(ticket.uuid, password,
+                                              place='louvre',
+                                              purpose='visit'),
+                         ticket)
+        self.assertEqual(manager.get().data, {'user': 1})
+
+
+class AsyncTicketManagerTestCase(django.test.TestCase):
+    """Test suite around asynchronous API of `TicketManager`."""
+    def setUp(self):
+        super().setUp()
+        self.ticket = models.Ticket.objects.create(place='louvre',
+                                                   purpose='visit')
+        self.ticket.set_password('secret')
+        self.ticket.save()
+
+    async def test_aauthenticate(self):
+        """aauthenticate() returns ticket or raises like authenticate()."""
+        manager = models.Ticket.objects
+        ticket = await manager.aauthenticate(self.ticket.uuid, 'secret',
+                                             place='louvre', purpose='visit')
+        self.assertEqual(ticket, self.ticket)
+        with self.assertRaises(exceptions.CredentialsError):
+            await manager.aauthenticate(self.ticket.uuid, 'wrong',
+                                        place='louvre', purpose='visit')
+        with self.assertRaises(exceptions.CredentialsError):
+            await manager.aauthenticate(self.ticket.uuid, 'secret')
+        with self.assertRaises(exceptions.CredentialsError):
+            await manager.aauthenticate('foo', 'secret')
+
+    @mock.patch('django_ticketoffice.settings.TICKETOFFICE_UUID_FILTER',
+                new={})
+    async def test_aauthenticate_uuid_filter(self):
+        """aauthenticate() builds UUID filter outside the event loop."""
+        bloom.uuid_filter.filter = None
+        self.addCleanup(setattr, bloom.uuid_filter, 'filter', None)
+        manager = models.Ticket.objects
+        ticket = await manager.aauthenticate(self.ticket.uuid, 'secret',
+                                             place='louvre', purpose='visit')
+        self.assertEqual(ticket, self.ticket)
+        with self.assertRaises(exceptions.CredentialsError):
+            await manager.aauthenticate(uuid.uuid4(), 'secret',
+                                        place='louvre', purpose='visit')
+
+    async def test_aauthenticate_used(self):
+        """aauthenticate() raises TicketUsedError if ticket was used."""
+        manager = models.Ticket.objects
+        self.assertTrue(await manager.aconsume(self.ticket.uuid, 'louvre',
+                                               'visit'))
+        with self.assertRaises(exceptions.TicketUsedError):
+            await manager.aauthenticate(self.ticket.uuid, 'secret',
+                                        place='louvre', purpose='visit')
+
+    async def test_aissue(self):
+        """aissue() creates ticket and returns it with clear password."""
+        manager = models.Ticket.objects
+        ticket, password = await manager.aissue(place='louvre',
+                                                purpose='visit')
+        self.assertEqual(await manager.aauthenticate(ticket.uuid, password,
+                                                     place='louvre',
+                                                     purpose='visit'),
+                         ticket)
+
+    async def test_abulk_issue(self):
+        """abulk_issue() creates tickets, yields uuid and clear password."""
+        manager = models.Ticket.objects
+        issued = [pair async for pair in manager.abulk_issue(
+            5, place='louvre', purpose='visit', batch_size=2)]
+        self.assertEqual(len(issued), 5)
+        for ticket_uuid, password in issued:
+            await manager.aauthenticate(ticket_uuid, password,
+                                        place='louvre', purpose='visit')
+
+    def test_benchmark(self):
+        """Throughput benchmark compares sync and async API."""
+        results = benchmarks.bench_async_throughput(10, concurrency=2)
+        self.assertEqual(set(results), {'sync', 'async'})
+
+
+class GuestUserTestCase(django.test.TestCase):
+    """Test suite around `django_ticketoffice.models.GuestUser`."""
+    def test_id(self):
+        """GuestUser.id is read from invitation's data on access."""
+        invitation = models.Ticket(data='{"user": 42}')
+        user = models.GuestUser(invitation=invitation, invitation_valid=True)
+        self.assertEqual(user.id, 42)
+
+    def test_id_missing(self):
+        """GuestUser.id is None if invitation's data has no user."""
+        invitation = models.Ticket(data='{}')
+        user = models.GuestUser(invitation=invitation, invitation_valid=True)
+        self.assertIsNone(user.id)
+        self.assertIsNone(models.GuestUser().id)
+
+    def test_guest_login_does_not_load_data(self):
+        """guest_login() does not load invitation's data."""
+        original = models.Ticket.objects.create()
+        invitation = models.Ticket.objects.get_for_validation(pk=original.pk)
+        request = mock.Mock()
+        with self.assertNumQueries(0):
+            decorators.guest_login(request, invitation)
+        self.assertIs(request.invitation, invitation)
+        self.assertTrue(request.user.is_authenticated())
+
+
+@mock.patch('django_ticketoffice.settings.TICKETOFFICE_CACHE', new='default')
+class TicketCacheTestCase(django.test.TestCase):
+    """Test suite around `django_ticketoffice.cache.TicketCache`."""
+    def setUp(self):
+        super().setUp()
+        self.addCleanup(caches['default'].clear)
+
+    def test_get_cached(self):
+        """get_cached() hits database once for valid tickets."""
+        manager = models.Ticket.objects
+        original = manager.create(place='louvre', purpose='visit',
+                                  data={'user': 42})
+        stats = cache.ticket_cache.stats()
+        with self.assertNumQueries(1):
+            manager.get_cached(original.uuid, 'louvre', 'visit')
+        with self.assertNumQueries(0):
+            ticket = manager.get_cached(original.uuid, 'louvre', 'visit')
+        self.assertEqual(ticket, original)
+        self.assertTrue(ticket.is_valid())
+        self.assertEqual(cache.ticket_cache.stats(),
+                         {'hits': stats['hits'] + 1,
+                          'misses': stats['misses'] + 1})
+        # Other fields are loaded on access.
+        with self.assertNumQueries(1):
+            self.assertEqual(ticket.data, {'user': 42})
+
+    def test_get_cached_wrong_place(self):
+        """get_cached() checks place and purpose of cached tickets."""
+        manager = models.Ticket.objects
+        original = manager.create(place='louvre', purpose='visit')
+        manager.get_cached(original.uuid, 'louvre', 'visit')
+        with self.assertRaises(models.Ticket.DoesNotExist):
+            manager.get_cached(original.uuid, 'orsay', 'visit')
+
+    def test_invalid_not_cached(self):
+        """Used or expired tickets are not cached."""
+        manager = models.Ticket.objects
+        used = manager.create(usage_datetime=now())
+        expired = manager.create(expiry_datetime=now() - timedelta(days=2))
+        for ticket in (used, expired):
+            manager.get_cached(ticket.uuid)
+            self.assertIsNone(cache.ticket_cache.get(ticket.uuid))
+
+    def test_disabled(self):
+        """get_cached() always hits database if cache is disabled."""
+        manager = models.Ticket.objects
+        ticket = manager.create()
+        with mock.patch('django_ticketoffice.settings.TICKETOFFICE_CACHE',
+                        new=None):
+            manager.get_cached(ticket.uuid)
+            with self.assertNumQueries(1):
+                manager.get_cached(ticket.uuid)
+
+
+@mock.patch('django_ticketoffice.settings.TICKETOFFICE_CACHE', new='default')
+class TicketCacheInvalidationTestCase(django.test.TransactionTestCase):
+    """Test suite around invalidation of cached tickets, on commit."""
+    def setUp(self):
+        super().setUp()
+        self.addCleanup(caches['default'].clear)
+
+    def test_consume_invalidates(self):
+        """Using tickets removes them from cache."""
+        manager = models.Ticket.objects
+        ticket = manager.create()
+        manager.get_cached(ticket.uuid)
+        self.assertIsNotNone(cache.ticket_cache.get(ticket.uuid))
+        ticket.consume()
+        self.assertIsNone(cache.ticket_cache.get(ticket.uuid))
+        other = manager.create()
+        manager.get_cached(other.uuid)
+        other.use()
+        self.assertIsNone(cache.ticket_cache.get(other.uuid))
+
+    def test_bulk_updates(self):
+        """Bulk state transitions remove tickets from cache."""
+        manager = models.Ticket.objects
+        tickets = [manager.create(place='louvre') for x in range(3)]
+        for ticket in tickets:
+            manager.get_cached(ticket.uuid, 'louvre')
+        manager.filter(pk=tickets[0].pk).revoke()
+        manager.filter(pk=tickets[1].pk).expire_now()
+        manager.bulk_consume([tickets[2].uuid])
+        for ticket in tickets:
+            self.assertFalse(
+                manager.get_cached(ticket.uuid, 'louvre').is_valid())
+
+    def test_invalidate_on_commit(self):
+        """Tickets are invalidated on commit, stale lookups cannot recache."""
+        manager = models.Ticket.objects
+        ticket = manager.create()
+        stale = manager.get_cached(ticket.uuid)
+        with transaction.atomic():
+            self.assertTrue(manager.consume(ticket.uuid))
+            # Other transactions still read the ticket as valid.
+            self.assertIsNotNone(cache.ticket_cache.get(ticket.uuid))
+        self.assertIsNone(cache.ticket_cache.get(ticket.uuid))
+        # A lookup which read the ticket before commit sets it afterwards.
+        cache.ticket_cache.set(stale)
+        self.assertIsNone(cache.ticket_cache.get(ticket.uuid))
+        self.assertTrue(manager.get_cached(ticket.uuid).used)
+
+    def test_rollback(self):
+        """Tickets stay cached if transaction is rolled back."""
+        manager = models.Ticket.objects
+        ticket = manager.create()
+        manager.get_cached(ticket.uuid)
+        with self.assertRaises(ZeroDivisionError):
+            with transaction.atomic():
+                manager.consume(ticket.uuid)
+                1 / 0
+        self.assertIsNotNone(cache.ticket_cache.get(ticket.uuid))
+
+
+class BloomFilterTestCase(unittest.TestCase):
+    """Test suite around `django_ticketoffice.bloom.BloomFilter`."""
+    def test_contains(self):
+        """BloomFilter has no false negatives, and few false positives."""
+        bloom_filter = bloom.BloomFilter(capacity=1000, error_rate=0.01)
+        added = [uuid.uuid4() for x in range(1000)]
+        for value in added:
+            bloom_filter.add(value)
+        for value in added:
+            self.assertIn(value, bloom_filter)
+            self.assertIn(str(value), bloom_filter)
+        false_positives = sum(uuid.uuid4() in bloom_filter
+                              for x in range(1000))
+        self.assertLess(false_positives, 50)
+
+    def test_max_bytes(self):
+        """BloomFilter size is limited by max_bytes."""
+        bloom_filter = bloom.BloomFilter(capacity=10 ** 6, max_bytes=1024)
+        self.assertEqual(len(bloom_filter.bits), 1024)
+
+
+@mock.patch('django_ticketoffice.settings.TICKETOFFICE_UUID_FILTER',
+            new={})
+class TicketUUIDFilterTestCase(django.test.TestCase):
+    """Test suite around `django_ticketoffice.bloom.TicketUUIDFilter`."""
+    def setUp(self):
+        super().setUp()
+        self.ticket = models.Ticket.objects.create()
+        self.ticket.set_password('secret')
+        self.ticket.save()
+        # Filter is built with tickets of each test.
+        bloom.uuid_filter.filter = None
+        self.addCleanup(setattr, bloom.uuid_filter, 'filter', None)
+
+    def test_unknown_uuid(self):
+        """authenticate() rejects unknown UUIDs without query."""
+        bloom.uuid_filter.update()
+        with self.assertNumQueries(0):
+            with self.assertRaises(exceptions.CredentialsError):
+                models.Ticket.objects.authenticate(uuid.uuid4(), 'secret')
+
+    def test_known_uuid(self):
+        """authenticate() finds tickets in filter."""
+        ticket = models.Ticket.objects.authenticate(self.ticket.uuid,
+                                                    'secret')
+        self.assertEqual(ticket, self.ticket)
+
+    def test_add(self):
+        """Tickets created in current process are added to filter."""
+        bloom.uuid_filter.update()
+        ticket = models.Ticket.objects.create()
+        self.assertTrue(bloom.uuid_filter.might_contain(ticket.uuid))
+        ((issued_uuid, password),) = models.Ticket.objects.bulk_issue(1)
+        self.assertTrue(bloom.uuid_filter.might_contain(issued_uuid))
+
+    def test_sync(self):
+        """Tickets created by other processes are added on refresh."""
+        bloom.uuid_filter.update()
+        ticket = models.Ticket(uuid=uuid.uuid4())
+        models.Ticket.objects.bulk_create([ticket])  # Skips save().
+        self.assertFalse(bloom.uuid_filter.might_contain(ticket.uuid))
+        bloom.uuid_filter.synced_at -= timedelta(seconds=60)
+        self.assertTrue(bloom.uuid_filter.might_contain(ticket.uuid))
+
+    def test_rebuild(self):
+        """Rebuilds run in background, requests use current filter."""
+        bloom.uuid_filter.update()
+        current = bloom.uuid_filter.filter
+        bloom.uuid_filter.built_at -= timedelta(days=1)
+        with mock.patch('django_ticketoffice.bloom.threading.Thread') \
+                as thread:
+            with self.assertNumQueries(0):
+                self.assertTrue(
+                    bloom.uuid_filter.might_contain(self.ticket.uuid))
+        self.assertTrue(thread.return_value.start.called)
+        self.assertIs(bloom.uuid_filter.filter, current)
+        self.addCleanup(setattr, bloom.uuid_filter, '_updating', False)
+        # Other requests do not start another rebuild meanwhile.
+        with mock.patch('django_ticketoffice.bloom.threading.Thread') \
+                as thread:
+            bloom.uuid_filter.update()
+        self.assertFalse(thread.called)
+
+    def test_build(self):
+        """Builds keep UUIDs added during the scan, forget deleted ones."""
+        bloom.uuid_filter.update()
+        added = uuid.uuid4()
+        get_querysets = bloom.uuid_filter.get_querysets
+
+        def add_during_scan():
+            bloom.uuid_filter.add(added)
+            return get_querysets()
+
+        self.ticket.delete()
+        with mock.patch.object(bloom.uuid_filter, 'get_querysets',
+                               side_effect=add_during_scan):
+            bloom.uuid_filter.build()
+        self.assertIn(added, bloom.uuid_filter.filter)
+        self.assertNotIn(self.ticket.uuid, bloom.uuid_filter.filter)
+
+    def test_disabled(self):
+        """Filter lets everything pass when disabled."""
+        with mock.patch('django_ticketoffice.settings'
+                        '.TICKETOFFICE_UUID_FILTER', new=None):
+            self.assertTrue(bloom.uuid_filter.might_contain(uuid.uuid4()))
+        self.assertIsNone(bloom.uuid_filter.filter)
+
+
+class TicketIndexesTestCase(django.test.TestCase):
+    """Test suite around database indexes of `Ticket`."""
+    def test_uuid_unique(self):
+        """Two tickets cannot share the same UUID."""
+        ticket = models.Ticket.objects.create()
+        with self.assertRaises(IntegrityError):
+            models.Ticket.objects.create(uuid=ticket.uuid)
+
+    def test_lookup_uses_index(self):
+        """Lookup by (uuid, place, purpose) does not scan the table."""
+        for x in range(50):
+            models.Ticket.objects.create(place='louvre', purpose='visit')
+        ticket = models.Ticket.objects.create(place='louvre',
+                                              purpose='visit')
+        if connection.vendor == 'postgresql':
+            # Tiny tables are cheaper to scan: disable sequential scans so
+            # that the plan tells whether an index is usable.
+            with connection.cursor() as cursor:
+                cursor.execute('SET LOCAL enable_seqscan = off')
+        plan = models.Ticket.objects.filter(uuid=ticket.uuid,
+                                            place='louvre',
+                                            purpose='visit').explain()
+        self.assertIn('index', plan.lower())
+
+    def test_expired_uses_partial_index(self):
+        """Lookup of expired tickets uses partial index on expiry."""
+        for x in range(50):
+            models.Ticket.objects.create()
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute('SET LOCAL enable_seqscan = off')
+        plan = models.Ticket.objects.expired().explain()
+        self.assertIn('ticket_expiry_idx', plan)
+
+    def test_single_column_indexes_dropped(self):
+        """Migrations drop single-column indexes replaced by composite ones."""
+        with connection.cursor() as cursor:
+            constraints = connection.introspection.get_constraints(
+                cursor, models.Ticket._meta.db_table)
+        declared = [index.name for index in models.Ticket._meta.indexes]
+        indexed = [info['columns'] for name, info in constraints.items()
+                   if info['index'] and not info['unique']
+                   and name not in declared]
+        for column in ['place', 'purpose', 'expiry_datetime',
+                       'usage_datetime']:
+            self.assertNotIn([column], indexed)
+        for name in declared:
+            self.assertIn(name, constraints)
+
+    def test_benchmarks(self):
+        """Insert and cleanup benchmarks return time per ticket."""
+        self.assertEqual(list(benchmarks.bench_insert(10)), ['bulk_create'])
+        self.assertEqual(list(benchmarks.bench_cleanup(10)),
+                         ['clean_tickets'])
+        self.assertEqual(models.Ticket.objects.count(), 0)
+
 
 class TicketAuthenticationFormTestCase(unittest.TestCase):
     """Test suite around
@@ -200,7 +856,6 @@ class InvitationRequiredTestCase(unittest.TestCase):
         decorator = decorators.invitation_required(
             place=place,
             purpose=purpose)
-        decorator.ticket = invitation
         # Check result when session is empty.
         self.request.session = {}
         with self.assertRaises(exceptions.NoTicketError):
@@ -214,18 +869,19 @@ class InvitationRequiredTestCase(unittest.TestCase):
         with self.assertRaises(exceptions.CredentialsError):
             decorator.get_ticket_from_session(self.request)
         # Check result when invitation is in both session and DB.
-        backup = models.Ticket.objects.get
+        backup = models.Ticket.objects.get_cached
         try:
-            models.Ticket.objects.get = mock.Mock(return_value=invitation)
+            models.Ticket.objects.get_cached = mock.Mock(
+                return_value=invitation)
             instance = decorator.get_ticket_from_session(self.request)
             self.assertIs(instance, invitation)
-            models.Ticket.objects.get.assert_called_once_with(
-                uuid=fake_uuid,
+            models.Ticket.objects.get_cached.assert_called_once_with(
+                fake_uuid,
                 place=place,
                 purpose=purpose,
             )
         finally:
-            models.Ticket.objects.get = backup
+            models.Ticket.objects.get_cached = backup
 
     def test_redirect_session(self):
         """invitation_required() stores invitation UUID in session."""
@@ -237,9 +893,8 @@ class InvitationRequiredTestCase(unittest.TestCase):
         decorator = decorators.invitation_required(
             place=place,
             purpose=purpose)
-        decorator.ticket = invitation
         self.request.session = {}
-        decorator.redirect(self.request)
+        decorator.redirect(self.request, invitation)
         self.assertEqual(self.request.session['invitation'], str(fake_uuid))
 
     def test_valid_invitation_in_session(self):
@@ -277,7 +932,7 @@ class InvitationRequiredTestCase(unittest.TestCase):
         # Setup:
         #
         # * fake invitation uuid in session
-        # * Ticket.objects.get() returns expired ticket.
+        # * Ticket.objects.get_for_validation() returns expired ticket.
         place = 'louvre'
         purpose = 'visit'
         fake_uuid = uuid.uuid4()
@@ -308,11 +963,11 @@ class InvitationRequiredTestCase(unittest.TestCase):
         # Setup:
         #
         # * fake invitation in session
-        # * Ticket.objects.get() raises DoesNotExist.
+        # * Ticket.objects.get_cached() raises DoesNotExist.
         fake_uuid = uuid.uuid4()
         self.request.session = {'invitation': str(fake_uuid)}
         manager_mock = mock.Mock()
-        manager_mock.get = mock.Mock(
+        manager_mock.get_cached = mock.Mock(
             side_effect=models.Ticket.DoesNotExist)
         ticket_mock = mock.Mock()
         ticket_mock.objects = manager_mock
@@ -345,7 +1000,7 @@ class InvitationRequiredTestCase(unittest.TestCase):
         form_mock.cleaned_data = {'uuid': str(fake_uuid), 'password': password}
         form_class_mock = mock.Mock(return_value=form_mock)
         manager_mock = mock.Mock()
-        manager_mock.get = mock.Mock(return_value=invitation)
+        manager_mock.get_for_validation = mock.Mock(return_value=invitation)
         ticket_mock = mock.Mock()
         ticket_mock.objects = manager_mock
         with mock.patch('django_ticketoffice.decorators.Ticket',
@@ -394,6 +1049,35 @@ class InvitationRequiredTestCase(unittest.TestCase):
         self.assertFalse(self.authorized_view.called)
         self.assertFalse(self.forbidden_view.called)
 
+    def test_concurrent_requests(self):
+        "invitation_required() isolates requests running in threads."
+        thread_count = 8
+        barrier = threading.Barrier(thread_count)
+        decorator = decorators.invitation_required(place='', purpose='')
+
+        class Session(dict):
+            def __contains__(self, key):
+                # All requests got their ticket, none logged in yet.
+                barrier.wait()
+                return super().__contains__(key)
+
+        decorator.get_ticket_from_credentials = \
+            lambda request: request.expected_ticket
+        decorated_view = decorator(lambda request: request.invitation)
+        for run in range(5):
+            requests = []
+            for x in range(thread_count):
+                request = mock.Mock()
+                request.session = Session(invitation='in session')
+                request.expected_ticket = models.Ticket(uuid=uuid.uuid4())
+                requests.append(request)
+            with ThreadPoolExecutor(max_workers=thread_count) as executor:
+                responses = list(executor.map(decorated_view, requests))
+            for request, response in zip(requests, responses):
+                self.assertIs(response, request.expected_ticket)
+                self.assertIs(request.user.invitation,
+                              request.expected_ticket)
+
     def test_run_credentials_error(self):
         """invitation_required.run() calls forbidden() if CredentialsError."""
         decorator = decorators.invitation_required(place='', purpose='')
@@ -430,6 +1114,854 @@ class InvitationRequiredTestCase(unittest.TestCase):
         decorator.forbidden.assert_called_once_with('fake request')
 
 
+class StampInvitationTestCase(django.test.TestCase):
+    "Tests around :func:`django_ticketoffice.decorators.stamp_invitation`."
+    def setUp(self):
+        super().setUp()
+        self.ticket = models.Ticket.objects.create()
+        self.request = mock.MagicMock()
+        self.request.invitation = self.ticket
+        self.forbidden_view = mock.Mock(return_value=mock.sentinel.forbidden)
+        patcher = mock.patch('django_ticketoffice.decorators.forbidden_view',
+                             new=self.forbidden_view)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_stamp(self):
+        """stamp_invitation() uses ticket after view execution."""
+        view = mock.Mock(return_value=mock.sentinel.response)
+        response = decorators.stamp_invitation(view)(self.request)
+        self.assertEqual(response, mock.sentinel.response)
+        view.assert_called_once_with(self.request)
+        self.assertTrue(models.Ticket.objects.get(pk=self.ticket.pk).used)
+
+    def concurrent_view(self, request):
+        # Concurrent request uses the ticket during view execution.
+        models.Ticket.objects.consume(self.ticket.uuid)
+        models.Ticket.objects.create(place='created-by-view')
+        return mock.sentinel.response
+
+    def test_concurrent_use(self):
+        """stamp_invitation() returns forbidden if ticket was used meanwhile.
+
+        View's changes are kept.
+
+        """
+        view = decorators.stamp_invitation(self.concurrent_view)
+        self.assertEqual(view(self.request), mock.sentinel.forbidden)
+        self.forbidden_view.assert_called_once_with(self.request)
+        self.assertTrue(
+            models.Ticket.objects.filter(place='created-by-view').exists())
+
+    def test_atomic(self):
+        """stamp_invitation(atomic=True) rolls back view if ticket was used
+        meanwhile."""
+        view = decorators.stamp_invitation(atomic=True)(self.concurrent_view)
+        self.assertEqual(view(self.request), mock.sentinel.forbidden)
+        self.forbidden_view.assert_called_once_with(self.request)
+        self.assertFalse(
+            models.Ticket.objects.filter(place='created-by-view').exists())
+
+    def test_atomic_coroutine(self):
+        """stamp_invitation(atomic=True) rejects coroutine views."""
+        async def view(request):
+            return mock.sentinel.response
+
+        with self.assertRaises(ValueError):
+            decorators.stamp_invitation(atomic=True)(view)
+
+
+class MultiUseInvitationTestCase(django.test.TestCase):
+    """Test suite around decorators and multi-use tickets."""
+    def test_stamp_invitation(self):
+        """stamp_invitation uses one of ticket's uses per request."""
+        ticket, password = models.Ticket.objects.issue(
+            place='louvre', purpose='visit', max_uses=2)
+        remaining_uses = []
+
+        def view(request):
+            remaining_uses.append(request.invitation.remaining_uses)
+            return mock.sentinel.response
+
+        decorated_view = decorators.invitation_required(
+            place='louvre', purpose='visit')(
+            decorators.stamp_invitation(view))
+        factory = django.test.RequestFactory()
+        with mock.patch('django_ticketoffice.decorators.forbidden_view',
+                        return_value=mock.sentinel.forbidden):
+            for expected in (mock.sentinel.response, mock.sentinel.response,
+                             mock.sentinel.forbidden):
+                request = factory.get('/')
+                request.session = {'invitation': str(ticket.uuid)}
+                self.assertEqual(decorated_view(request), expected)
+        self.assertEqual(remaining_uses, [2, 1])
+
+
+@mock.patch('django_ticketoffice.settings'
+            '.TICKETOFFICE_SESSION_SNAPSHOT_MAX_AGE', new=60)
+class SessionSnapshotTestCase(django.test.TestCase):
+    """Tests around ticket snapshots in session."""
+    def setUp(self):
+        super().setUp()
+        self.ticket = models.Ticket.objects.create(
+            place='louvre', purpose='visit',
+            expiry_datetime=now() + timedelta(days=2))
+        self.decorator = decorators.invitation_required(place='louvre',
+                                                        purpose='visit')
+        self.request = mock.MagicMock()
+        self.request.path = '/'
+        self.request.GET = {}
+        self.request.session = {}
+
+    def test_snapshot(self):
+        """Ticket in session is validated from snapshot, without query."""
+        self.decorator.redirect(self.request, self.ticket)
+        self.assertIn(decorators.SNAPSHOT_SESSION_KEY, self.request.session)
+        with self.assertNumQueries(0):
+            ticket = self.decorator.get_ticket_from_session(self.request)
+        self.assertEqual(ticket.pk, self.ticket.pk)
+        self.assertEqual(ticket.uuid, self.ticket.uuid)
+        self.assertEqual(ticket.expiry_datetime, self.ticket.expiry_datetime)
+        self.assertTrue(ticket.is_valid())
+
+    def test_no_snapshot(self):
+        """Ticket read from database is snapshot in session."""
+        self.request.session['invitation'] = str(self.ticket.uuid)
+        with self.assertNumQueries(1):
+            self.decorator.get_ticket_from_session(self.request)
+        with self.assertNumQueries(0):
+            self.decorator.get_ticket_from_session(self.request)
+
+    def test_stale_snapshot(self):
+        """Snapshots older than max age are ignored."""
+        self.decorator.redirect(self.request, self.ticket)
+        with mock.patch('django_ticketoffice.settings'
+                        '.TICKETOFFICE_SESSION_SNAPSHOT_MAX_AGE', new=-1):
+            with self.assertNumQueries(1):
+                self.decorator.get_ticket_from_session(self.request)
+
+    def test_tampered_snapshot(self):
+        """Snapshots with wrong signature are ignored."""
+        self.request.session['invitation'] = str(self.ticket.uuid)
+        self.request.session[decorators.SNAPSHOT_SESSION_KEY] = 'tampered'
+        with self.assertNumQueries(1):
+            self.decorator.get_ticket_from_session(self.request)
+
+    def test_other_purpose(self):
+        """Snapshots are only valid for their place and purpose."""
+        self.decorator.redirect(self.request, self.ticket)
+        decorator = decorators.invitation_required(place='louvre',
+                                                   purpose='paint')
+        with self.assertRaises(exceptions.CredentialsError):
+            decorator.get_ticket_from_session(self.request)
+
+    def test_multi_use(self):
+        """Multi-use tickets are not snapshot: usage count is read from
+        database, where other processes use the ticket too."""
+        ticket = models.Ticket.objects.create(place='louvre', purpose='visit',
+                                              max_uses=3)
+        self.request.session['invitation'] = str(ticket.uuid)
+        self.assertEqual(
+            self.decorator.get_ticket_from_session(self.request).use_count, 0)
+        self.assertNotIn(decorators.SNAPSHOT_SESSION_KEY,
+                         self.request.session)
+        # Another process uses the ticket between requests.
+        models.Ticket.objects.filter(pk=ticket.pk).update(use_count=2)
+        with self.assertNumQueries(1):
+            ticket = self.decorator.get_ticket_from_session(self.request)
+        self.assertEqual(ticket.remaining_uses, 1)
+        # Snapshots stored by previous versions are ignored.
+        self.request.session[decorators.SNAPSHOT_SESSION_KEY] = \
+            decorators.make_snapshot(ticket)
+        with self.assertNumQueries(1):
+            self.decorator.get_ticket_from_session(self.request)
+
+    def test_stamp_removes_snapshot(self):
+        """stamp_invitation() removes snapshot from session."""
+        self.decorator.redirect(self.request, self.ticket)
+        self.request.invitation = self.ticket
+        view = mock.Mock(return_value=mock.sentinel.response)
+        decorators.stamp_invitation(view)(self.request)
+        self.assertNotIn(decorators.SNAPSHOT_SESSION_KEY,
+                         self.request.session)
+        with self.assertRaises(exceptions.TicketUsedError):
+            self.decorator.get_ticket(self.request)
+
+
+class TokenTestCase(django.test.TestCase):
+    """Test suite around `django_ticketoffice.tokens`."""
+    def setUp(self):
+        super().setUp()
+        caches['default'].clear()
+        self.ticket = models.Ticket.objects.create(
+            place='louvre', purpose='visit', data={'user': 42},
+            expiry_datetime=now() + timedelta(days=1))
+        self.factory = django.test.RequestFactory()
+        self.forbidden_view = mock.Mock(return_value=mock.sentinel.forbidden)
+        patcher = mock.patch('django_ticketoffice.decorators.forbidden_view',
+                             new=self.forbidden_view)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def decorate(self, view, place='louvre'):
+        return decorators.invitation_required(place=place, purpose='visit',
+                                              tokens=True)(view)
+
+    def test_load_token(self):
+        """load_token() returns ticket without query."""
+        token = tokens.make_token(self.ticket)
+        with self.assertNumQueries(0):
+            ticket = tokens.load_token(token)
+        self.assertEqual(ticket, self.ticket)
+        self.assertEqual(ticket.uuid, self.ticket.uuid)
+        self.assertEqual(ticket.expiry_datetime,
+                         self.ticket.expiry_datetime.replace(microsecond=0))
+        with self.assertNumQueries(1):
+            self.assertEqual(ticket.data, {'user': 42})
+
+    def test_invalid_token(self):
+        """load_token() raises CredentialsError if token was tampered."""
+        token = tokens.make_token(self.ticket)
+        with self.assertRaises(exceptions.CredentialsError):
+            tokens.load_token(token[:-1])
+        with self.assertRaises(exceptions.CredentialsError):
+            tokens.load_token(signing.dumps([1, 2], salt=tokens.TOKEN_SALT))
+
+    def test_revoke(self):
+        """revoke() invalidates tokens made so far for place and purpose."""
+        token = tokens.make_token(self.ticket)
+        other = models.Ticket.objects.create(place='orsay', purpose='visit')
+        other_token = tokens.make_token(other)
+        self.assertEqual(tokens.revoke('louvre', 'visit'), 1)
+        with self.assertRaises(exceptions.CredentialsError):
+            tokens.load_token(token)
+        tokens.load_token(other_token)
+        tokens.load_token(tokens.make_token(self.ticket))
+        self.assertEqual(tokens.revoke('louvre', 'visit'), 2)
+
+    def test_revoke_durable(self):
+        """Revocations are stored in database, cache is read through."""
+        token = tokens.make_token(self.ticket)
+        tokens.revoke('louvre', 'visit')
+        caches['default'].clear()
+        with self.assertNumQueries(1):
+            with self.assertRaises(exceptions.CredentialsError):
+                tokens.load_token(token)
+        with self.assertNumQueries(0):
+            with self.assertRaises(exceptions.CredentialsError):
+                tokens.load_token(token)
+        self.assertEqual(models.TokenGeneration.objects.get(
+            place='louvre', purpose='visit').generation, 1)
+
+    def test_invitation_required(self):
+        """invitation_required(tokens=True) runs view without query."""
+        view = self.decorate(lambda request: request.invitation)
+        request = self.factory.get(
+            '/', {'token': tokens.make_token(self.ticket)})
+        request.session = {}
+        with self.assertNumQueries(0):
+            self.assertEqual(view(request), self.ticket)
+        self.assertEqual(request.session, {})
+
+    def test_invitation_required_forbidden(self):
+        """invitation_required rejects tokens of other places, or expired."""
+        view = self.decorate(lambda request: request.invitation,
+                             place='orsay')
+        request = self.factory.get(
+            '/', {'token': tokens.make_token(self.ticket)})
+        request.session = {}
+        self.assertEqual(view(request), mock.sentinel.forbidden)
+        self.ticket.expiry_datetime = now() - timedelta(days=1)
+        self.ticket.save()
+        view = self.decorate(lambda request: request.invitation)
+        request = self.factory.get(
+            '/', {'token': tokens.make_token(self.ticket)})
+        request.session = {}
+        self.assertEqual(view(request), mock.sentinel.forbidden)
+
+    def test_tokens_disabled(self):
+        """invitation_required ignores tokens by default."""
+        view = decorators.invitation_required(place='louvre',
+                                              purpose='visit')(mock.Mock())
+        request = self.factory.get(
+            '/', {'token': tokens.make_token(self.ticket)})
+        request.session = {}
+        self.assertEqual(view(request), mock.sentinel.forbidden)
+
+    def test_stamp_invitation(self):
+        """stamp_invitation consumes tickets of tokens."""
+        view = self.decorate(decorators.stamp_invitation(
+            lambda request: mock.sentinel.response))
+        token = tokens.make_token(self.ticket)
+        request = self.factory.get('/', {'token': token})
+        request.session = {}
+        self.assertEqual(view(request), mock.sentinel.response)
+        request = self.factory.get('/', {'token': token})
+        request.session = {}
+        self.assertEqual(view(request), mock.sentinel.forbidden)
+
+
+class AsyncInvitationTestCase(django.test.TestCase):
+    """Tests around decorators applied to coroutine views."""
+    def setUp(self):
+        super().setUp()
+        self.ticket = models.Ticket.objects.create(place='louvre',
+                                                   purpose='visit')
+        self.ticket.set_password('secret')
+        self.ticket.save()
+        self.factory = django.test.RequestFactory()
+        self.forbidden_view = mock.Mock(return_value=mock.sentinel.forbidden)
+        patcher = mock.patch('django_ticketoffice.decorators.forbidden_view',
+                             new=self.forbidden_view)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def decorate(self, view):
+        return decorators.invitation_required(place='louvre',
+                                              purpose='visit')(view)
+
+    def test_coroutine_function(self):
+        """Decorators return coroutine functions for coroutine views."""
+        async def view(request):
+            pass
+
+        def sync_view(request):
+            pass
+
+        self.assertTrue(asyncio.iscoroutinefunction(self.decorate(view)))
+        self.assertTrue(asyncio.iscoroutinefunction(
+            decorators.stamp_invitation(view)))
+        self.assertFalse(asyncio.iscoroutinefunction(
+            self.decorate(sync_view)))
+
+    async def test_invitation_flow(self):
+        """invitation_required() validates credentials, then session."""
+        async def view(request):
+            return request.invitation
+
+        decorated_view = self.decorate(view)
+        request = self.factory.get('/', {'uuid': str(self.ticket.uuid),
+                                         'password': 'secret'})
+        request.session = {}
+        response = await decorated_view(request)
+        self.assertEqual(response.status_code, 302)
+        request = self.factory.get('/')
+        request.session = {'invitation': str(self.ticket.uuid)}
+        response = await decorated_view(request)
+        self.assertEqual(response, self.ticket)
+
+    async def test_wrong_password(self):
+        """invitation_required() returns forbidden if password is wrong."""
+        async def view(request):
+            return request.invitation
+
+        decorated_view = self.decorate(view)
+        decorated_view.forbidden = mock.Mock(
+            return_value=mock.sentinel.forbidden)
+        request = self.factory.get('/', {'uuid': str(self.ticket.uuid),
+                                         'password': 'wrong'})
+        request.session = {}
+        response = await decorated_view(request)
+        self.assertEqual(response, mock.sentinel.forbidden)
+
+    async def test_stamp_invitation(self):
+        """stamp_invitation() consumes ticket after coroutine view."""
+        async def view(request):
+            return mock.sentinel.response
+
+        decorated_view = decorators.stamp_invitation(view)
+        request = self.factory.get('/')
+        request.session = {}
+        request.invitation = self.ticket
+        self.assertEqual(await decorated_view(request),
+                         mock.sentinel.response)
+        self.assertTrue(self.ticket.used)
+        # Stale copy of ticket, as loaded by a concurrent request.
+        request.invitation = models.Ticket(pk=self.ticket.pk,
+                                           uuid=self.ticket.uuid,
+                                           place='louvre', purpose='visit')
+        self.assertEqual(await decorated_view(request),
+                         mock.sentinel.forbidden)
+
+    async def test_aauthenticate(self):
+        """Ticket.aauthenticate() verifies password."""
+        self.assertTrue(await self.ticket.aauthenticate('secret'))
+        self.assertFalse(await self.ticket.aauthenticate('wrong'))
+
+
+@mock.patch('django_ticketoffice.settings.TICKETOFFICE_METRICS',
+            new='django_ticketoffice.metrics.Registry')
+class MetricsTestCase(django.test.TestCase):
+    """Test suite around `django_ticketoffice.metrics`."""
+    def setUp(self):
+        super().setUp()
+        self.registry = metrics.get_backend(
+            'django_ticketoffice.metrics.Registry')
+        self.registry.clear()
+
+    def counter(self, name, **labels):
+        return self.registry.counters.get(
+            (name, tuple(sorted(labels.items()))), 0)
+
+    def test_disabled(self):
+        """Metrics are not recorded without backend."""
+        with mock.patch('django_ticketoffice.settings.TICKETOFFICE_METRICS',
+                        new=None):
+            metrics.metrics.increment('foo')
+            with metrics.metrics.timer('bar'):
+                pass
+        self.assertEqual(self.registry.counters, {})
+        self.assertEqual(self.registry.histograms, {})
+
+    def test_render(self):
+        """Registry renders counters and histograms for Prometheus."""
+        self.registry.increment('requests_total', 2, {'outcome': 'a"b'})
+        self.registry.observe('latency_seconds', 0.003, {})
+        self.registry.observe('latency_seconds', 20, {})
+        text = self.registry.render()
+        self.assertIn('# TYPE requests_total counter\n', text)
+        self.assertIn('requests_total{outcome="a\\"b"} 2\n', text)
+        self.assertIn('# TYPE latency_seconds histogram\n', text)
+        self.assertIn('latency_seconds_bucket{le="0.001"} 0\n', text)
+        self.assertIn('latency_seconds_bucket{le="0.005"} 1\n', text)
+        self.assertIn('latency_seconds_bucket{le="10"} 1\n', text)
+        self.assertIn('latency_seconds_bucket{le="+Inf"} 2\n', text)
+        self.assertIn('latency_seconds_count 2\n', text)
+
+    def test_authenticate(self):
+        """TicketManager.authenticate() counts outcomes, times hashing."""
+        manager = models.Ticket.objects
+        ticket = manager.create()
+        ticket.set_password('secret')
+        ticket.save()
+        manager.authenticate(ticket.uuid, 'secret')
+        with self.assertRaises(exceptions.CredentialsError):
+            manager.authenticate(ticket.uuid, 'wrong')
+        self.assertEqual(self.counter(metrics.AUTHENTICATIONS,
+                                      outcome='valid'), 1)
+        self.assertEqual(self.counter(metrics.AUTHENTICATIONS,
+                                      outcome='credentials'), 1)
+        self.assertEqual(
+            self.registry.histograms[metrics.HASH_SECONDS, ()]['count'], 2)
+        self.assertEqual(
+            self.registry.histograms[metrics.LOOKUP_SECONDS, ()]['count'], 2)
+        manager.authenticate_many([(ticket.uuid, 'secret'),
+                                   (ticket.uuid, 'wrong')])
+        self.assertEqual(self.counter(metrics.AUTHENTICATIONS,
+                                      outcome='credentials'), 2)
+        self.assertEqual(
+            self.registry.histograms[metrics.HASH_SECONDS, ()]['count'], 4)
+
+    def test_invitation_required(self):
+        """invitation_required counts outcomes."""
+        view = decorators.invitation_required(place='louvre',
+                                              purpose='visit')(mock.Mock())
+        request = django.test.RequestFactory().get('/')
+        request.session = {}
+        view(request)
+        self.assertEqual(self.counter(metrics.INVITATIONS,
+                                      outcome='no_ticket'), 1)
+
+    def test_cleanup(self):
+        """delete_in_batches() counts deleted tickets."""
+        for x in range(3):
+            models.Ticket.objects.create()
+        list(models.Ticket.objects.all().delete_in_batches(2))
+        self.assertEqual(self.counter(metrics.CLEANED), 3)
+        self.assertEqual(
+            self.registry.histograms[metrics.CLEANUP_BATCH_SECONDS,
+                                     ()]['count'],
+            2)
+
+    def test_view(self):
+        """metrics_view renders registry, or 404 without registry."""
+        self.registry.increment('requests_total', 1, {})
+        request = django.test.RequestFactory().get('/metrics')
+        response = views.metrics_view(request)
+        self.assertEqual(response.content, self.registry.render().encode())
+        with mock.patch('django_ticketoffice.settings.TICKETOFFICE_METRICS',
+                        new=None):
+            with self.assertRaises(Http404):
+                views.metrics_view(request)
+
+
+class InvitationView(views.InvitationMixin, View):
+    def get(self, request):
+        return HttpResponse(self.invitation.place)
+
+
+class QueryBudgetTestCase(django.test.TestCase):
+    """Number of queries of public paths, for valid tickets."""
+    def setUp(self):
+        super().setUp()
+        self.ticket = models.Ticket.objects.create(place='louvre',
+                                                   purpose='visit')
+        self.ticket.set_password('secret')
+        self.ticket.save()
+        self.factory = django.test.RequestFactory()
+        self.view = decorators.invitation_required(
+            place='louvre', purpose='visit')(
+            decorators.stamp_invitation(InvitationView.as_view()))
+
+    def test_authenticate(self):
+        """TicketManager.authenticate(): 1 query."""
+        with self.assertNumQueries(1):
+            models.Ticket.objects.authenticate(
+                self.ticket.uuid, 'secret', place='louvre', purpose='visit')
+
+    def test_issue(self):
+        """TicketManager.issue(): 1 query."""
+        with self.assertNumQueries(1):
+            models.Ticket.objects.issue()
+
+    def test_bulk_issue(self):
+        """TicketManager.bulk_issue(): 1 query per batch."""
+        with self.assertNumQueries(2):
+            list(models.Ticket.objects.bulk_issue(3, batch_size=2))
+
+    def test_consume(self):
+        """Ticket.consume(): 1 query."""
+        with self.assertNumQueries(1):
+            self.assertTrue(self.ticket.consume())
+
+    def test_credentials(self):
+        """invitation_required with credentials: 1 query."""
+        request = self.factory.get('/', {'uuid': str(self.ticket.uuid),
+                                         'password': 'secret'})
+        request.session = {}
+        with self.assertNumQueries(1):
+            response = self.view(request)
+        self.assertEqual(response.status_code, 302)
+
+    def test_session(self):
+        """invitation_required, InvitationMixin and stamp_invitation with
+        session: 1 query to load ticket, 1 to use it."""
+        request = self.factory.get('/')
+        request.session = {'invitation': str(self.ticket.uuid)}
+        with self.assertNumQueries(2):
+            response = self.view(request)
+        self.assertEqual(response.content, b'louvre')
+
+    def test_session_snapshot(self):
+        """With session snapshots, ticket is not loaded from database."""
+        request = self.factory.get('/')
+        request.session = {
+            'invitation': str(self.ticket.uuid),
+            decorators.SNAPSHOT_SESSION_KEY:
+                decorators.make_snapshot(self.ticket),
+        }
+        with mock.patch('django_ticketoffice.settings'
+                        '.TICKETOFFICE_SESSION_SNAPSHOT_MAX_AGE', new=60):
+            with self.assertNumQueries(1):
+                response = self.view(request)
+        self.assertEqual(response.content, b'louvre')
+
+
+class TicketQueryReportMiddlewareTestCase(django.test.TestCase):
+    """Test suite around `TicketQueryReportMiddleware`."""
+    def test_report(self):
+        """Middleware reports tickets' queries and hashes in header."""
+        ticket = models.Ticket.objects.create(place='louvre',
+                                              purpose='visit')
+        ticket.set_password('secret')
+        ticket.save()
+        view = decorators.invitation_required(
+            place='louvre', purpose='visit')(InvitationView.as_view())
+        request = django.test.RequestFactory().get(
+            '/', {'uuid': str(ticket.uuid), 'password': 'secret'})
+        request.session = {}
+        middleware = TicketQueryReportMiddleware(view)
+        response = middleware(request)
+        report = response[TicketQueryReportMiddleware.header]
+        self.assertTrue(report.startswith('queries=1 (default=1); '), report)
+        self.assertIn('; hashes=1; ', report)
+        self.assertIsNone(metrics.collector.get())
+
+
+@mock.patch('django_ticketoffice.settings.TICKETOFFICE_READ_DATABASES',
+            new=['replica'])
+@django.test.override_settings(
+    DATABASE_ROUTERS=['django_ticketoffice.routers.TicketRouter'])
+class TicketRouterTestCase(django.test.TestCase):
+    """Test suite around `django_ticketoffice.routers`."""
+    def setUp(self):
+        super().setUp()
+        self.router = routers.TicketRouter()
+        token = routers.pinned_until.set(0)
+        self.addCleanup(routers.pinned_until.reset, token)
+
+    def test_db_for_read(self):
+        """Reads of tickets go to replicas, other models are not routed."""
+        self.assertEqual(self.router.db_for_read(models.Ticket), 'replica')
+        self.assertIsNone(self.router.db_for_read(Session))
+        with mock.patch('django_ticketoffice.settings'
+                        '.TICKETOFFICE_READ_DATABASES', new=[]):
+            self.assertEqual(self.router.db_for_read(models.Ticket),
+                             'default')
+
+    def test_read_after_write(self):
+        """Reads go to primary database for a while after writes."""
+        self.assertEqual(
+            self.router.db_for_write(models.Ticket, read_fallback=True),
+            'default')
+        self.assertEqual(self.router.db_for_read(models.Ticket), 'replica')
+        self.assertEqual(self.router.db_for_write(models.Ticket), 'default')
+        self.assertEqual(self.router.db_for_read(models.Ticket), 'default')
+        with mock.patch('django_ticketoffice.settings'
+                        '.TICKETOFFICE_READ_AFTER_WRITE_SECONDS', new=0):
+            self.router.db_for_write(models.Ticket)
+        self.assertEqual(self.router.db_for_read(models.Ticket), 'replica')
+
+    def test_requests_unpinned(self):
+        """Pins of a request do not leak to next requests of the thread."""
+        # Keep tests' transaction open, as Django's test client does.
+        for signal in (request_started, request_finished):
+            signal.disconnect(close_old_connections)
+            self.addCleanup(signal.connect, close_old_connections)
+        request_started.send(sender=WSGIHandler, environ={})
+        self.router.db_for_write(models.Ticket)
+        self.assertEqual(self.router.db_for_read(models.Ticket), 'default')
+        request_finished.send(sender=WSGIHandler)
+        # Next request served by the same thread.
+        request_started.send(sender=WSGIHandler, environ={})
+        self.assertEqual(self.router.db_for_read(models.Ticket), 'replica')
+        self.router.db_for_write(models.Ticket)
+        # Requests which fail before request_finished do not leak either.
+        request_started.send(sender=WSGIHandler, environ={})
+        self.assertEqual(self.router.db_for_read(models.Ticket), 'replica')
+
+    @mock.patch('django_ticketoffice.settings.TICKETOFFICE_READ_DATABASES',
+                new=[])
+    def test_deferred_fields(self):
+        """Routing does not load deferred fields of tickets."""
+        ticket = models.Ticket.objects.create(place='louvre',
+                                              data={'a': 1})
+        self.assertEqual(
+            models.Ticket.objects.only('id').get(pk=ticket.pk).place,
+            'louvre')
+        self.assertEqual(
+            models.Ticket.objects.only('uuid').get(pk=ticket.pk).data,
+            {'a': 1})
+
+    def test_validation_databases(self):
+        """Validation lookups fall back to primary database on miss."""
+        queryset = models.Ticket.objects.all()
+        self.assertEqual(queryset.validation_databases(),
+                         ['replica', 'default'])
+        self.assertEqual(queryset.using('other').validation_databases(),
+                         ['other'])
+        with mock.patch('django_ticketoffice.settings'
+                        '.TICKETOFFICE_REPLICA_FALLBACK', new=False):
+            self.assertEqual(queryset.validation_databases(), ['replica'])
+        self.assertEqual(routers.pinned_until.get(), 0)
+
+    def test_get_for_validation(self):
+        """Tickets missing from first database are looked up in next one."""
+        ticket = models.Ticket.objects.using('default').create()
+        with mock.patch.object(managers.TicketQuerySet,
+                               'validation_databases',
+                               return_value=['default', 'default']):
+            with self.assertNumQueries(1):
+                self.assertEqual(
+                    models.Ticket.objects.get_for_validation(uuid=ticket.uuid),
+                    ticket)
+            with self.assertNumQueries(4):
+                with self.assertRaises(models.Ticket.DoesNotExist):
+                    models.Ticket.objects.get_for_validation(
+                        uuid=uuid.uuid4())
+
+
+@mock.patch('django_ticketoffice.settings.TICKETOFFICE_SHARDS',
+            new=['shard1', 'shard2'])
+class ShardingTestCase(django.test.TransactionTestCase):
+    """Test suite around `django_ticketoffice.sharding`, on SQLite shards.
+
+    Default database only holds views' changes, see `stamp_invitation`.
+
+    """
+    databases = {'default', 'shard1', 'shard2'}
+
+    def tearDown(self):
+        self.assertFalse(models.Ticket.objects.using('default').exists())
+        super().tearDown()
+
+    def get_place(self, shard):
+        """Return a place whose tickets are stored in ``shard``."""
+        return next(place for place in (f'place{x}' for x in range(100))
+                    if sharding.get_shard(place) == shard)
+
+    def test_get_shard(self):
+        """Shard is a stable hash of place or UUID, None if disabled."""
+        self.assertIn(sharding.get_shard('louvre'), ['shard1', 'shard2'])
+        self.assertEqual({sharding.get_shard(f'place{x}')
+                          for x in range(10)}, {'shard1', 'shard2'})
+        self.assertIsNone(sharding.get_shard(uuid=uuid.uuid4()))
+        ticket_uuid = uuid.uuid4()
+        with mock.patch('django_ticketoffice.settings'
+                        '.TICKETOFFICE_SHARD_KEY', new='uuid'):
+            self.assertEqual(sharding.get_shard(uuid=ticket_uuid),
+                             sharding.get_shard('other', str(ticket_uuid)))
+            self.assertIsNone(sharding.get_shard('louvre'))
+        with mock.patch('django_ticketoffice.settings'
+                        '.TICKETOFFICE_SHARDS', new=[]):
+            self.assertIsNone(sharding.get_shard('louvre'))
+
+    def test_ticket_lifecycle(self):
+        """Tickets are issued, authenticated and consumed on their shard."""
+        manager = models.Ticket.objects
+        for shard, other in [('shard1', 'shard2'), ('shard2', 'shard1')]:
+            place = self.get_place(shard)
+            ticket, password = manager.issue(place=place, max_uses=2)
+            self.assertTrue(
+                manager.using(shard).filter(pk=ticket.pk).exists())
+            self.assertFalse(
+                manager.using(other).filter(uuid=ticket.uuid).exists())
+            self.assertEqual(
+                manager.authenticate(ticket.uuid, password, place=place),
+                ticket)
+            self.assertTrue(ticket.consume())
+            self.assertEqual(ticket.use_count, 1)
+            self.assertTrue(manager.consume(ticket.uuid, place=place))
+            with self.assertRaises(exceptions.TicketUsedError):
+                manager.authenticate(ticket.uuid, password, place=place)
+
+    def test_lookup_without_shard_key(self):
+        """Lookups by UUID only, e.g. of InvitationMixin, try all shards."""
+        ticket = models.Ticket.objects.issue(
+            place=self.get_place('shard2'))[0]
+        self.assertEqual(models.Ticket.objects.get_for_validation(
+            uuid=ticket.uuid), ticket)
+        with self.assertRaises(models.Ticket.DoesNotExist):
+            models.Ticket.objects.get_for_validation(uuid=uuid.uuid4())
+
+    @mock.patch('django_ticketoffice.settings.TICKETOFFICE_SHARD_KEY',
+                new='uuid')
+    def test_bulk_issue(self):
+        """bulk_issue() spreads tickets across shards by UUID."""
+        manager = models.Ticket.objects
+        issued = list(manager.bulk_issue(20, place='louvre'))
+        self.assertEqual(manager.using('shard1').count()
+                         + manager.using('shard2').count(), 20)
+        self.assertTrue(manager.using('shard1').exists())
+        self.assertTrue(manager.using('shard2').exists())
+        for ticket_uuid, password in issued:
+            manager.authenticate(ticket_uuid, password, place='louvre')
+
+    def test_authenticate_many(self):
+        """authenticate_many() looks tickets up on all shards by UUID."""
+        manager = models.Ticket.objects
+        with mock.patch('django_ticketoffice.settings'
+                        '.TICKETOFFICE_SHARD_KEY', new='uuid'):
+            issued = list(manager.bulk_issue(10, place='louvre'))
+            results = manager.authenticate_many(issued, place='louvre')
+        self.assertEqual([ticket.uuid for ticket in results],
+                         [ticket_uuid for ticket_uuid, password in issued])
+
+    @mock.patch('django_ticketoffice.settings.TICKETOFFICE_UUID_FILTER',
+                new={})
+    def test_uuid_filter(self):
+        """UUID filter holds tickets of all shards."""
+        manager = models.Ticket.objects
+        issued = [manager.issue(place=self.get_place(shard))
+                  for shard in ['shard1', 'shard2']]
+        self.addCleanup(setattr, bloom.uuid_filter, 'filter', None)
+        bloom.uuid_filter.build()
+        for ticket, password in issued:
+            self.assertEqual(manager.authenticate(ticket.uuid, password,
+                                                  place=ticket.place),
+                             ticket)
+        # Tickets issued by other processes are synced too.
+        ticket = models.Ticket(place=self.get_place('shard2'))
+        manager.using('shard2').bulk_create([ticket])
+        self.assertFalse(bloom.uuid_filter.might_contain(ticket.uuid))
+        bloom.uuid_filter.sync()
+        self.assertTrue(bloom.uuid_filter.might_contain(ticket.uuid))
+
+    def test_invitation_required(self):
+        """invitation_required validates tickets on their shard."""
+        place = self.get_place('shard2')
+        ticket, password = models.Ticket.objects.issue(place=place,
+                                                       purpose='visit')
+        view = decorators.invitation_required(place=place, purpose='visit')(
+            decorators.stamp_invitation(InvitationView.as_view()))
+        factory = django.test.RequestFactory()
+        request = factory.get('/', {'uuid': str(ticket.uuid),
+                                    'password': password})
+        request.session = {}
+        self.assertEqual(view(request).status_code, 302)
+        request = factory.get('/')
+        request.session = {'invitation': str(ticket.uuid)}
+        self.assertEqual(view(request).content, place.encode())
+        ticket.refresh_from_db()
+        self.assertTrue(ticket.used)
+
+    def test_stamp_invitation_atomic(self):
+        """stamp_invitation(atomic=True) runs view in a transaction on
+        ticket's shard."""
+        ticket, password = models.Ticket.objects.issue(
+            place=self.get_place('shard2'))
+        in_atomic_block = {}
+
+        def view(request):
+            for alias in ['default', 'shard2']:
+                in_atomic_block[alias] = \
+                    transaction.get_connection(alias).in_atomic_block
+            return HttpResponse()
+
+        request = django.test.RequestFactory().get('/')
+        request.session = {}
+        request.invitation = ticket
+        decorators.stamp_invitation(atomic=True)(view)(request)
+        self.assertEqual(in_atomic_block, {'default': False, 'shard2': True})
+        ticket.refresh_from_db()
+        self.assertTrue(ticket.used)
+
+    def test_query_report(self):
+        """TicketQueryReportMiddleware counts queries of each shard."""
+        issued = [models.Ticket.objects.issue(place=self.get_place(shard))
+                  for shard in ['shard1', 'shard2']]
+
+        def view(request):
+            for ticket, password in issued:
+                models.Ticket.objects.authenticate(ticket.uuid, password,
+                                                   place=ticket.place)
+            return HttpResponse()
+
+        request = django.test.RequestFactory().get('/')
+        response = TicketQueryReportMiddleware(view)(request)
+        report = response[TicketQueryReportMiddleware.header]
+        self.assertTrue(report.startswith('queries=2 (shard1=1, shard2=1); '),
+                        report)
+
+    def test_clean_tickets(self):
+        """clean_tickets cleans shards in parallel."""
+        for shard in ['shard1', 'shard2']:
+            place = self.get_place(shard)
+            for x in range(3):
+                models.Ticket.objects.issue(
+                    place=place, expiry_datetime=now() - timedelta(days=1))
+            models.Ticket.objects.issue(place=place)
+        stdout = StringIO()
+        call_command('clean_tickets', batch_size=2, verbosity=2,
+                     stdout=stdout)
+        self.assertIn('Deleted 6 expired tickets', stdout.getvalue())
+        self.assertEqual(models.Ticket.objects.using('shard1').count(), 1)
+        self.assertEqual(models.Ticket.objects.using('shard2').count(), 1)
+
+    def test_export_tickets(self):
+        """export_tickets exports tickets of all shards."""
+        for shard in ['shard1', 'shard2']:
+            models.Ticket.objects.issue(place=self.get_place(shard))
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'tickets.jsonl')
+            call_command('export_tickets', path, then_delete=True,
+                         stdout=StringIO())
+            with open(path) as output:
+                self.assertEqual(len(output.readlines()), 2)
+        self.assertFalse(models.Ticket.objects.using('shard1').exists())
+        self.assertFalse(models.Ticket.objects.using('shard2').exists())
+
+
 class SettingsTestCase(django.test.TestCase):
     """Test suite around django.conf.settings."""
     def test_password_generator(self):
@@ -463,6 +1995,60 @@ class UtilsTestCase(unittest.TestCase):
         with self.assertRaises(ValueError):
             utils.random_unicode(min_length=10, max_length=1)
 
+    def test_random_passwords(self):
+        """random_passwords() returns passwords of alphabet and lengths."""
+        passwords = utils.random_passwords(1000, min_length=2, max_length=5,
+                                           alphabet='abc')
+        self.assertEqual(len(passwords), 1000)
+        self.assertEqual({len(password) for password in passwords},
+                         {2, 3, 4, 5})
+        self.assertEqual(set(''.join(passwords)), {'a', 'b', 'c'})
+
+    def test_random_unicodes_non_ascii(self):
+        """random_unicodes() supports non-ASCII alphabets."""
+        self.assertEqual(set(utils.random_unicodes(10, 3, alphabet='é')),
+                         {'ééé'})
+
+    def test_random_indexes(self):
+        """random_indexes() has no modulo bias."""
+        # 255 % 3 == 0, so that byte 255 is the only one to reject.
+        with mock.patch('os.urandom', side_effect=[bytes([255, 0, 1]),
+                                                   bytes(range(254, 256))]):
+            self.assertEqual(list(utils.random_indexes(3, 3)), [0, 1, 2])
+        indexes = utils.random_indexes(200, 20000)
+        self.assertEqual(set(indexes), set(range(200)))
+        self.assertEqual(len(utils.random_indexes(1000, 5)), 5)
+
+    def test_password_generation_benchmark(self):
+        """Benchmark compares password generators."""
+        self.assertEqual(
+            set(benchmarks.bench_password_generation(count=10)),
+            {'SystemRandom', 'random_password', 'random_passwords'})
+
+
+class HMACPasswordHasherTestCase(unittest.TestCase):
+    """Test suite around :class:`django_ticketoffice.utils.HMACPasswordHasher`.
+    """
+    def test_verify(self):
+        """HMACPasswordHasher verifies encoded passwords."""
+        hasher = utils.HMACPasswordHasher()
+        encoded = hasher.encode('secret', hasher.salt())
+        self.assertTrue(hasher.verify('secret', encoded))
+        self.assertFalse(hasher.verify('wrong', encoded))
+
+    def test_salt(self):
+        """HMACPasswordHasher output depends on salt."""
+        hasher = utils.HMACPasswordHasher()
+        self.assertNotEqual(hasher.encode('secret', 'salt1'),
+                            hasher.encode('secret', 'salt2'))
+
+    def test_key(self):
+        """HMACPasswordHasher output depends on settings.SECRET_KEY."""
+        hasher = utils.HMACPasswordHasher()
+        encoded = hasher.encode('secret', 'salt')
+        with django.test.override_settings(SECRET_KEY='Other secret.'):
+            self.assertFalse(hasher.verify('secret', encoded))
+
 
 class CommandsTestCase(django.test.TestCase):
 
@@ -502,3 +2088,153 @@ class CommandsTestCase(django.test.TestCase):
             valid_qs.count(),
             5
         )
+
+    def test_clean_tickets_batches(self):
+        """clean_tickets deletes expired tickets by batches."""
+        manager = models.Ticket.objects
+        for x in range(5):
+            manager.create(expiry_datetime=now() - timedelta(days=1))
+        valid = manager.create(expiry_datetime=now() + timedelta(days=1))
+        stdout = StringIO()
+        # 3 batches: 2 + 2 + 1, each one SELECT and one DELETE, then a last
+        # SELECT which finds nothing.
+        with self.assertNumQueries(7):
+            call_command('clean_tickets', batch_size=2, verbosity=2,
+                         stdout=stdout)
+        self.assertEqual(list(manager.all()), [valid])
+        self.assertIn('Deleted 5 expired tickets', stdout.getvalue())
+
+    def test_clean_tickets_quiet(self):
+        """clean_tickets writes nothing at default verbosity."""
+        models.Ticket.objects.create(
+            expiry_datetime=now() - timedelta(days=1))
+        stdout = StringIO()
+        call_command('clean_tickets', stdout=stdout)
+        self.assertEqual(stdout.getvalue(), '')
+        self.assertEqual(models.Ticket.objects.count(), 0)
+
+    def test_clean_tickets_dry_run(self):
+        """clean_tickets --dry-run only counts expired tickets."""
+        manager = models.Ticket.objects
+        for x in range(3):
+            manager.create(expiry_datetime=now() - timedelta(days=1))
+        stdout = StringIO()
+        call_command('clean_tickets', dry_run=True, stdout=stdout)
+        self.assertEqual(manager.count(), 3)
+        self.assertIn('3 expired tickets would be deleted', stdout.getvalue())
+
+    def test_clean_tickets_max_runtime(self):
+        """clean_tickets stops after --max-runtime seconds."""
+        manager = models.Ticket.objects
+        for x in range(3):
+            manager.create(expiry_datetime=now() - timedelta(days=1))
+        call_command('clean_tickets', batch_size=2, max_runtime=0,
+                     stdout=StringIO())
+        self.assertEqual(manager.count(), 1)
+
+    def test_export_tickets(self):
+        """export_tickets writes matching tickets as gzipped JSON lines."""
+        manager = models.Ticket.objects
+        tickets = [manager.create(place='louvre', data={'user': x})
+                   for x in range(3)]
+        manager.create(place='orsay')
+        tickets[0].use()
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'tickets.jsonl.gz')
+            call_command('export_tickets', path, place='louvre',
+                         status='active', batch_size=1, stdout=StringIO())
+            with gzip.open(path, 'rt') as output:
+                rows = [json.loads(line) for line in output]
+        self.assertEqual([row['uuid'] for row in rows],
+                         [str(ticket.uuid) for ticket in tickets[1:]])
+        self.assertEqual(rows[0]['data'], {'user': 1})
+        self.assertNotIn('password', rows[0])
+        self.assertEqual(manager.count(), 4)
+
+    def export_created(self, *args):
+        """Run export_tickets with ``args``, return exported places.
+
+        Tickets are created on 2020-01-01, 2020-01-02 and 2020-01-03.
+
+        """
+        for day in (1, 2, 3):
+            ticket = models.Ticket.objects.create(place=f'day{day}')
+            timestamp = datetime(2020, 1, day, 12)
+            if settings.USE_TZ:
+                timestamp = make_aware(timestamp)
+            models.Ticket.objects.filter(pk=ticket.pk).update(
+                creation_datetime=timestamp)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'tickets.jsonl')
+            call_command('export_tickets', path, *args, stdout=StringIO())
+            with open(path) as output:
+                return [json.loads(line)['place'] for line in output]
+
+    def test_export_tickets_created_after(self):
+        """export_tickets --created-after exports tickets created since
+        date, with or without time zone support."""
+        for use_tz in (True, False):
+            with self.subTest(use_tz=use_tz), \
+                    mock.patch.object(settings, 'USE_TZ', use_tz):
+                models.Ticket.objects.all().delete()
+                self.assertEqual(
+                    self.export_created('--created-after=2020-01-02'),
+                    ['day2', 'day3'])
+
+    def test_export_tickets_created_before(self):
+        """export_tickets --created-before exports tickets created before
+        datetime, with or without time zone support."""
+        for use_tz in (True, False):
+            with self.subTest(use_tz=use_tz), \
+                    mock.patch.object(settings, 'USE_TZ', use_tz):
+                models.Ticket.objects.all().delete()
+                self.assertEqual(
+                    self.export_created(
+                        '--created-before=2020-01-02T12:00:00+00:00'),
+                    ['day1'])
+
+    def test_export_tickets_then_delete(self):
+        """export_tickets --then-delete deletes exported tickets."""
+        manager = models.Ticket.objects
+        for x in range(3):
+            manager.create(expiry_datetime=now() - timedelta(days=1))
+        valid = manager.create()
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'tickets.csv')
+            call_command('export_tickets', path, format='csv',
+                         status='expired', then_delete=True, batch_size=2,
+                         stdout=StringIO())
+            with open(path, newline='') as output:
+                rows = list(csv.DictReader(output))
+        self.assertEqual(len(rows), 3)
+        self.assertEqual(rows[0]['data'], '{}')
+        self.assertEqual(list(manager.all()), [valid])
+
+    @mock.patch('django_ticketoffice.management.commands.benchmark_tickets'
+                '.teardown_databases')
+    @mock.patch('django_ticketoffice.management.commands.benchmark_tickets'
+                '.setup_databases')
+    def test_benchmark_tickets(self, setup_databases, teardown_databases):
+        """benchmark_tickets runs benchmarks in a test database."""
+        stdout = StringIO()
+        call_command('benchmark_tickets', 'generate_password', 'lifecycle',
+                     sizes=[10, 20], format='json', stdout=stdout)
+        self.assertTrue(setup_databases.called)
+        self.assertTrue(teardown_databases.called)
+        output = json.loads(stdout.getvalue())
+        self.assertEqual(output['database'], connection.vendor)
+        self.assertEqual(
+            [(result['benchmark'], result['size'], result['label'])
+             for result in output['results']],
+            [('generate_password', None, 'Ticket.generate_password')]
+            + [('lifecycle', size, label)
+               for size in (10, 20)
+               for label in ('Ticket.authenticate',
+                             'TicketManager.authenticate',
+                             'invitation_required', 'stamp_invitation')])
+        self.assertEqual(models.Ticket.objects.count(), 0)
+
+    def test_benchmark_tickets_unknown(self):
+        """benchmark_tickets rejects unknown benchmarks."""
+        with self.assertRaises(CommandError):
+            call_command('benchmark_tickets', 'foo', stdout=StringIO())
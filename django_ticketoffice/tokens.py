@@ -0,0 +1,150 @@
+"""Stateless signed tokens.
+
+A token is a signed, compact encoding of a ticket's id, UUID, place,
+purpose, expiry, maximum uses and revocation generation.
+``invitation_required(..., tokens=True)`` validates tokens without querying
+tickets, nor hashing passwords: use them for links that only need to be
+authentic and unexpired. Revocation generations are read from cache, or
+from database on cache miss.
+
+.. warning::
+
+   Tokens are not checked against tickets' usage: only ``stamp_invitation``
+   does, when it consumes the ticket. A token stays valid until expiry after
+   its ticket was used or revoked, e.g. with ``Ticket.use()`` or
+   ``TicketQuerySet.revoke()``. Revoke tokens by place and purpose with
+   :func:`revoke`.
+
+"""
+import hashlib
+import json
+from datetime import datetime, timezone
+from uuid import UUID
+
+from django.conf import settings as django_settings
+from django.core import signing
+from django.core.cache import caches
+from django.db import IntegrityError, router, transaction
+from django.db.models import F
+from django.utils.timezone import make_naive
+
+from django_ticketoffice import exceptions, settings
+from django_ticketoffice.models import Ticket, TokenGeneration
+
+
+#: Name of GET parameter holding tokens.
+TOKEN_PARAMETER = 'token'
+
+#: Salt of tokens' signatures.
+TOKEN_SALT = 'django_ticketoffice.tokens'
+
+
+class TokenGenerations:
+    """Revocation generations of tokens, by place and purpose.
+
+    Tokens carry the generation of their place and purpose when they were
+    made. Incrementing the generation revokes all tokens made before.
+
+    Generations are stored in database, as
+    :class:`~django_ticketoffice.models.TokenGeneration`, so that
+    revocations are durable. Cache ``settings.TICKETOFFICE_TOKEN_CACHE`` of
+    ``settings.CACHES`` is read through, for :attr:`timeout` seconds: if the
+    cache is not shared by processes, revocations reach other processes
+    within this delay.
+
+    """
+    #: Prefix of cache keys.
+    key_prefix = 'ticketoffice:generation:'
+
+    #: Lifetime of cached generations, in seconds.
+    timeout = 60
+
+    @property
+    def backend(self):
+        """Return Django cache backend."""
+        return caches[settings.TICKETOFFICE_TOKEN_CACHE]
+
+    def make_key(self, place, purpose):
+        # Place and purpose may contain characters invalid in cache keys.
+        digest = hashlib.sha256(json.dumps([place, purpose]).encode())
+        return f'{self.key_prefix}{digest.hexdigest()}'
+
+    def get(self, place, purpose):
+        """Return current generation of ``place`` and ``purpose``."""
+        key = self.make_key(place, purpose)
+        generation = self.backend.get(key)
+        if generation is None:
+            generation = TokenGeneration.objects \
+                .filter(place=place, purpose=purpose) \
+                .values_list('generation', flat=True).first() or 0
+            # Does not overwrite the value of a concurrent increment().
+            self.backend.add(key, generation, self.timeout)
+        return generation
+
+    def increment(self, place, purpose):
+        """Increment generation of ``place`` and ``purpose``, return it."""
+        database = router.db_for_write(TokenGeneration)
+        generations = TokenGeneration.objects.using(database)
+        queryset = generations.filter(place=place, purpose=purpose)
+        with transaction.atomic(using=database):
+            if not queryset.update(generation=F('generation') + 1):
+                try:
+                    with transaction.atomic(using=database):
+                        generations.create(place=place, purpose=purpose,
+                                           generation=1)
+                except IntegrityError:  # Created concurrently.
+                    queryset.update(generation=F('generation') + 1)
+            generation = queryset.values_list('generation', flat=True).get()
+        self.backend.set(self.make_key(place, purpose), generation,
+                         self.timeout)
+        return generation
+
+
+#: Generations of tokens.
+generations = TokenGenerations()
+
+
+def make_token(ticket):
+    """Return signed token for ``ticket``."""
+    expiry = ticket.expiry_datetime
+    if expiry is not None:
+        expiry = int(expiry.timestamp())
+    generation = generations.get(ticket.place, ticket.purpose)
+    return signing.dumps([ticket.pk, ticket.uuid.hex, ticket.place,
+                          ticket.purpose, expiry, ticket.max_uses,
+                          generation],
+                         salt=TOKEN_SALT,
+                         compress=True)
+
+
+def load_token(token):
+    """Return ticket from signed ``token``, without querying the database.
+
+    Fields other than id, UUID, place, purpose, expiry and maximum uses are
+    loaded on first access.
+
+    Raises :class:`~django_ticketoffice.exceptions.CredentialsError` if
+    token was tampered with or revoked.
+
+    """
+    try:
+        pk, uuid, place, purpose, expiry, max_uses, generation = \
+            signing.loads(token, salt=TOKEN_SALT)
+    except (signing.BadSignature, TypeError, ValueError):
+        raise exceptions.CredentialsError('Invalid token.')
+    if generation < generations.get(place, purpose):
+        raise exceptions.CredentialsError(f'Token of ticket {uuid} revoked.')
+    if expiry is not None:
+        expiry = datetime.fromtimestamp(expiry, tz=timezone.utc)
+        if not django_settings.USE_TZ:
+            expiry = make_naive(expiry)
+    return Ticket.from_db(None,
+                          ['id', 'uuid', 'place', 'purpose',
+                           'expiry_datetime', 'usage_datetime', 'max_uses'],
+                          [pk, UUID(uuid), place, purpose, expiry, None,
+                           max_uses])
+
+
+def revoke(place, purpose):
+    """Revoke all tokens of ``place`` and ``purpose`` made so far."""
+    return generations.increment(place, purpose)
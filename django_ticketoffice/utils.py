@@ -1,20 +1,77 @@
 """Utilities that may be packaged in external libraries."""
-from random import SystemRandom
+import asyncio
+import hashlib
+import hmac
+import os
+import secrets
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from importlib import import_module
 
+from django.conf import settings
 from django.views.generic import TemplateView
 from django.contrib.auth.hashers import BasePasswordHasher, mask_hash
+from django.utils.crypto import constant_time_compare
 
+from django_ticketoffice.compat import markcoroutinefunction
 
-def random_unicode(min_length=None,
-                   max_length=None,
-                   alphabet='abcdefghijklmnopqrstuvwxyz'
-                            'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
-                            '0123456789'):
-    """Return random unicode.
 
-    .. note:: Uses :py:func:`os.urandom`.
+@lru_cache()
+def index_tables(n):
+    """Return ``(limit, table, rejected)`` for :func:`random_indexes`."""
+    limit = 256 - 256 % n
+    table = bytes(byte % n for byte in range(256))
+    rejected = bytes(range(limit, 256))
+    return limit, table, rejected
+
+
+def random_indexes(n, count):
+    """Return ``count`` random integers in ``range(n)``, uniformly.
+
+    For ``n`` up to 256, returns :py:class:`bytes` read from
+    :py:func:`os.urandom` in bulk. Bytes greater than the largest multiple of
+    ``n`` are dropped, so that ``byte % n`` has no modulo bias.
+
+    """
+    if n > 256:
+        return [secrets.randbelow(n) for i in range(count)]
+    limit, table, rejected = index_tables(n)
+    indexes = b''
+    while len(indexes) < count:
+        missing = count - len(indexes)
+        # Read enough bytes to get missing ones after rejection, on average.
+        buffer = os.urandom(missing * 256 // limit + 8)
+        indexes += buffer.translate(table, rejected)
+    return indexes[:count]
+
+
+@lru_cache()
+def alphabet_table(alphabet):
+    """Return table that translates indexes to bytes of ASCII ``alphabet``."""
+    return alphabet.encode('ascii').ljust(256, b'\0')
+
+
+def random_characters(count, alphabet):
+    """Return ``count`` characters drawn uniformly from ``alphabet``."""
+    indexes = random_indexes(len(alphabet), count)
+    if len(alphabet) <= 256 and alphabet.isascii():
+        return indexes.translate(alphabet_table(alphabet)).decode('ascii')
+    return ''.join(alphabet[index] for index in indexes)
+
+
+def random_unicodes(count,
+                    min_length=None,
+                    max_length=None,
+                    alphabet='abcdefghijklmnopqrstuvwxyz'
+                             'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+                             '0123456789'):
+    """Return list of ``count`` random unicode strings.
+
+    Lengths are uniformly distributed between ``min_length`` and
+    ``max_length``, characters are uniformly drawn from ``alphabet``.
+
+    .. note:: Uses :py:func:`os.urandom`, a few calls for all strings.
 
     """
     if min_length is None:
@@ -32,9 +89,36 @@ def random_unicode(min_length=None,
     if max_length < min_length:
         raise ValueError("Maximum length must be greater than minimum length.")
 
-    random = SystemRandom()
-    length = random.randint(min_length, max_length)
-    return ''.join(random.choice(alphabet) for i in range(length))
+    lengths = [min_length + index for index
+               in random_indexes(max_length - min_length + 1, count)]
+    characters = random_characters(sum(lengths), alphabet)
+    strings = []
+    start = 0
+    for length in lengths:
+        strings.append(characters[start:start + length])
+        start += length
+    return strings
+
+
+def random_unicode(min_length=None,
+                   max_length=None,
+                   alphabet='abcdefghijklmnopqrstuvwxyz'
+                            'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+                            '0123456789'):
+    """Return random unicode.
+
+    .. note:: Uses :py:func:`os.urandom`.
+
+    """
+    return random_unicodes(1, min_length, max_length, alphabet)[0]
+
+
+def random_passwords(count, min_length=16, max_length=32,
+                     alphabet='abcdefghjkmnpqrstuvwxyz'
+                              'ABCDEFGHJKLMNPQRSTUVWXYZ'
+                              '23456789'):
+    """Return list of ``count`` passwords, see :func:`random_password`."""
+    return random_unicodes(count, min_length, max_length, alphabet)
 
 
 def random_password(min_length=16, max_length=32,
@@ -49,7 +133,13 @@ def random_password(min_length=16, max_length=32,
        letters and digits that look similar -- just to avoid confusion.
 
     """
-    return random_unicode(min_length, max_length, alphabet)
+    return random_passwords(1, min_length, max_length, alphabet)[0]
+
+
+# Password generators may generate many passwords at once: ``many`` takes
+# the number of passwords, then generator's arguments.
+random_unicode.many = random_unicodes
+random_password.many = random_passwords
 
 
 class PlainPasswordHasher(BasePasswordHasher):
@@ -74,6 +164,83 @@ class PlainPasswordHasher(BasePasswordHasher):
         ])
 
 
+class HMACPasswordHasher(BasePasswordHasher):
+    """Keyed HMAC-SHA256 hashing algorithm, for random secrets only.
+
+    There is no key stretching: verification takes microseconds. It is safe
+    for high-entropy random secrets, such as the ones generated by
+    :func:`random_password`, because they cannot be guessed by brute force
+    anyway. Do NOT use it for passwords chosen by humans.
+
+    The key is derived from ``settings.SECRET_KEY``: changing it invalidates
+    passwords encrypted with this hasher.
+
+    """
+    algorithm = "hmac_sha256"
+    digest = hashlib.sha256
+
+    def key(self):
+        """Return key derived from ``settings.SECRET_KEY``."""
+        return hashlib.sha256(
+            f'{__name__}.{self.__class__.__name__}{settings.SECRET_KEY}'
+            .encode()).digest()
+
+    def encode(self, password, salt):
+        assert password is not None
+        assert salt and '$' not in salt
+        hash = hmac.new(self.key(), f'{salt}${password}'.encode(),
+                        self.digest).hexdigest()
+        return f'{self.algorithm}${salt}${hash}'
+
+    def decode(self, encoded):
+        algorithm, salt, hash = encoded.split('$', 2)
+        assert algorithm == self.algorithm
+        return {
+            'algorithm': algorithm,
+            'hash': hash,
+            'salt': salt,
+        }
+
+    def verify(self, password, encoded):
+        decoded = self.decode(encoded)
+        return constant_time_compare(encoded,
+                                     self.encode(password, decoded['salt']))
+
+    def safe_summary(self, encoded):
+        decoded = self.decode(encoded)
+        return OrderedDict([
+            ('algorithm', decoded['algorithm']),
+            ('salt', mask_hash(decoded['salt'], show=2)),
+            ('hash', mask_hash(decoded['hash'])),
+        ])
+
+    def harden_runtime(self, password, encoded):
+        pass
+
+
+@lru_cache()
+def import_hasher(import_string):
+    """Return instance of password hasher class at ``import_string``."""
+    return import_member(import_string)()
+
+
+@lru_cache()
+def import_generator(import_string):
+    """Return password generator at ``import_string``, imported once."""
+    return import_member(import_string)
+
+
+@lru_cache()
+def get_executor(max_workers=None):
+    """Return shared thread pool of ``max_workers`` threads.
+
+    Default ``max_workers`` is the number of processors.
+
+    """
+    return ThreadPoolExecutor(max_workers=max_workers or os.cpu_count(),
+                              thread_name_prefix='ticketoffice')
+
+
 class UnauthorizedView(TemplateView):
     template_name = '401.html'
 
@@ -142,6 +309,15 @@ class Decorator:
     special implementation in Decorator. Generally, consider overriding
     :meth:`run` instead of :meth:`__call__`.
 
+    A decorator instance is shared by all calls of the decorated function,
+    possibly from concurrent threads. So :meth:`run` must not store per-call
+    state in instance attributes: keep it in local variables, and pass it as
+    arguments.
+
+    If the decorated function is a coroutine function, the decorator instance
+    is marked as a coroutine function too, so that callers such as Django
+    await it. Then :meth:`run` must return an awaitable.
+
     """
     #: Sentinel to detect undefined function argument.
     UNDEFINED_FUNCTION = UNDEFINED_FUNCTION
@@ -206,6 +382,8 @@ class Decorator:
             raise NotCallableError(
                 f'Cannot decorate non callable object "{func}"')
         self.decorated = func
+        if asyncio.iscoroutinefunction(func):
+            markcoroutinefunction(self)
         return self
 
     def __call__(self, *args, **kwargs):
@@ -2,12 +2,29 @@
 from uuid import UUID
 
 from django.core.exceptions import PermissionDenied
+from django.http import Http404, HttpResponse
 from django.utils.translation import gettext_lazy as _
 from django.contrib import messages
 
+from django_ticketoffice.metrics import metrics
 from django_ticketoffice.models import Ticket
 
 
+def metrics_view(request):
+    """Render metrics in Prometheus text format.
+
+    Requires ``settings.TICKETOFFICE_METRICS`` to be a backend with a
+    ``render()`` method, such as
+    :class:`~django_ticketoffice.metrics.Registry`. Returns 404 otherwise.
+
+    """
+    if not metrics.enabled or not hasattr(metrics.backend, 'render'):
+        raise Http404('No metrics registry.')
+    return HttpResponse(metrics.backend.render(),
+                        content_type='text/plain; version=0.0.4; '
+                                     'charset=utf-8')
+
+
 class InvitationMixin:
     "Mixin that extracts `invitation` property from request."
     @property
@@ -29,7 +46,8 @@ class InvitationMixin:
                                          _('Invalid invitation credentials.'))
                     raise PermissionDenied()
                 try:
-                    ticket = Ticket.objects.get(uuid=ticket_uuid)
+                    ticket = Ticket.objects.get_for_validation(
+                        uuid=ticket_uuid)
                 except Ticket.DoesNotExist:
                     messages.add_message(self.request, messages.ERROR,
                                          _('Invalid invitation.'))
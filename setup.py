@@ -28,7 +28,7 @@ KEYWORDS = [
 ]
 PACKAGES = [NAME.replace('-', '_')]
 REQUIREMENTS = [
-    'Django>=2',
+    'Django>=3.1',
     'psycopg2',
     'setuptools',
 ]